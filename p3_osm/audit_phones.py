@@ -22,7 +22,8 @@ An exception is made for the short numbers starting with "1" and containing
 
 from collections import defaultdict
 import re
-from pymongo import MongoClient
+import osm_sinks
+import value_dump
 
 
 # Swiss numbering plan E.164/2002
@@ -276,9 +277,6 @@ def audit_phone(phone: str):
 
 ################################################################################
 
-# Default location of the MongoDB server
-DEFAULT_MONGODB_HOST = "mongodb://localhost:27017"
-
 # Tuple listing all common OSM XML keys that can tag a phone number
 OSM_PHONE_KEYS = ('phone', 'mobile', 'fax',
                   'contact:phone', 'contact:mobile', 'contact_fax')
@@ -318,9 +316,8 @@ def print_audit_results(results: dict):
             print("{:<30}".format(dirty))
 
 
-def audit_file(filename: str):
-    """Extract phone numbers from a text file, audit & clean them, and print the
-    results.
+def read_dump_phones(filename: str):
+    """Extract the phone numbers from a k:v dump file.
 
     The data file is expected to be a valid Python dictionary, that can be
     eval'd. A suitable format is the one output by the get_xml_values.py script
@@ -330,6 +327,9 @@ def audit_file(filename: str):
                       'contact:phone':  {'+044 411 84 42',
                                          '+41 (0)43 268 59 30'}}}
 
+    Value dump files (e.g. "kv-node-tag.vals.gz", see value_dump.py) are
+    streamed instead, and only the values of the phone keys are decoded.
+
     The function extracts phone numbers marked by keys specified in the
     OSM_PHONE_KEYS tuple.
 
@@ -337,32 +337,57 @@ def audit_file(filename: str):
         filename: str - the filename of the file containing phone numbers
 
     Returns:
-        None
+        list of phone number strings, or None if the file is invalid
     """
+    phones = []
+
+    if value_dump.is_dump(filename):
+        for (_, values) in value_dump.iter_values(filename, OSM_PHONE_KEYS):
+            phones.extend(values)
+        return phones
+
     with open(filename) as fd:
         # Read the input file expecting it to be a valid Python dictionary
         try:
             kv = eval(fd.read())
         except SyntaxError:
             print("ERROR: The input file is not a valid Python dictionary!")
-            return
+            return None
 
-        # Extract the main dictionary behind the top-level key
-        # e.g. './/node/tag'
-        kv = kv.popitem()[1]
+    # Extract the main dictionary behind the top-level key
+    # e.g. './/node/tag'
+    kv = kv.popitem()[1]
 
-        # Extract all the phones specified by the applicable OSM XML keys
-        phones = []
-        for key in OSM_PHONE_KEYS:
-            if key in kv.keys():
-                phones.extend(kv[key])
+    # Extract all the phones specified by the applicable OSM XML keys
+    for key in OSM_PHONE_KEYS:
+        if key in kv.keys():
+            phones.extend(kv[key])
+
+    return phones
+
+
+def audit_file(filename: str):
+    """Extract phone numbers from a text file, audit & clean them, and print the
+    results.
+
+    See read_dump_phones() for the supported file formats.
+
+    Input:
+        filename: str - the filename of the file containing phone numbers
+
+    Returns:
+        None
+    """
+    phones = read_dump_phones(filename)
+    if phones is None:
+        return
 
-        # Audit and clean the extracted numbers
-        results = defaultdict(list)
+    # Audit and clean the extracted numbers
+    results = defaultdict(list)
 
-        for dirty in phones:
-            (fixed, _, class_id, _) = audit_phone(dirty)
-            results[class_id].append((dirty, fixed))
+    for dirty in phones:
+        (fixed, _, class_id, _) = audit_phone(dirty)
+        results[class_id].append((dirty, fixed))
 
     print_audit_results(results)
 
@@ -392,6 +417,8 @@ def audit_mongodb(host, dbase, coll):
     Returns:
         None
     """
+    from pymongo import MongoClient
+
     client = MongoClient(host)
     dbase = client[dbase]
     coll = dbase[coll]
@@ -441,18 +468,17 @@ def main():
     parser.add_argument("-m", "--mongodb", metavar="[host:port/]DB/COLLECTION",
                         help="take input from a MongoDB")
     parser.add_argument("-d", "--dump", metavar="FILE",
-                        help="take input from an OSM K:V dump file")
+                        help="take input from an OSM K:V dump file (pprint'ed "
+                             "dict or value dump, e.g. kv-node-tag.vals.gz)")
     args = parser.parse_args()
 
     if args.mongodb:
         print("> MongoDB mode enabled")
-        m = re.match(r"(.*:.*/)*(.*)/(.*)", args.mongodb)
-        if not m:
+        try:
+            (host, dbase, collection) = osm_sinks.parse_mongodb_spec(args.mongodb)
+        except ValueError:
             print("ERROR: Invalid specification of MongoDB database")
             return
-        host = m.group(1) or DEFAULT_MONGODB_HOST
-        dbase = m.group(2)
-        collection = m.group(3)
         print("> MongoDB: host {}, dbase: {}, collection: {}".format(
             host, dbase, collection))
         print()
@@ -0,0 +1,315 @@
+#!/usr/bin/python3
+
+"""Benchmarks for the OSM processing scripts.
+
+Each benchmark is run as a sub-command on a given OSM input file and prints a
+small table with its results, e.g.:
+
+    > ./bench.py bz2 zurich-area.osm.bz2
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import open_file
+
+
+def _megabytes(nbytes):
+    """Convert a number of bytes to megabytes."""
+    return nbytes / (1024 * 1024)
+
+
+def _drain(inf, size=1024 * 1024):
+    """Read a fileobject to its end and return the number of bytes read."""
+    total = 0
+    with inf:
+        while True:
+            data = inf.read(size)
+            if not data:
+                return total
+            total += len(data)
+
+
+def bench_bz2(filename, max_jobs=None):
+    """Compare the bzip2 decompression throughput for different core counts.
+
+    The serial bz2.BZ2File reader is compared against the parallel block-wise
+    decompression with 1, 2, 4, ... worker processes.
+    """
+    max_jobs = max_jobs or os.cpu_count() or 1
+
+    runs = [("bz2.BZ2File", 1)]
+    jobs = 1
+    while jobs <= max_jobs:
+        runs.append(("parallel", jobs))
+        jobs *= 2
+
+    print("{:<12} {:>5} {:>10} {:>10}".format("reader", "jobs", "time [s]", "MB/s"))
+    for (reader, jobs) in runs:
+        start = time.perf_counter()
+        if reader == "parallel":
+            import bz2_parallel
+            nbytes = _drain(bz2_parallel.open_parallel(filename, jobs))
+        else:
+            nbytes = _drain(open_file.open_file(filename))
+        elapsed = time.perf_counter() - start
+        print("{:<12} {:>5} {:>10.2f} {:>10.1f}".format(
+            reader, jobs, elapsed, _megabytes(nbytes) / elapsed))
+
+
+def bench_schema(filename):
+    """Compare the get_xml_schema parsing engines in elements per second."""
+    import get_xml_schema
+
+    engines = (("iterparse", get_xml_schema.parse_tree),
+               ("expat", get_xml_schema.parse_tree_fast))
+
+    print("{:<12} {:>10} {:>10} {:>12}".format("engine", "elements", "time [s]",
+                                                "elements/s"))
+    for (engine, parse) in engines:
+        start = time.perf_counter()
+        (_, _, tag_counters) = parse(open_file.open_file(filename))
+        elapsed = time.perf_counter() - start
+        elements = sum(tag_counters.values())
+        print("{:<12} {:>10} {:>10.2f} {:>12.0f}".format(
+            engine, elements, elapsed, elements / elapsed))
+
+
+def bench_shape(filename, max_elements=200000):
+    """Compare osm_to_json.shape_element with and without the tag key cache.
+
+    The first max_elements elements below the root are parsed into memory
+    first, so that only shape_element itself is timed.
+    """
+    import osm_to_json
+
+    elements = []
+    depth = 0
+    for (event, elem) in open_file.iterparse(open_file.open_file(filename),
+                                             events=('start', 'end')):
+        depth += 1 if event == 'start' else -1
+        if event == 'end' and depth == 1:
+            elements.append(elem)
+            if len(elements) >= max_elements:
+                break
+    tags = sum(len(elem.findall('tag')) for elem in elements)
+
+    cached = osm_to_json.classify_key
+    runs = (("regexes", cached.__wrapped__), ("key cache", cached))
+
+    print("{} elements with {} tags".format(len(elements), tags))
+    print("{:<12} {:>10} {:>12}".format("variant", "time [s]", "elements/s"))
+    try:
+        for (variant, classify) in runs:
+            osm_to_json.classify_key = classify
+            cached.cache_clear()
+            start = time.perf_counter()
+            for elem in elements:
+                osm_to_json.shape_element(elem)
+            elapsed = time.perf_counter() - start
+            print("{:<12} {:>10.2f} {:>12.0f}".format(variant, elapsed,
+                                                      len(elements) / elapsed))
+    finally:
+        osm_to_json.classify_key = cached
+    print("> Tag key cache: " + osm_to_json.format_key_cache_stats())
+
+
+def _run_isolated(statement):
+    """Run a Python statement in a fresh interpreter in the script folder.
+
+    The statement can set the variable "result" to a JSON serializable value.
+
+    Returns:
+        (elapsed, peak_rss, result) -- the run time in seconds, the peak
+                                       resident memory of the interpreter in
+                                       MB and the result of the statement
+    """
+    # ru_maxrss survives execve() on Linux, so VmHWM is used where available
+    code = ("import json, re, resource, time\n"
+            "result = None\n"
+            "start = time.perf_counter()\n"
+            "{}\n"
+            "elapsed = time.perf_counter() - start\n"
+            "try:\n"
+            "    with open('/proc/self/status') as status:\n"
+            "        rss = int(re.search(r'VmHWM:\\s*(\\d+)', status.read()).group(1))\n"
+            "except OSError:\n"
+            "    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n"
+            "print(json.dumps([elapsed, rss / 1024, result]))\n").format(statement)
+    output = subprocess.run([sys.executable, "-c", code], check=True,
+                            stdout=subprocess.PIPE,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    return tuple(json.loads(output.stdout.decode().splitlines()[-1]))
+
+
+def bench_dump(filename):
+    """Compare loading the phone numbers from a pprint'ed k:v dump with eval()
+    against loading them from value dumps (see value_dump.py).
+
+    Each loader runs in a fresh interpreter, so that its peak memory can be
+    measured.
+    """
+    import value_dump
+
+    filename = os.path.abspath(filename)
+    with open(filename) as inf:
+        (xpath, values) = eval(inf.read()).popitem()
+
+    print("{:<28} {:>10} {:>10} {:>14}".format("loader", "size [MB]", "time [s]",
+                                                "peak RSS [MB]"))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        runs = [("eval .txt", filename,
+                 "import audit_phones; audit_phones.read_dump_phones({!r})")]
+        for suffix in (value_dump.DUMP_SUFFIX, value_dump.DUMP_SUFFIX + ".gz"):
+            dump = os.path.join(tmpdir, "dump" + suffix)
+            value_dump.write_values(dump, xpath, values)
+            runs.append(("read all " + suffix, dump,
+                         "import value_dump; value_dump.read_values({!r})"))
+            runs.append(("stream phones " + suffix, dump,
+                         "import audit_phones; audit_phones.read_dump_phones({!r})"))
+        del values
+
+        for (loader, path, statement) in runs:
+            (elapsed, peak_rss, _) = _run_isolated(statement.format(path))
+            print("{:<28} {:>10.1f} {:>10.2f} {:>14.1f}".format(
+                loader, _megabytes(os.path.getsize(path)), elapsed, peak_rss))
+
+
+def bench_intern(filename):
+    """Compare the peak memory of osm_to_json.process_map(), which keeps all
+    documents in memory, with and without a shared string table.
+
+    Each variant runs in a fresh interpreter, so that its peak memory can be
+    measured.
+    """
+    filename = os.path.abspath(filename)
+    statement = ("import open_file, osm_to_json\n"
+                 "strings = {}\n"
+                 "data = osm_to_json.process_map(open_file.open_file({!r}), {!r}, "
+                 "strings=strings)\n"
+                 "result = [len(data), strings and strings.saved]")
+
+    print("{:<14} {:>10} {:>10} {:>14} {:>12}".format(
+        "variant", "documents", "time [s]", "peak RSS [MB]", "saved [MB]"))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output = os.path.join(tmpdir, "map")
+        for (variant, strings) in (("no interning", "None"),
+                                   ("string table", "osm_to_json.StringTable()")):
+            (elapsed, peak_rss, (count, saved)) = _run_isolated(
+                statement.format(strings, filename, output))
+            print("{:<14} {:>10} {:>10.2f} {:>14.1f} {:>12.1f}".format(
+                variant, count, elapsed, peak_rss, _megabytes(saved or 0)))
+
+
+def bench_parsers(filename, tag=None):
+    """Compare the XML parser backends of xml_parsers.py in elements per
+    second and peak memory.
+
+    Each backend parses the whole input like the scripts do (the elements
+    below the root are cleared after their end event), in a fresh
+    interpreter, so that its peak memory can be measured. With tag, only the
+    elements with this tag directly below the root are counted, as read by
+    xml_parsers.iter_elements() (which releases them and the root's
+    references to them).
+    """
+    import xml_parsers
+
+    filename = os.path.abspath(filename)
+    if tag is None:
+        statement = ("import open_file\n"
+                     "count = depth = 0\n"
+                     "root = None\n"
+                     "for (event, elem) in open_file.iterparse(open_file.open_file({!r}), "
+                     "('start', 'end'), {!r}):\n"
+                     "    if event == 'start':\n"
+                     "        root = elem if root is None else root\n"
+                     "        depth += 1\n"
+                     "        continue\n"
+                     "    depth -= 1\n"
+                     "    count += 1\n"
+                     "    if depth == 1:\n"
+                     "        elem.clear()\n"
+                     "        root.clear()\n"
+                     "result = count")
+    else:
+        statement = ("import open_file, xml_parsers\n"
+                     "count = 0\n"
+                     "for elem in xml_parsers.iter_elements(open_file.open_file({!r}), "
+                     + repr(tag) + ", {!r}):\n"
+                     "    count += 1\n"
+                     "result = count")
+
+    print("{:<8} {:>10} {:>10} {:>12} {:>14}".format(
+        "parser", "elements", "time [s]", "elements/s", "peak RSS [MB]"))
+    for parser in xml_parsers.PARSERS:
+        try:
+            (elapsed, peak_rss, count) = _run_isolated(statement.format(filename, parser))
+        except subprocess.CalledProcessError:
+            print("{:<8} {:>10}".format(parser, "failed"))
+            continue
+        print("{:<8} {:>10} {:>10.2f} {:>12.0f} {:>14.1f}".format(
+            parser, count, elapsed, count / elapsed, peak_rss))
+
+
+def main():
+    """The main function.
+    """
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command")
+
+    cmd = commands.add_parser("bz2", help="bzip2 decompression throughput (MB/s) "
+                                          "vs. number of cores")
+    cmd.add_argument("-j", "--max-jobs", type=int, default=None,
+                     help="maximal number of worker processes to try")
+    cmd.add_argument("filename", metavar="FILE", help="input .bz2 file")
+
+    cmd = commands.add_parser("schema", help="get_xml_schema parsing engines "
+                                             "(elements/s)")
+    cmd.add_argument("filename", metavar="FILE", help="input OSM XML file")
+
+    cmd = commands.add_parser("shape", help="osm_to_json.shape_element with and "
+                                            "without the tag key cache (elements/s)")
+    cmd.add_argument("-n", "--max-elements", type=int, default=200000,
+                     help="number of elements to shape")
+    cmd.add_argument("filename", metavar="FILE", help="input OSM XML file")
+
+    cmd = commands.add_parser("dump", help="loading a k:v dump with eval() vs. "
+                                           "value dumps (time and peak memory)")
+    cmd.add_argument("filename", metavar="FILE",
+                     help="k:v dump file of get_xml_values.py, e.g. kv-node-tag.txt")
+
+    cmd = commands.add_parser("intern", help="osm_to_json.process_map with and "
+                                             "without string interning (peak memory)")
+    cmd.add_argument("filename", metavar="FILE", help="input OSM XML file")
+
+    cmd = commands.add_parser("parsers", help="XML parser backends (elements/s "
+                                              "and peak memory)")
+    cmd.add_argument("--tag", help="count only the elements with this tag below "
+                                   "the root")
+    cmd.add_argument("filename", metavar="FILE", help="input OSM XML file")
+
+    args = parser.parse_args()
+
+    if args.command == "bz2":
+        bench_bz2(args.filename, args.max_jobs)
+    elif args.command == "schema":
+        bench_schema(args.filename)
+    elif args.command == "shape":
+        bench_shape(args.filename, args.max_elements)
+    elif args.command == "dump":
+        bench_dump(args.filename)
+    elif args.command == "intern":
+        bench_intern(args.filename)
+    elif args.command == "parsers":
+        bench_parsers(args.filename, args.tag)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
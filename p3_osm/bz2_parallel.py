@@ -0,0 +1,244 @@
+"""
+Parallel block-wise decompression of bzip2 files.
+
+A bzip2 stream is a sequence of independently compressed blocks. Each block
+starts with the 48-bit magic number 0x314159265359 and the stream ends with
+the 48-bit magic 0x177245385090 followed by a combined CRC. The blocks are
+*bit*-aligned, so they cannot simply be cut out of the file. Instead, each
+block is shifted into a stand-alone one-block bzip2 stream, which can then be
+decompressed by any worker process with the standard bz2 module.
+
+The combined CRC of a one-block stream equals the CRC of that block, which is
+stored in the 32 bits right after the block magic. Multi-stream files (e.g.
+those created by pbzip2) are handled too, since each stream end marker is
+treated like a block boundary.
+
+Attributes:
+    BLOCK_MAGIC: int -- the 48-bit magic number starting each bzip2 block
+    EOS_MAGIC: int -- the 48-bit magic number ending each bzip2 stream
+    READ_SIZE: int -- size in bytes of the compressed data read at once
+"""
+
+import bz2
+import io
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+BLOCK_MAGIC = 0x314159265359
+EOS_MAGIC = 0x177245385090
+READ_SIZE = 4 * 1024 * 1024
+
+# Header of the synthesized one-block streams. The maximal block size level
+# (9) is used, since it accepts blocks created with any lower level.
+_STREAM_HEADER = int.from_bytes(b"BZh9", "big")
+
+
+def _magic_patterns(magic):
+    """Precompute byte patterns for finding a 48-bit magic at any bit offset.
+
+    For each of the 8 possible bit shifts, the magic fully covers at least 5
+    consecutive bytes. These bytes can be searched for with the fast
+    bytes.find(), and the candidate is then verified bit by bit.
+
+    Returns:
+        list of (shift, pattern, lead) tuples, where "lead" is the number of
+        bytes preceding the pattern which are partially covered by the magic
+    """
+    patterns = []
+    for shift in range(8):
+        # Place the magic at bit offset "shift" within a 7-byte window
+        window = (magic << (56 - 48 - shift)).to_bytes(7, "big")
+        if shift == 0:
+            patterns.append((shift, window[0:6], 0))
+        else:
+            patterns.append((shift, window[1:6], 1))
+    return patterns
+
+
+_PATTERNS = {magic: _magic_patterns(magic) for magic in (BLOCK_MAGIC, EOS_MAGIC)}
+
+
+def _bits_at(data, bit_pos, nbits):
+    """Return as int the "nbits" bits of "data" starting at bit "bit_pos"."""
+    start = bit_pos // 8
+    end = (bit_pos + nbits + 7) // 8
+    value = int.from_bytes(data[start:end], "big")
+    value >>= end * 8 - (bit_pos + nbits)
+    return value & ((1 << nbits) - 1)
+
+
+def find_magics(data, magic, start_bit=0):
+    """Find the bit offsets of all occurrences of a 48-bit magic in "data".
+
+    Args:
+        data: bytes -- the compressed data to search
+        magic: int -- either BLOCK_MAGIC or EOS_MAGIC
+        start_bit: int -- bit offset from which to start searching
+
+    Returns:
+        sorted list of int bit offsets
+    """
+    found = set()
+    for (shift, pattern, lead) in _PATTERNS[magic]:
+        pos = max(start_bit // 8 - 1, 0) + lead
+        while True:
+            pos = data.find(pattern, pos)
+            if pos < 0:
+                break
+            bit_pos = (pos - lead) * 8 + shift
+            if (bit_pos >= start_bit and bit_pos + 48 <= len(data) * 8 and
+                    _bits_at(data, bit_pos, 48) == magic):
+                found.add(bit_pos)
+            pos += 1
+    return sorted(found)
+
+
+def make_block_stream(data, start_bit, end_bit):
+    """Wrap a single bit-aligned bzip2 block into a stand-alone bzip2 stream.
+
+    Args:
+        data: bytes -- the compressed data containing the block
+        start_bit: int -- the bit offset of the block magic
+        end_bit: int -- the bit offset where the block ends (i.e. the offset
+                        of the next block magic or stream end magic)
+
+    Returns:
+        bytes -- a complete bzip2 stream decompressable with bz2.decompress()
+    """
+    nbits = end_bit - start_bit
+    block = _bits_at(data, start_bit, nbits)
+    crc = _bits_at(data, start_bit + 48, 32)
+
+    stream = (((_STREAM_HEADER << nbits | block) << 48 | EOS_MAGIC) << 32) | crc
+    total_bits = 32 + nbits + 48 + 32
+    pad = -total_bits % 8
+    return (stream << pad).to_bytes((total_bits + pad) // 8, "big")
+
+
+def iter_blocks(fileobj, read_size=READ_SIZE):
+    """Split a bzip2 file into a sequence of stand-alone one-block streams.
+
+    The compressed file is read in chunks of "read_size" bytes, so memory
+    usage stays bounded regardless of the file size.
+
+    Args:
+        fileobj: binary fileobject of the compressed file
+        read_size: int -- how many compressed bytes to read at once
+
+    Yields:
+        (start, end, stream) tuples, where "start" and "end" are the bit
+        offsets of the block in the compressed file and "stream" are the bytes
+        of a bzip2 stream containing only this block
+    """
+    buf = b""
+    base_bit = 0  # Bit offset of buf[0] within the file
+    eof = False
+
+    while not eof:
+        chunk = fileobj.read(read_size)
+        eof = not chunk
+        buf += chunk
+
+        blocks = find_magics(buf, BLOCK_MAGIC)
+        ends = find_magics(buf, EOS_MAGIC)
+        bounds = sorted(set(blocks) | set(ends))
+
+        consumed_bit = None
+        for (i, start) in enumerate(bounds):
+            if start not in blocks:
+                continue
+            if i + 1 < len(bounds):
+                end = bounds[i + 1]
+            elif eof:
+                raise IOError("Truncated bzip2 file: missing stream end marker")
+            else:
+                # The block end is not yet read in; wait for more data
+                break
+            yield (base_bit + start, base_bit + end,
+                   make_block_stream(buf, start, end))
+            consumed_bit = end
+
+        # Drop the data of the processed blocks, but keep the whole byte
+        # containing the first unprocessed bit
+        if consumed_bit is not None:
+            cut = consumed_bit // 8
+            buf = buf[cut:]
+            base_bit += cut * 8
+
+
+def decompress_block(stream):
+    """Decompress a stand-alone one-block stream (runs in a worker process)."""
+    return bz2.decompress(stream)
+
+
+class ParallelBZ2Reader(io.RawIOBase):
+    """A read-only binary fileobject decompressing bzip2 blocks in parallel.
+
+    Blocks are handed to a pool of worker processes, while the decompressed
+    data is returned to the reader strictly in the original order. At most
+    "2 * jobs" blocks are in flight at any time, so memory usage is bounded
+    to a few megabytes per worker.
+
+    Args:
+        filename: str -- the bzip2 compressed file to read
+        jobs: int -- number of worker processes (None means one per CPU core)
+    """
+
+    def __init__(self, filename, jobs=None):
+        super().__init__()
+        self.name = filename
+        self._file = open(filename, "rb")
+        jobs = jobs or os.cpu_count() or 1
+        self._pool = ProcessPoolExecutor(max_workers=jobs)
+        self._max_pending = 2 * jobs
+        self._blocks = iter_blocks(self._file)
+        self._pending = deque()
+        self._data = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def _fill_pending(self):
+        """Submit blocks to the pool until enough of them are in flight."""
+        while self._blocks is not None and len(self._pending) < self._max_pending:
+            try:
+                (_, _, stream) = next(self._blocks)
+            except StopIteration:
+                self._blocks = None
+                break
+            self._pending.append(self._pool.submit(decompress_block, stream))
+
+    def readinto(self, buf):
+        while not self._data:
+            self._fill_pending()
+            if not self._pending:
+                return 0
+            self._data = memoryview(self._pending.popleft().result())
+
+        size = min(len(buf), len(self._data))
+        buf[:size] = self._data[:size]
+        self._data = self._data[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            for future in self._pending:
+                future.cancel()
+            self._pool.shutdown(wait=True)
+            self._file.close()
+        super().close()
+
+
+def open_parallel(filename, jobs=None):
+    """Open a bzip2 file for buffered reading with parallel decompression.
+
+    Args:
+        filename: str -- the bzip2 compressed file to read
+        jobs: int -- number of worker processes (None means one per CPU core)
+
+    Returns:
+        a buffered binary fileobject yielding the decompressed data
+    """
+    return io.BufferedReader(ParallelBZ2Reader(filename, jobs),
+                             buffer_size=1024 * 1024)
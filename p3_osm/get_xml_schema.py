@@ -27,21 +27,40 @@ Example for Attribute mode:
       'osm.node.tag': {'v', 'k'},
       'osm.way.tag': {'v', 'k'}
     }
+
+In addition the number of occurrences of each attribute of each fully
+specified tag can be counted (Attribute count mode):
+    { 'osm.relation.member': Counter({'ref': 65783, 'role': 65783, ...}),
+      ...
+    }
+
+Two parsing engines are available: a fast one driving the expat parser
+directly (the default), and one based on iterparse, with the XML parser
+backend chosen with "--parser" (see xml_parsers.py).
 """
 
 from collections import Counter
-import xml.etree.cElementTree as ET
+from xml.parsers import expat
+import functools
 import pprint
 import open_file
+import osm_chunks
+import xml_parsers
+import zindex
+
+# Size of the chunks fed to the expat parser
+EXPAT_CHUNK_SIZE = 1024 * 1024
 
 
-def parse_tree(xmlf):
+def parse_tree(xmlf, attr_counters=None):
     """Find all tags and their attributes in the input XML file and count them.
 
     Tag hierarchy is represented in a "dot" way, e.g. "osm.role.member".
 
     Args:
         xmlf: FileObject input XML file, already open for reading
+        attr_counters: dict -- if given, it is filled with a collections.Counter
+                       {<attribute>: <int number of occurrences>} per tag path
 
     Returns:
         (tag_tree, tag_tree_counters, tag_counters) where
@@ -59,7 +78,7 @@ def parse_tree(xmlf):
     tag_counters = Counter()  # Will count separate tags
 
     with xmlf as inf:
-        parser = ET.iterparse(inf, events=('start', 'end'))
+        parser = open_file.iterparse(inf, events=('start', 'end'))
         tag = []  # Will contain all the parent tags of the current tag
         cur_level = -1  # The level of descent in the XML tree
         for event, elem in parser:
@@ -80,9 +99,11 @@ def parse_tree(xmlf):
                 # by the tag path
                 attrs = list(elem.attrib.keys())
                 if tag_path in tag_tree.keys():
-                    tag_tree[tag_path].union(attrs)
+                    tag_tree[tag_path].update(attrs)
                 else:
                     tag_tree[tag_path] = set(attrs)
+                if attr_counters is not None:
+                    attr_counters.setdefault(tag_path, Counter()).update(attrs)
             else:
                 # At the end of each tag climb one level up the tree
                 cur_level -= 1
@@ -97,6 +118,210 @@ def parse_tree(xmlf):
     return (tag_tree, tag_tree_counters, tag_counters)
 
 
+def parse_tree_fast(xmlf, attr_counters=None):
+    """A faster version of parse_tree(), driving the expat parser directly.
+
+    No element objects are built. Each distinct tag path gets an integer id
+    when first seen, and the ids of the currently open tags are kept in a
+    stack indexed by the tree depth, so a tag path is never rebuilt as a
+    string. The attribute names of each tag path are kept as a bitset of
+    interned attribute ids, updated once per distinct set of attribute names.
+
+    The input must be a binary XML fileobject (not a PBF file).
+
+    Args and Returns: see parse_tree()
+    """
+    path_ids = {}  # {(<parent path id>, <tag>): <path id>}
+    paths = []  # [(<tag path>, <tag>)], indexed by path id
+    path_counts = []  # [<int number of occurrences>], indexed by path id
+    path_bits = []  # [<bitset of attribute ids>], indexed by path id
+    signatures = []  # [Counter {<tuple of attribute names>: count}] by path id
+    attr_bits = {}  # {<tuple of attribute names>: <bitset of attribute ids>}
+    attr_ids = {}  # {<attribute name>: <attribute id>}
+    stack = [-1]  # Path ids of the open tags, indexed by depth + 1
+    depth = [0]
+
+    def start(tag, attrs):
+        level = depth[0] = depth[0] + 1
+        key = (stack[level - 1], tag)
+        path_id = path_ids.get(key)
+        if path_id is None:
+            path_id = path_ids[key] = len(paths)
+            parent = paths[key[0]][0] + '.' if key[0] >= 0 else ''
+            paths.append((parent + tag, tag))
+            path_counts.append(0)
+            path_bits.append(0)
+            signatures.append(Counter())
+        if level < len(stack):
+            stack[level] = path_id
+        else:
+            stack.append(path_id)
+        path_counts[path_id] += 1
+
+        # With ordered_attributes, attrs is [name1, value1, name2, ...]
+        names = tuple(attrs[::2])
+        bits = attr_bits.get(names)
+        if bits is None:
+            bits = 0
+            for name in names:
+                bits |= 1 << attr_ids.setdefault(name, len(attr_ids))
+            attr_bits[names] = bits
+        path_bits[path_id] |= bits
+        signatures[path_id][names] += 1
+
+    def end(_):
+        depth[0] -= 1
+
+    parser = expat.ParserCreate()
+    parser.ordered_attributes = True
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+
+    with xmlf as inf:
+        while True:
+            data = inf.read(EXPAT_CHUNK_SIZE)
+            if not data:
+                break
+            parser.Parse(data, False)
+        parser.Parse(b"", True)
+
+    attr_names = sorted(attr_ids, key=attr_ids.get)
+    tag_tree = {}
+    tag_tree_counters = Counter()
+    tag_counters = Counter()
+    for (path_id, (tag_path, tag)) in enumerate(paths):
+        bits = path_bits[path_id]
+        tag_tree[tag_path] = {name for (i, name) in enumerate(attr_names)
+                              if bits >> i & 1}
+        tag_tree_counters[tag_path] += path_counts[path_id]
+        tag_counters[tag] += path_counts[path_id]
+        if attr_counters is not None:
+            counter = attr_counters.setdefault(tag_path, Counter())
+            for (names, count) in signatures[path_id].items():
+                for name in names:
+                    counter[name] += count
+
+    return (tag_tree, tag_tree_counters, tag_counters)
+
+
+def merge_results(results):
+    """Merge the results of several parse_tree() calls into one.
+
+    Args:
+        results: iterable of (tag_tree, tag_tree_counters, tag_counters)
+                 tuples, as returned by parse_tree()
+
+    Returns:
+        (tag_tree, tag_tree_counters, tag_counters) -- the merged result
+    """
+    tag_tree = {}
+    tag_tree_counters = Counter()
+    tag_counters = Counter()
+
+    for (tree, tree_counters, counters) in results:
+        for (tag_path, attrs) in tree.items():
+            tag_tree.setdefault(tag_path, set()).update(attrs)
+        tag_tree_counters.update(tree_counters)
+        tag_counters.update(counters)
+
+    return (tag_tree, tag_tree_counters, tag_counters)
+
+
+def merge_attr_counters(attr_counters, other):
+    """Add the attribute counters "other" to "attr_counters" (in place)."""
+    for (tag_path, counter) in other.items():
+        attr_counters.setdefault(tag_path, Counter()).update(counter)
+    return attr_counters
+
+
+def _parse(xmlf, engine, attr_counters=None):
+    """Parse a file with the given engine ("expat" or "iterparse").
+
+    PBF files are always parsed with the iterparse engine.
+    """
+    if engine == 'expat' and not hasattr(xmlf, 'iterparse'):
+        return parse_tree_fast(xmlf, attr_counters)
+    return parse_tree(xmlf, attr_counters)
+
+
+def _parse_member(engine, _, xmlf):
+    """Parse an archive member (used with open_file.map_members()).
+
+    Returns:
+        (parse_tree() result, attribute counters)
+    """
+    attr_counters = {}
+    return (_parse(xmlf, engine, attr_counters), attr_counters)
+
+
+class SortedPrettyPrinter(pprint.PrettyPrinter):
+    """A PrettyPrinter printing the elements of sets sorted, also when they
+    fit on one line (where pprint keeps their hash order)."""
+
+    def format(self, obj, context, maxlevels, level):
+        if isinstance(obj, set) and obj:
+            reprs = [self.format(elem, context, maxlevels, level)
+                     for elem in sorted(obj)]
+            return ("{" + ", ".join(rep for (rep, _, _) in reprs) + "}",
+                    all(readable for (_, readable, _) in reprs), False)
+        return super().format(obj, context, maxlevels, level)
+
+
+def _key_order(obj):
+    """Return a copy of a result with the entries of its Counters in key
+    order, so that the entries with equal counts are printed in key order
+    (instead of the order in which they were found)."""
+    if isinstance(obj, Counter):
+        return Counter(dict(sorted(obj.items())))
+    if isinstance(obj, dict):
+        return {key: _key_order(value) for (key, value) in obj.items()}
+    return obj
+
+
+def print_result(obj, stream):
+    """Pretty-print a part of a parse_tree() result, or attribute counters.
+
+    The output only depends on the content of obj: the same statistics are
+    printed the same way whether they were found serially or merged from
+    chunks or archive members.
+    """
+    SortedPrettyPrinter(stream=stream).pprint(_key_order(obj))
+
+
+def parse_chunked(filename, jobs=None, engine='expat', attr_counters=None):
+    """Parse an OSM XML file split in chunks by a pool of worker processes.
+
+    The file has to be uncompressed, or bzip2/gzip compressed (see
+    osm_chunks.py; a single-member gzip file makes one chunk, so it is parsed
+    serially, see zindex.has_random_access()). The result is equal to the one of a serial parse (and so is
+    its output with print_result()).
+
+    Args:
+        filename: str -- the OSM XML file
+        jobs: int -- number of worker processes (None means one per CPU core)
+        engine: str -- the parsing engine ("expat" or "iterparse")
+        attr_counters: dict -- see parse_tree()
+
+    Returns: see parse_tree()
+    """
+    chunks = osm_chunks.map_chunks(
+        filename, functools.partial(_parse_member, engine, None), jobs)
+
+    root = osm_chunks.get_root_tag(filename, None).decode()
+
+    results = []
+    for (start, (result, chunk_attr_counters)) in chunks:
+        if start > 0:
+            # Do not count the synthetic root element of the chunk
+            result[1][root] -= 1
+            result[2][root] -= 1
+        if attr_counters is not None:
+            merge_attr_counters(attr_counters, chunk_attr_counters)
+        results.append(result)
+
+    return merge_results(results)
+
+
 def main():
     """The main function.
     """
@@ -105,38 +330,123 @@ def main():
     parser = ArgumentParser(description=__doc__)
     parser.add_argument("-a", "--attr", action="store_true",
                         help="print the tree of the found tags and their attributes")
+    parser.add_argument("-c", "--attr-count", action="store_true",
+                        help="print the number of occurrences of each attribute "
+                             "of the found tags")
     parser.add_argument("-f", "--flat", action="store_true",
                         help="print flat statistics of the found tags")
     parser.add_argument("-t", "--tree", action="store_true",
                         help="print the tree of the found tags and their statistics")
+    parser.add_argument("-e", "--engine", choices=("expat", "iterparse"),
+                        help="the XML parsing engine (default: expat, or "
+                             "iterparse with --parser)")
     parser.add_argument("-o", "--out", dest="outf", default="-",
                         type=FileType("w", encoding="UTF-8"),
                         help="output file (if not specified, then sys.stdout)")
+    parser.add_argument("-z", "--unzip-jobs", type=int, default=1, metavar="N",
+                        help="decompress bzip2 or PBF input with N processes in parallel "
+                             "(0 means one per CPU core)")
+    parser.add_argument("-p", "--prefetch", type=int, default=0, metavar="N",
+                        help="decompress the input ahead in a background thread, "
+                             "buffering up to N 1 MB chunks")
+    parser.add_argument("-m", "--members", action="store_true",
+                        help="parse all members of a zip/tar archive and merge "
+                             "their statistics")
+    parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+                        help="parse with N processes in parallel (0 means one per "
+                             "CPU core), each taking a chunk of the input file "
+                             "(or archive member with -m)")
+    parser.add_argument("--cache", action="store_true",
+                        help="read the statistics from the cache next to the input "
+                             "file, or store them there (see stats_cache.py)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="with --cache, keep what is needed to apply change files")
+    parser.add_argument("--apply-changes", action="append", default=[], metavar="OSC",
+                        help="apply an OSM change file to the cached statistics "
+                             "(implies --cache and --incremental); can be "
+                             "repeated, the files are applied in order")
+    parser.add_argument("--sample", type=float, metavar="FRACTION",
+                        help="estimate the statistics from random windows making up "
+                             "this fraction of the input (see osm_sample.py)")
+    parser.add_argument("--window-size", type=int, default=1024 * 1024, metavar="BYTES",
+                        help="with --sample, the size of a window (default: 1 MB)")
+    parser.add_argument("--seed", type=int,
+                        help="with --sample, the seed of the random generator")
     parser.add_argument("filename", metavar="FILE",
                         help="input OSM XML file (can be compressed or uncompressed)")
+    xml_parsers.add_parser_argument(parser)
     args = parser.parse_args()
+    if args.parser:
+        xml_parsers.set_default(args.parser)
+    if args.engine is None:
+        # The backend chosen with --parser is the one of the iterparse engine
+        args.engine = "iterparse" if args.parser else "expat"
 
-    if not (args.flat or args.attr or args.tree):
+    if not (args.flat or args.attr or args.tree or args.attr_count):
         args.flat = True
     if args.flat:
         print("> Flat mode enabled")
     if args.attr:
         print("> Attribute mode enabled")
+    if args.attr_count:
+        print("> Attribute count mode enabled")
     if args.tree:
         print("> Tree mode enabled")
     print("> Input file: " + args.filename)
     print("> Output will go to: " + args.outf.name)
     print()
 
-    inf = open_file.open_file(args.filename)
-    (tag_tree, tag_tree_counters, tag_counters) = parse_tree(inf)
+    attr_counters = {}
+    if args.sample:
+        import osm_sample
+        try:
+            (profiles, length, window) = osm_sample.sample_profiles(
+                args.filename, args.sample, window=args.window_size, seed=args.seed)
+        except ValueError as error:
+            parser.error(str(error))
+        print("> Sampled {} windows of {} bytes out of {} bytes".format(
+            len(profiles), window, length))
+        print("> Counts are (estimate, low, high) with a 95% confidence interval")
+        (tag_tree, tag_tree_counters, tag_counters, attr_counters) = \
+            osm_sample.estimate_schema(profiles, length, window)
+    elif args.cache or args.apply_changes:
+        import stats_cache
+        (profile, applied) = stats_cache.get_profile(
+            args.filename, incremental=args.incremental, changes=args.apply_changes)
+        for osc in applied:
+            print("> Applied change file: " + osc)
+        (tag_tree, tag_tree_counters, tag_counters, attr_counters) = profile.schema()
+    elif args.members:
+        results = open_file.map_members(args.filename,
+                                        functools.partial(_parse_member, args.engine),
+                                        args.jobs or None)
+        for (name, (_, member_attr_counters)) in results:
+            print("> Parsed archive member: " + name)
+            merge_attr_counters(attr_counters, member_attr_counters)
+        (tag_tree, tag_tree_counters, tag_counters) = merge_results(
+            result for (_, (result, _)) in results)
+    elif args.jobs != 1 and osm_chunks.can_split(args.filename):
+        if not zindex.has_random_access(zindex.get_index(args.filename)):
+            print("> Single gzip member: the file is parsed serially "
+                  "(recompress it with bgzip to parse it in parallel)")
+        (tag_tree, tag_tree_counters, tag_counters) = parse_chunked(
+            args.filename, args.jobs or None, args.engine, attr_counters)
+    else:
+        inf = open_file.open_file(args.filename, args.unzip_jobs or None,
+                                  args.prefetch)
+        (tag_tree, tag_tree_counters, tag_counters) = _parse(inf, args.engine,
+                                                             attr_counters)
+        if isinstance(inf, open_file.PrefetchReader):
+            print("> Read-ahead: " + inf.format_stats())
 
     if args.flat:
-        pprint.pprint(tag_counters, stream=args.outf)
+        print_result(tag_counters, args.outf)
     if args.attr:
-        pprint.pprint(tag_tree, stream=args.outf)
+        print_result(tag_tree, args.outf)
     if args.tree:
-        pprint.pprint(tag_tree_counters, stream=args.outf)
+        print_result(tag_tree_counters, args.outf)
+    if args.attr_count:
+        print_result(attr_counters, args.outf)
 
 
 if __name__ == '__main__':
@@ -11,18 +11,41 @@ The "tag" XML tags are specially treated since they contain matched pairs of
 pairs are harvested together, so that we can easily see for example all the
 values of the OSM "amenity" key.
 
+The values are dumped as pprint'ed Python dicts ("*.txt"), or with the
+"-f .vals" (or e.g. "-f .vals.gz") option in the compact, streamable format
+of value_dump.py.
+
 Attributes:
     ATTR_FILE_PREFIX: str -- the prefix for filenames containing attribute dump
     KV_FILE_PREFIX: str -- the prefix for filenames containing kv pairs dump
+    SKETCH_FILE_INFIX: str -- added to the prefixes in sketch mode
+    ATTR_XPATHS: list of str -- the xpaths of the harvested attributes
+    KV_XPATHS: list of str -- the xpaths of the tags with harvested k:v pairs
 """
 
-import xml.etree.cElementTree as ET
 import pprint
 import re
 import open_file
+import sketches
+import stats_cache
+import value_dump
+import xml_parsers
 
 ATTR_FILE_PREFIX = "attr"
 KV_FILE_PREFIX = "kv"
+SKETCH_FILE_INFIX = "-sketch"
+
+ATTR_XPATHS = [r".//node[@lat]",
+               r".//node[@lon]",
+               r".//node[@user]",
+               r".//relation[@user]",
+               r".//relation/member[@role]",
+               r".//relation/member[@type]",
+               r".//way[@user]"]
+
+KV_XPATHS = [r".//node/tag",
+             r".//way/tag",
+             r".//relation/tag"]
 
 
 def _xpath2filename(xpath):
@@ -33,6 +56,102 @@ def _xpath2filename(xpath):
     return re.sub(r"[^a-zA-Z]+", "-", xpath).strip("-")
 
 
+def _dump_values(prefix, vals, suffix=".txt"):
+    """Save to files the harvested values, one file per xpath.
+
+    The files are pprint'ed dicts if the suffix is ".txt", else value dumps
+    (see value_dump.py), e.g. with the suffix ".vals.gz".
+    """
+    for xpath in vals.keys():
+        filename = "{}-{}{}".format(prefix, _xpath2filename(xpath), suffix)
+        if value_dump.is_dump(filename):
+            value_dump.write_values(filename, xpath, vals[xpath])
+            continue
+        with open(filename, 'w') as outf:
+            pprint.pprint({xpath: vals[xpath]}, stream=outf)
+
+
+def _compile_xpaths(xpaths):
+    """Index the xpaths by their last tag name.
+
+    Returns:
+        dict {<tag>: [(<xpath>, <tuple of tags>, <attribute or None>), ...]}
+    """
+    by_tag = {}
+    for xpath in xpaths:
+        (tags, attr) = stats_cache.parse_xpath(xpath)
+        by_tag.setdefault(tags[-1], []).append((xpath, tags, attr))
+    return by_tag
+
+
+def iter_matches(xmlf, xpaths):
+    """Find the elements matching any of a list of xpaths in a single pass.
+
+    Only the xpath subset ".//a/b[@attr]" and ".//a/b" (with any number of
+    tags) is supported. The file is parsed incrementally and the elements are
+    cleared as soon as they are parsed, so the memory use does not depend on
+    the size of the file.
+
+    Args:
+       xmlf: fileobject -- the XML file open for reading
+       xpaths: list of str -- the xpaths, e.g. ".//relation/member[@role]"
+
+    Yields:
+       (xpath, element) tuples, in document order. The element is only valid
+       until the next tuple is requested, and its children are not parsed yet.
+    """
+    by_tag = _compile_xpaths(xpaths)
+    stack = []
+    root = None
+
+    for (event, elem) in open_file.iterparse(xmlf, events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem.tag)
+            if root is None:
+                root = elem
+            for (xpath, tags, attr) in by_tag.get(elem.tag, ()):
+                # Like findall(), ".//" matches below the root element only
+                if (len(stack) > len(tags) and
+                        tuple(stack[-len(tags):]) == tags and
+                        (attr is None or attr in elem.attrib)):
+                    yield (xpath, elem)
+        else:
+            stack.pop()
+            if len(stack) == 1:
+                elem.clear()
+                root.clear()
+
+
+def get_values(xmlf, attr_xpaths, kv_xpaths):
+    """Retrieve attribute values and k:v pairs in a single pass over the file.
+
+    Args:
+       xmlf: fileobject -- the XML file open for reading
+       attr_xpaths: list of str -- see get_attrib_values()
+       kv_xpaths: list of str -- see get_kv()
+
+    Returns:
+       (attr_values, kv_values) -- the values returned by get_attrib_values()
+                                   and get_kv()
+    """
+    attr_values = {path: set() for path in attr_xpaths}
+    kv_values = {path: {} for path in kv_xpaths}
+    attrs = {path: stats_cache.parse_xpath(path)[1] for path in attr_xpaths}
+
+    with xmlf as inf:
+        for (path, elem) in iter_matches(inf, list(attr_xpaths) + list(kv_xpaths)):
+            if path in attr_values:
+                attr_values[path].add(elem.attrib[attrs[path]])
+            else:
+                key = elem.attrib['k']
+                val = elem.attrib['v']
+                if key not in kv_values[path].keys():
+                    kv_values[path][key] = set()
+                kv_values[path][key].add(val)
+
+    return (attr_values, kv_values)
+
+
 def get_attrib_values(xmlf, xpaths):
     """Retrieve the values of a specified attributes of a specified tag.
 
@@ -46,43 +165,16 @@ def get_attrib_values(xmlf, xpaths):
                each set contains attribute value strings, e.g.
                {".//relation/member[@role]" : {"way", "node"}}
     """
-    values = {}
+    return get_values(xmlf, xpaths, [])[0]
 
-    with xmlf as inf:
-        # We're obliged to use one-time parse (and not iterparse)
-        # in order to be able to search via a xpath
-        parser = ET.parse(inf)
-        for path in xpaths:
-            # Get the name of the attribute to be harversted from the xpath
-            attr = re.search(r"\[@(.*)\]", path).group(1)
-            values[path] = set()
-            # Find all occurrences of the tag with the specified attribute
-            findings = parser.findall(path)
-            # Extract the value of the attribute we're interested in (if
-            # available) and add it to the set of values we will return
-            for fnd in findings:
-                if attr in fnd.attrib.keys():
-                    values[path].add(fnd.attrib[attr])
-
-    return values
-
-
-def harvest_attribs(filename):
+
+def harvest_attribs(filename, jobs=1, prefetch=0, suffix=".txt"):
     """Retrieve and save to files the values of certain tags' attribute.
     """
-    inf = open_file.open_file(filename)
-    vals = get_attrib_values(inf, [r".//node[@lat]",
-                                   r".//node[@lon]",
-                                   r".//node[@user]",
-                                   r".//relation[@user]",
-                                   r".//relation/member[@role]",
-                                   r".//relation/member[@type]",
-                                   r".//way[@user]"])
+    inf = open_file.open_file(filename, jobs, prefetch)
+    vals = get_attrib_values(inf, ATTR_XPATHS)
 
-    for xpath in vals.keys():
-        name = _xpath2filename(xpath)
-        with open("{}-{}.txt".format(ATTR_FILE_PREFIX, name), 'w') as outf:
-            pprint.pprint({xpath: vals[xpath]}, stream=outf)
+    _dump_values(ATTR_FILE_PREFIX, vals, suffix)
 
 
 def get_kv(xmlf, xpaths):
@@ -100,36 +192,72 @@ def get_kv(xmlf, xpaths):
                {".//node/tag" : {"addr:postal_code": {"1234", "2345"},
                                  "amenity": {"bar", "school"}}}
    """
-    values = {}
+    return get_values(xmlf, [], xpaths)[1]
 
-    with xmlf as inf:
-        parser = ET.parse(inf)
-        for path in xpaths:
-            values[path] = {}
-            findings = parser.findall(path)
 
-            for fnd in findings:
-                key = fnd.attrib['k']
-                val = fnd.attrib['v']
-                if key not in values[path].keys():
-                    values[path][key] = set()
-                values[path][key].add(val)
+def harvest_kv_pairs(filename, jobs=1, prefetch=0, suffix=".txt"):
+    """Retrieve and save to files the k:v values of a set of specified tags.
+    """
+    inf = open_file.open_file(filename, jobs, prefetch)
+    vals = get_kv(inf, KV_XPATHS)
 
-    return values
+    _dump_values(KV_FILE_PREFIX, vals, suffix)
 
 
-def harvest_kv_pairs(filename):
-    """Retrieve and save to files the k:v values of a set of specified tags.
+def harvest_values(filename, jobs=1, prefetch=0, suffix=".txt"):
+    """Retrieve and save to files both the attribute values and the k:v
+    values, reading the file only once.
     """
-    inf = open_file.open_file(filename)
-    vals = get_kv(inf, [r".//node/tag",
-                        r".//way/tag",
-                        r".//relation/tag"])
+    inf = open_file.open_file(filename, jobs, prefetch)
+    (attr_vals, kv_vals) = get_values(inf, ATTR_XPATHS, KV_XPATHS)
 
-    for xpath in vals.keys():
-        name = _xpath2filename(xpath)
-        with open("{}-{}.txt".format(KV_FILE_PREFIX, name), 'w') as outf:
-            pprint.pprint({xpath: vals[xpath]}, stream=outf)
+    _dump_values(ATTR_FILE_PREFIX, attr_vals, suffix)
+    _dump_values(KV_FILE_PREFIX, kv_vals, suffix)
+
+
+def get_sketches(xmlf, attr_xpaths, kv_xpaths, threshold=sketches.EXACT_THRESHOLD,
+                 top=sketches.TOP_K):
+    """Profile attribute values and k:v pairs with bounded memory.
+
+    Like get_values(), but the values of each attribute xpath and of each key
+    of each k:v xpath are profiled with a sketches.ValueSketch.
+
+    Returns:
+       (attr_sketches, kv_sketches) -- {<xpath>: <ValueSketch>} and
+                                       {<xpath>: {<key>: <ValueSketch>}}
+    """
+    attr_sketches = {path: sketches.ValueSketch(threshold, top)
+                     for path in attr_xpaths}
+    kv_sketches = {path: {} for path in kv_xpaths}
+    attrs = {path: stats_cache.parse_xpath(path)[1] for path in attr_xpaths}
+
+    with xmlf as inf:
+        for (path, elem) in iter_matches(inf, list(attr_xpaths) + list(kv_xpaths)):
+            if path in attr_sketches:
+                attr_sketches[path].add(elem.attrib[attrs[path]])
+            else:
+                key = elem.attrib['k']
+                if key not in kv_sketches[path]:
+                    kv_sketches[path][key] = sketches.ValueSketch(threshold, top)
+                kv_sketches[path][key].add(elem.attrib['v'])
+
+    return (attr_sketches, kv_sketches)
+
+
+def harvest_sketches(filename, jobs=1, prefetch=0,
+                     threshold=sketches.EXACT_THRESHOLD, top=sketches.TOP_K):
+    """Profile the attribute values and the k:v values with bounded memory,
+    and save the profiles to files.
+    """
+    inf = open_file.open_file(filename, jobs, prefetch)
+    (attr_sketches, kv_sketches) = get_sketches(inf, ATTR_XPATHS, KV_XPATHS,
+                                                threshold, top)
+
+    _dump_values(ATTR_FILE_PREFIX + SKETCH_FILE_INFIX,
+                 {path: sketch.summary() for (path, sketch) in attr_sketches.items()})
+    _dump_values(KV_FILE_PREFIX + SKETCH_FILE_INFIX,
+                 {path: {key: sketch.summary() for (key, sketch) in per_key.items()}
+                  for (path, per_key) in kv_sketches.items()})
 
 
 def main():
@@ -138,16 +266,91 @@ def main():
     from argparse import ArgumentParser
 
     parser = ArgumentParser(description=__doc__)
+    parser.add_argument("-z", "--unzip-jobs", type=int, default=1, metavar="N",
+                        help="decompress bzip2 or PBF input with N processes in parallel "
+                             "(0 means one per CPU core)")
+    parser.add_argument("-p", "--prefetch", type=int, default=0, metavar="N",
+                        help="decompress the input ahead in a background thread, "
+                             "buffering up to N 1 MB chunks")
+    parser.add_argument("-f", "--format", default=".txt",
+                        choices=[".txt", value_dump.DUMP_SUFFIX] +
+                        [value_dump.DUMP_SUFFIX + "." + ext for ext in value_dump.COMPRESSION],
+                        help="the suffix of the dump files: pprint'ed dicts "
+                             "(default: %(default)s), or (compressed) value dumps, "
+                             "see value_dump.py")
+    parser.add_argument("--cache", action="store_true",
+                        help="read the values from the cache next to the input "
+                             "file, or store them there (see stats_cache.py)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="with --cache, keep what is needed to apply change files")
+    parser.add_argument("--apply-changes", action="append", default=[], metavar="OSC",
+                        help="apply an OSM change file to the cached values "
+                             "(implies --cache and --incremental); can be "
+                             "repeated, the files are applied in order")
+    parser.add_argument("--sample", type=float, metavar="FRACTION",
+                        help="only print the estimated numbers of distinct values, "
+                             "from random windows making up this fraction of the "
+                             "input (see osm_sample.py)")
+    parser.add_argument("--window-size", type=int, default=1024 * 1024, metavar="BYTES",
+                        help="with --sample, the size of a window (default: 1 MB)")
+    parser.add_argument("--seed", type=int,
+                        help="with --sample, the seed of the random generator")
+    parser.add_argument("-s", "--sketch", action="store_true",
+                        help="profile the values with bounded memory: exact values "
+                             "only up to a threshold, else estimated number of "
+                             "distinct values and most frequent values (see "
+                             "sketches.py), dumped to attr-sketch-*.txt and "
+                             "kv-sketch-*.txt files")
+    parser.add_argument("--threshold", type=int, default=sketches.EXACT_THRESHOLD,
+                        metavar="N", help="with --sketch, keep the values exactly "
+                        "up to N distinct values (default: %(default)s)")
+    parser.add_argument("--top", type=int, default=sketches.TOP_K, metavar="K",
+                        help="with --sketch, report the K most frequent values "
+                             "(default: %(default)s)")
     parser.add_argument("filename", metavar="FILE",
                         help="input OSM XML file (can be compressed or uncompressed)")
+    xml_parsers.add_parser_argument(parser)
     args = parser.parse_args()
+    if args.parser:
+        xml_parsers.set_default(args.parser)
 
     print("> Input file: " + args.filename)
     print()
 
-    harvest_attribs(args.filename)
-
-    harvest_kv_pairs(args.filename)
+    if args.sample:
+        import osm_sample
+        try:
+            (profiles, length, window) = osm_sample.sample_profiles(
+                args.filename, args.sample, ATTR_XPATHS, KV_XPATHS, args.window_size,
+                args.seed)
+        except ValueError as error:
+            parser.error(str(error))
+        print("> Sampled {} windows of {} bytes out of {} bytes".format(
+            len(profiles), window, length))
+        print("> Estimated numbers of distinct values:")
+        (attr_distinct, kv_distinct) = osm_sample.estimate_values(
+            profiles, length, window)
+        pprint.pprint(attr_distinct)
+        pprint.pprint(kv_distinct)
+        return
+
+    if args.cache or args.apply_changes:
+        (profile, applied) = stats_cache.get_profile(
+            args.filename, ATTR_XPATHS, KV_XPATHS, args.incremental,
+            args.apply_changes)
+        for osc in applied:
+            print("> Applied change file: " + osc)
+        _dump_values(ATTR_FILE_PREFIX, profile.attr_value_sets(), args.format)
+        _dump_values(KV_FILE_PREFIX, profile.kv_value_sets(), args.format)
+        return
+
+    if args.sketch:
+        harvest_sketches(args.filename, args.unzip_jobs or None, args.prefetch,
+                         args.threshold, args.top)
+        return
+
+    harvest_values(args.filename, args.unzip_jobs or None, args.prefetch,
+                   args.format)
 
 
 if __name__ == '__main__':
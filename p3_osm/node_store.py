@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+
+"""Compact store of the node locations of an OSM file (requires numpy).
+
+The ways of an OSM file only reference their nodes by id. To resolve these
+references to coordinates without a dict of Python objects (hundreds of bytes
+per node), the store keeps two numpy arrays:
+- the node ids, sorted, as int64;
+- the node coordinates (lat, lon), as int32 fixed-point numbers with 7
+  decimals (the precision of OSM coordinates).
+That is 16 bytes per node. Lookups are vectorised binary searches.
+
+The arrays are saved as "<prefix>-ids.npy" and "<prefix>-coords.npy" and can
+be memory-mapped, so a store bigger than the RAM can be used too.
+
+Example run (build the store "zurich-area-nodes-*.npy"):
+    > ./node_store.py zurich-area.osm.bz2
+
+Attributes:
+    SCALE: int -- the factor of the fixed-point coordinates
+    STORE_SUFFIX: str -- the suffix of the default store prefix
+"""
+
+from array import array
+import numpy as np
+import open_file
+import xml_parsers
+
+SCALE = 10 ** 7
+STORE_SUFFIX = "-nodes"
+
+
+class NodeStore:
+    """Node id to (lat, lon) lookup table.
+
+    Args:
+        ids: numpy int64 array -- the sorted node ids
+        coords: numpy int32 array of shape (n, 2) -- the fixed-point
+                coordinates of the nodes
+    """
+
+    def __init__(self, ids, coords):
+        self.ids = ids
+        self.coords = coords
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def load(cls, prefix, mmap=True):
+        """Load a store saved with save(), memory-mapped by default."""
+        mode = 'r' if mmap else None
+        return cls(np.load(prefix + "-ids.npy", mmap_mode=mode),
+                   np.load(prefix + "-coords.npy", mmap_mode=mode))
+
+    def save(self, prefix):
+        """Save the store to "<prefix>-ids.npy" and "<prefix>-coords.npy"."""
+        np.save(prefix + "-ids.npy", self.ids)
+        np.save(prefix + "-coords.npy", self.coords)
+
+    def lookup(self, node_ids):
+        """Find the coordinates of nodes.
+
+        Args:
+            node_ids: sequence of int (or of str) -- the node ids
+
+        Returns:
+            (coords, found) -- a float64 array of shape (n, 2) with the
+            (lat, lon) of each node (NaN if not found), and a boolean array
+            telling which nodes were found
+        """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        index = np.searchsorted(self.ids, node_ids)
+        index[index == len(self.ids)] = 0
+        found = self.ids[index] == node_ids if len(self.ids) else \
+            np.zeros(len(node_ids), dtype=bool)
+        coords = np.full((len(node_ids), 2), np.nan)
+        coords[found] = self.coords[index[found]] / SCALE
+        return (coords, found)
+
+    def lookup_list(self, node_ids):
+        """Like lookup(), but return a list of [lat, lon] lists, with None for
+        the nodes not found (e.g. for JSON documents)."""
+        (coords, found) = self.lookup(node_ids)
+        return [pos if ok else None for (pos, ok) in zip(coords.tolist(), found)]
+
+    def updated(self, positions):
+        """Return a new store with updated node locations.
+
+        Args:
+            positions: dict {<node id>: (lat, lon), or None for a deleted
+                       node} -- e.g. the nodes of an OSM change file
+        """
+        changed = np.array(sorted(int(node_id) for node_id in positions),
+                           dtype=np.int64)
+        keep = ~np.isin(self.ids, changed, assume_unique=True)
+        builder = NodeStoreBuilder()
+        for node_id in changed.tolist():
+            pos = positions.get(node_id, positions.get(str(node_id)))
+            if pos is not None:
+                builder.add(node_id, *pos)
+        new = builder.build()
+        ids = np.concatenate([self.ids[keep], new.ids])
+        coords = np.concatenate([self.coords[keep], new.coords])
+        order = np.argsort(ids, kind='stable')
+        return NodeStore(ids[order], coords[order])
+
+
+class NodeStoreBuilder:
+    """Collect node locations (in compact arrays) and build a NodeStore."""
+
+    def __init__(self):
+        self._ids = array('q')
+        self._coords = array('i')
+        self._store = None
+
+    def add(self, node_id, lat, lon):
+        """Add the location of a node."""
+        self._ids.append(int(node_id))
+        self._coords.append(round(float(lat) * SCALE))
+        self._coords.append(round(float(lon) * SCALE))
+        self._store = None
+
+    def build(self):
+        """Return the NodeStore of the nodes added so far."""
+        if self._store is None:
+            ids = np.frombuffer(self._ids, dtype=np.int64).copy()
+            coords = np.frombuffer(self._coords, dtype=np.int32).reshape(-1, 2).copy()
+            if len(ids) > 1 and not np.all(ids[1:] >= ids[:-1]):
+                order = np.argsort(ids, kind='stable')
+                (ids, coords) = (ids[order], coords[order])
+            self._store = NodeStore(ids, coords)
+        return self._store
+
+
+def build_store(file_in):
+    """Build the NodeStore of the <node> elements of an open OSM file."""
+    builder = NodeStoreBuilder()
+    for element in open_file.iter_elements(file_in, 'node'):
+        if 'lat' in element.attrib and 'lon' in element.attrib:
+            builder.add(element.attrib['id'], element.attrib['lat'],
+                        element.attrib['lon'])
+    return builder.build()
+
+
+def main():
+    """The main function.
+    """
+    from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+    parser = ArgumentParser(description=__doc__,
+                            formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("-o", "--prefix",
+                        help="prefix of the store files (default: the input file "
+                             "name without extension, followed by \"{}\")".format(
+                                 STORE_SUFFIX))
+    parser.add_argument("filename", metavar="FILE",
+                        help="input OSM XML file (can be compressed or uncompressed)")
+    xml_parsers.add_parser_argument(parser)
+    args = parser.parse_args()
+    if args.parser:
+        xml_parsers.set_default(args.parser)
+
+    prefix = args.prefix or args.filename.split('.')[0] + STORE_SUFFIX
+    store = build_store(open_file.open_file(args.filename))
+    store.save(prefix)
+    print("> Stored the locations of {} nodes in {}-*.npy ({:.1f} MB)".format(
+        len(store), prefix, (store.ids.nbytes + store.coords.nbytes) / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
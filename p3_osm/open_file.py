@@ -1,21 +1,44 @@
 """
 Library for opening OSM XML files that can be optionally compressed.
+
+OSM PBF files (".osm.pbf") can be opened too. In order to consume them like
+XML files, the opened files should be parsed via the iterparse(),
+iter_elements() and parse() functions of this module, instead of the ones of
+xml.etree.ElementTree.
 """
 
+import io
+import mmap
 import sys
 import os.path
+import queue
+import threading
+import time
+import xml_parsers
 
-ZIP = {'gz': 'gzip', 'bz2': 'bzip2', 'zip': 'zip',
+ZIP = {'gz': 'gzip', 'bz2': 'bzip2', 'zip': 'zip', 'tar': 'tar',
        'tbz': 'tar:bz2', 'tar.bz2': 'tar:bz2', 'tb2': 'tar:bz2',
        'tgz': 'tar:gz', 'tar.gz': 'tar:gz'}
 
 ERR_UNSUPPORTED_COMPRESSION = 1
 ERR_BAD_EXTENSION = 2
 
+# Size of the decompressed chunks passed from the read-ahead thread
+PREFETCH_CHUNK_SIZE = 1024 * 1024
+
+# Default madvise() hint for memory-mapped files: a single linear pass
+MMAP_ADVICE = getattr(mmap, 'MADV_SEQUENTIAL', None)
+
 
 def _get_ext(filename):
-    """Return the lowercased extension of the given filename, without a dot."""
-    return os.path.splitext(filename)[1].lower()[1:]
+    """Return the lowercased extension of the given filename, without a dot.
+
+    Compressed tar archives keep their double extension, e.g. "tar.gz".
+    """
+    (root, ext) = os.path.splitext(filename.lower())
+    if ext in ('.gz', '.bz2') and root.endswith('.tar'):
+        return 'tar' + ext
+    return ext[1:]
 
 
 def _get_zip_ext():
@@ -23,10 +46,16 @@ def _get_zip_ext():
     return ", ".join(list(ZIP.keys()))
 
 
-def unzip_file(filename):
+def unzip_file(filename, jobs=1, member=None):
     """Open the specified compressed file and return a reader fileobject of it.
     Args:
         filename: str -- filename of the compressed file to be opened
+        jobs: int -- number of processes decompressing bzip2 blocks in
+                     parallel (None means one per CPU core). Ignored for
+                     the other formats.
+        member: str -- the name of the zip/tar archive member to open. If
+                       None, the first member is opened. Use iter_members()
+                       or map_members() to process all members.
     """
     ext = _get_ext(filename)
 
@@ -36,6 +65,9 @@ def unzip_file(filename):
         sys.exit(ERR_BAD_EXTENSION)
 
     if ZIP[ext] == 'bzip2':
+        if jobs != 1:
+            import bz2_parallel
+            return bz2_parallel.open_parallel(filename, jobs)
         import bz2
         return bz2.BZ2File(filename)
     elif ZIP[ext] == 'gzip':
@@ -44,38 +76,394 @@ def unzip_file(filename):
     elif ZIP[ext] == 'zip':
         import zipfile
         zipf = zipfile.ZipFile(filename)
-        # We support only the first archive member of the zip file
-        return zipf.open(zipf.namelist()[0])
+        return zipf.open(member or get_members(filename)[0])
     elif ZIP[ext].startswith('tar'):
         import tarfile
         tar = tarfile.open(filename, encoding="UTF-8")
-        # We support only the first archive member in the tar file
-        return tar.extractfile(tar.getnames()[0])
+        return tar.extractfile(member or get_members(filename)[0])
     else:
         print("ERROR: Currently this format is not supported", file=sys.stderr)
         sys.exit(ERR_UNSUPPORTED_COMPRESSION)
 
 
-def open_file(filename):
+def get_members(filename):
+    """Return the names of the regular file members of a zip/tar archive."""
+    ext = _get_ext(filename)
+    if ZIP.get(ext) == 'zip':
+        import zipfile
+        with zipfile.ZipFile(filename) as zipf:
+            return [info.filename for info in zipf.infolist()
+                    if not info.is_dir()]
+    elif ZIP.get(ext, '').startswith('tar'):
+        import tarfile
+        with tarfile.open(filename, encoding="UTF-8") as tar:
+            return [info.name for info in tar.getmembers() if info.isfile()]
+    return [filename]
+
+
+def iter_members(filename):
+    """Iterate over the members of a zip/tar archive, opened for reading.
+
+    The archive is read sequentially, so also compressed tar archives are
+    decompressed only once. Each member has to be read before the next one.
+    Any other file is treated as an archive with a single member.
+
+    Yields:
+        (name, fileobj) tuples
+    """
+    ext = _get_ext(filename)
+    if ZIP.get(ext) == 'zip':
+        import zipfile
+        with zipfile.ZipFile(filename) as zipf:
+            for info in zipf.infolist():
+                if not info.is_dir():
+                    yield (info.filename, zipf.open(info))
+    elif ZIP.get(ext, '').startswith('tar'):
+        import tarfile
+        with tarfile.open(filename, mode='r|*', encoding="UTF-8") as tar:
+            for info in tar:
+                if info.isfile():
+                    yield (info.name, tar.extractfile(info))
+    else:
+        yield (filename, open_file(filename))
+
+
+def _apply_to_member(func, filename, name):
+    """Open an archive member and apply a function to it (in a worker)."""
+    return func(name, unzip_file(filename, member=name))
+
+
+def _apply_to_data(func, name, data):
+    """Apply a function to the data of an archive member (in a worker)."""
+    return func(name, io.BytesIO(data))
+
+
+def map_members(filename, func, jobs=1):
+    """Apply a function to each member of a zip/tar archive in a process pool.
+
+    The members of zip and uncompressed tar archives are opened directly by
+    the worker processes. The members of compressed tar archives (which can
+    only be read sequentially) are decompressed by the calling process and
+    their data is passed to the workers, at most "jobs" members at a time.
+
+    Args:
+        filename: str -- the archive to process
+        func: callable -- a picklable function func(name, fileobj) returning
+                          a picklable result, e.g. a Counter
+        jobs: int -- number of worker processes (None means one per CPU core,
+                     1 means to process the members in the calling process)
+
+    Returns:
+        list of (member name, result) tuples, in archive order
+    """
+    if jobs == 1:
+        return [(name, func(name, inf)) for (name, inf) in iter_members(filename)]
+
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+    jobs = jobs or os.cpu_count() or 1
+    results = []
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        if ZIP.get(_get_ext(filename)) in ('zip', 'tar'):
+            names = get_members(filename)
+            futures = [pool.submit(_apply_to_member, func, filename, name)
+                       for name in names]
+            return list(zip(names, [future.result() for future in futures]))
+
+        pending = deque()
+        for (name, inf) in iter_members(filename):
+            pending.append((name, pool.submit(_apply_to_data, func, name, inf.read())))
+            if len(pending) >= jobs:
+                (done, future) = pending.popleft()
+                results.append((done, future.result()))
+        results.extend((name, future.result()) for (name, future) in pending)
+    return results
+
+
+class MmapReader(io.RawIOBase):
+    """A binary, seekable fileobject reading an uncompressed file via mmap.
+
+    The parser gets the raw bytes straight from the page cache, with no
+    text decoding and no intermediate read buffers. Byte ranges of the file
+    can be accessed without copying via view().
+
+    Args:
+        filename: str -- the file to map
+        advice: int -- an mmap.MADV_* constant passed to madvise(), e.g.
+                       mmap.MADV_SEQUENTIAL (the default) for a single linear
+                       pass, or None to give no hint. Ignored on platforms
+                       without madvise().
+    """
+
+    def __init__(self, filename, advice=MMAP_ADVICE):
+        super().__init__()
+        self.name = filename
+        with open(filename, 'rb') as inf:
+            self._map = mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+        if advice is not None and hasattr(self._map, 'madvise'):
+            self._map.madvise(advice)
+        self._pos = 0
+
+    def __len__(self):
+        return len(self._map)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._map)
+        if offset < 0:
+            raise ValueError("negative seek position {}".format(offset))
+        self._pos = offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def readinto(self, buf):
+        data = self.view(self._pos, self._pos + len(buf))
+        size = len(data)
+        buf[:size] = data
+        data.release()
+        self._pos += size
+        return size
+
+    def read(self, size=-1):
+        end = len(self._map) if size is None or size < 0 else self._pos + size
+        data = self._map[self._pos:end]
+        self._pos += len(data)
+        return data
+
+    def view(self, start=0, end=None):
+        """Return a zero-copy memoryview of the bytes [start, end) of the file.
+
+        Note that the view must be released before the reader is closed.
+        """
+        return memoryview(self._map)[start:end]
+
+    def close(self):
+        if not self.closed:
+            self._map.close()
+        super().close()
+
+
+class PrefetchReader(io.RawIOBase):
+    """A binary fileobject reading ahead another fileobject in a thread.
+
+    A background thread reads (and thereby decompresses) the wrapped
+    fileobject into a bounded queue of chunks, while the consumer (e.g. the
+    XML parser) takes the chunks out of the queue. Since the bz2, gzip and zlib
+    modules release the GIL while decompressing, decompression and parsing
+    overlap and the total run time approaches max(decompress, parse) instead
+    of their sum.
+
+    Args:
+        fileobj: the binary fileobject to read ahead
+        chunks: int -- the maximal number of chunks kept in the queue
+        chunk_size: int -- the size of a chunk in bytes
+
+    Attributes:
+        stall_time: float -- seconds the consumer waited for data
+        producer_stall_time: float -- seconds the thread waited for free space
+        bytes_read: int -- number of bytes returned to the consumer
+    """
+
+    def __init__(self, fileobj, chunks=8, chunk_size=PREFETCH_CHUNK_SIZE):
+        super().__init__()
+        self.name = getattr(fileobj, 'name', None)
+        self.stall_time = 0.0
+        self.producer_stall_time = 0.0
+        self.bytes_read = 0
+        self._fileobj = fileobj
+        self._chunk_size = chunk_size
+        self._queue = queue.Queue(maxsize=max(chunks, 1))
+        self._stop = threading.Event()
+        self._data = memoryview(b"")
+        self._eof = False
+        self._start_time = time.perf_counter()
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        """Put an item in the queue, giving up if the reader gets closed."""
+        start = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        self.producer_stall_time += time.perf_counter() - start
+
+    def _produce(self):
+        """Read the wrapped fileobject chunk by chunk (runs in the thread)."""
+        try:
+            while not self._stop.is_set():
+                data = self._fileobj.read(self._chunk_size)
+                if not data:
+                    break
+                self._put(data)
+            self._put(None)
+        except Exception as exc:  # Re-raised in the consumer
+            self._put(exc)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while not self._data:
+            if self._eof:
+                return 0
+            start = time.perf_counter()
+            item = self._queue.get()
+            self.stall_time += time.perf_counter() - start
+            if item is None:
+                self._eof = True
+                return 0
+            if isinstance(item, Exception):
+                self._eof = True
+                raise item
+            self._data = memoryview(item)
+
+        size = min(len(buf), len(self._data))
+        buf[:size] = self._data[:size]
+        self._data = self._data[size:]
+        self.bytes_read += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+            self._fileobj.close()
+            self._elapsed = time.perf_counter() - self._start_time
+        super().close()
+
+    def stats(self):
+        """Return a dictionary with the read-ahead statistics."""
+        if self.closed:
+            elapsed = self._elapsed
+        else:
+            elapsed = time.perf_counter() - self._start_time
+        return {'bytes': self.bytes_read,
+                'elapsed': elapsed,
+                'bytes_per_sec': self.bytes_read / elapsed if elapsed else 0.0,
+                'stall_time': self.stall_time,
+                'producer_stall_time': self.producer_stall_time}
+
+    def format_stats(self):
+        """Return the read-ahead statistics as a human-readable string."""
+        stats = self.stats()
+        return ("{:.1f} MB in {:.2f} s ({:.1f} MB/s), reader stalled {:.2f} s, "
+                "read-ahead thread stalled {:.2f} s".format(
+                    stats['bytes'] / 2**20, stats['elapsed'],
+                    stats['bytes_per_sec'] / 2**20, stats['stall_time'],
+                    stats['producer_stall_time']))
+
+
+def open_file(filename, jobs=1, prefetch=0, advice=MMAP_ADVICE, index=False):
     """Open a specified OSM XML file, which can be plain-text or compressed.
 
     The decision how to handle the file is taken based on its extension.
 
     Args:
        filename: str -- the name of the file to open
+       jobs: int -- number of decompression processes for bzip2 and PBF
+                    files (None means one per CPU core)
+       prefetch: int -- if not 0, read the file ahead in a background thread,
+                        keeping up to this many 1 MB chunks in memory
+       advice: int -- the madvise() hint for memory-mapping uncompressed files
+                      (see MmapReader)
+       index: bool -- build the random-access checkpoint index of a bzip2 or
+                      gzip file, unless it already exists (see zindex.py)
 
     Return:
        inf -- the open for reading fileobject
     """
     ext = _get_ext(filename)
 
+    if index and ZIP.get(ext) in ('bzip2', 'gzip'):
+        import zindex
+        zindex.get_index(filename)
+
     if ext in ZIP:
-        inf = unzip_file(filename)
-    elif ext == 'xml' or ext == 'osm':
-        inf = open(filename, 'r')
+        inf = unzip_file(filename, jobs)
+    elif ext == 'pbf':
+        import osm_pbf
+        return osm_pbf.PbfFile(filename, jobs, prefetch)
+    elif ext in ('xml', 'osm', 'osc'):
+        if os.path.getsize(filename) > 0:
+            inf = MmapReader(filename, advice)
+        else:
+            # Empty files cannot be memory-mapped
+            inf = open(filename, 'rb')
     else:
         print("ERROR: Unknown input file format. Supported extensions: " +
-              "osm, xml, osm.xml, " + _get_zip_ext(), file=sys.stderr)
+              "osm, xml, osm.xml, osc, osm.pbf, " + _get_zip_ext(), file=sys.stderr)
         sys.exit(ERR_BAD_EXTENSION)
 
+    if prefetch:
+        inf = PrefetchReader(inf, prefetch)
+
     return inf
+
+
+def iterparse(inf, events=('end',), parser=None, tag=None):
+    """Parse incrementally an open OSM file, like ElementTree.iterparse().
+
+    Args:
+       inf -- the fileobject returned by open_file()
+       events: tuple of str -- the events to report ("start" and/or "end")
+       parser: str -- the XML parser backend (see xml_parsers.py), the chosen
+               one if None. PBF files are decoded by osm_pbf.py instead.
+       tag: str or tuple of str -- see xml_parsers.iterparse()
+
+    Return:
+       an iterator of (event, element) tuples
+    """
+    if hasattr(inf, 'iterparse'):
+        if tag is None:
+            return inf.iterparse(events)
+        tag = (tag,) if isinstance(tag, str) else tuple(tag)
+        return ((event, elem) for (event, elem) in inf.iterparse(events)
+                if elem.tag in tag)
+    return xml_parsers.iterparse(inf, events, parser, tag)
+
+
+def iter_elements(inf, tag, parser=None):
+    """Yield the complete elements with the given tags directly below the
+    root element of an open OSM file, e.g. its <node> and <way> elements.
+
+    Args:
+       inf -- the fileobject returned by open_file()
+       tag: str or tuple of str -- the tags of the elements to yield
+       parser: str -- see iterparse()
+
+    Return:
+       an iterator of elements, see xml_parsers.iter_elements()
+    """
+    if hasattr(inf, 'iterparse'):
+        tag = (tag,) if isinstance(tag, str) else tuple(tag)
+        return xml_parsers.select_elements(inf.iterparse(('start', 'end')), tag)
+    return xml_parsers.iter_elements(inf, tag, parser)
+
+
+def parse(inf, parser=None):
+    """Parse an open OSM file into an ElementTree, like ElementTree.parse().
+
+    Args:
+       inf -- the fileobject returned by open_file()
+       parser: str -- see iterparse()
+
+    Return:
+       an ElementTree object
+    """
+    if hasattr(inf, 'parse'):
+        return inf.parse()
+    return xml_parsers.parse(inf, parser)
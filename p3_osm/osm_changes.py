@@ -0,0 +1,404 @@
+#!/usr/bin/python3
+
+"""Apply OSM change files (".osc") to the output of osm_to_json.py.
+
+Instead of converting and loading the whole updated extract again, the
+nodes and ways of the <create>, <modify> and <delete> blocks of a change
+file are converted with osm_to_json.shape_element() and applied to:
+- a SQLite database or MongoDB collection loaded by osm_to_json.py (see
+  osm_sinks.py): the documents are replaced or deleted by type and id;
+- a JSON file written by osm_to_json.py (with one document per line): the
+  offset index written along with it ("<file>.offsets.npz", see
+  "osm_to_json.py --offset-index") maps each element to the byte range of
+  its document, so the unchanged documents are copied as raw bytes, without
+  decoding or encoding them. Modified documents stay in place, created ones
+  are appended. The offsets of a spatial index of the file (see
+  spatial_index.py) are updated too. Note that the whole file is still
+  copied, so an update takes a sequential pass over the file; the database
+  sinks only touch the changed documents.
+
+With "--node-store PREFIX", the ways of the change files get the coordinates
+of their nodes ("node_pos", see osm_to_json.py --way-coords), and the node
+store is updated with the nodes of the change files. The ways which are not
+in the change files keep their node coordinates.
+
+Example runs:
+    > ./osm_changes.py --sqlite zurich-area.db 2015-11-01.osc.gz
+    > ./osm_to_json.py --offset-index zurich-area.osm.bz2
+    > ./osm_changes.py --json zurich-area.json 2015-11-01.osc.gz 2015-11-02.osc.gz
+
+Attributes:
+    OFFSETS_SUFFIX: str -- the suffix replacing ".json" in the offset index
+                    filename
+    TYPES: tuple of str -- the element types, whose position is encoded in
+           the keys of the offset index
+    COPY_BLOCK_SIZE: int -- the size of the blocks copied from the old JSON
+                     file
+"""
+
+import json
+import os
+from array import array
+import numpy as np
+import open_file
+import osm_sinks
+from osm_to_json import shape_element
+import xml_parsers
+
+OFFSETS_SUFFIX = ".offsets.npz"
+TYPES = ('node', 'way')
+COPY_BLOCK_SIZE = 1 << 20
+
+
+def iter_changes(file_in):
+    """Parse an open OSM change file.
+
+    Yields:
+        (action, element type, element id, elem_json) tuples for each node
+        and way, where action is "create", "modify" or "delete" and elem_json
+        is the JSON representation of the element (see
+        osm_to_json.shape_element(), whose "type" and "id" fields can be
+        replaced by tags)
+    """
+    depth = 0
+    block = None
+    action = None
+    for (event, element) in open_file.iterparse(file_in, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 2:
+                block = element
+                action = element.tag
+            continue
+
+        depth -= 1
+        if depth == 2:
+            elem_json = shape_element(element)
+            if elem_json:
+                yield (action, element.tag, element.attrib['id'], elem_json)
+            element.clear()
+            block.clear()
+
+
+def node_positions(changes):
+    """Return the locations of the nodes of a change list, as a dict
+    {<node id>: [lat, lon], or None for the deleted nodes}."""
+    return {elem_id: (None if action == 'delete' else doc['pos'])
+            for (action, elem_type, elem_id, doc) in changes if elem_type == 'node'}
+
+
+def load_changes(filename, nodes=None):
+    """Read the changes of an OSM change file.
+
+    Args:
+        filename: str -- the change file (can be compressed)
+        nodes: node_store.NodeStore -- if given, the ways get the coordinates
+               of their nodes ("node_pos"), from the nodes of the change file
+               or else from the store
+
+    Returns:
+        list of (action, element type, element id, elem_json) tuples, see
+        iter_changes()
+    """
+    inf = open_file.open_file(filename)
+    try:
+        changes = list(iter_changes(inf))
+    finally:
+        inf.close()
+
+    if nodes is not None:
+        changed = node_positions(changes)
+        for (action, elem_type, _, doc) in changes:
+            if action != 'delete' and elem_type == 'way' and 'node_refs' in doc:
+                doc['node_pos'] = [changed[ref] if ref in changed else pos
+                                   for (ref, pos) in zip(doc['node_refs'],
+                                                         nodes.lookup_list(doc['node_refs']))]
+    return changes
+
+
+def apply_to_sink(changes, sink):
+    """Apply changes to a sink of osm_sinks.py (which must replace the
+    existing documents, see osm_sinks.Sink)."""
+    for (action, elem_type, elem_id, doc) in changes:
+        if action == 'delete':
+            sink.delete(elem_type, elem_id)
+        else:
+            sink.add(elem_type, elem_id, doc)
+
+
+def _key(elem_type, elem_id):
+    """Return the key of an element in the offset index."""
+    return int(elem_id) * len(TYPES) + TYPES.index(elem_type)
+
+
+def offsets_filename(json_filename):
+    """Return the filename of the offset index of a JSON file."""
+    if json_filename.endswith(".json"):
+        json_filename = json_filename[:-len(".json")]
+    return json_filename + OFFSETS_SUFFIX
+
+
+class OffsetIndex:
+    """Map of the elements of a JSON file to the byte ranges of their
+    documents.
+
+    Args:
+        keys: numpy int64 array -- the sorted keys (element type and id) of
+              the documents
+        offsets: numpy int64 array -- the offset of each document
+        lengths: numpy int64 array -- the length of each document, including
+                 the newline
+    """
+
+    def __init__(self, keys, offsets, lengths):
+        self.keys = keys
+        self.offsets = offsets
+        self.lengths = lengths
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def load(cls, filename):
+        """Load an index saved with save()."""
+        with np.load(filename) as data:
+            return cls(data['keys'], data['offsets'], data['lengths'])
+
+    def save(self, filename):
+        """Save the index to a .npz file."""
+        np.savez(filename, keys=self.keys, offsets=self.offsets, lengths=self.lengths)
+
+    def end(self):
+        """Return the end offset of the last document."""
+        return int((self.offsets + self.lengths).max()) if len(self) else 0
+
+    def find(self, key):
+        """Return the position of a key in the index, or None."""
+        pos = int(np.searchsorted(self.keys, key))
+        if pos < len(self.keys) and self.keys[pos] == key:
+            return pos
+        return None
+
+
+class OffsetIndexBuilder:
+    """Collect the byte ranges of the documents of a JSON file while it is
+    written (see osm_to_json.process_map()) and build its OffsetIndex."""
+
+    def __init__(self):
+        self._keys = array('q')
+        self._offsets = array('q')
+        self._lengths = array('q')
+
+    def add(self, elem_type, elem_id, offset, length):
+        """Add the document of an element (its type is the tag of the XML
+        element, as the "type" field of a document can be replaced by a
+        "type" tag)."""
+        self._keys.append(_key(elem_type, elem_id))
+        self._offsets.append(offset)
+        self._lengths.append(length)
+
+    def build(self):
+        """Return the OffsetIndex of the documents added so far."""
+        keys = np.frombuffer(self._keys, dtype=np.int64)
+        order = np.argsort(keys, kind='stable')
+        return OffsetIndex(keys[order],
+                           np.frombuffer(self._offsets, dtype=np.int64)[order],
+                           np.frombuffer(self._lengths, dtype=np.int64)[order])
+
+
+def _copy_range(inf, outf, length):
+    """Copy length bytes from the current position of inf to outf."""
+    while length > 0:
+        block = inf.read(min(length, COPY_BLOCK_SIZE))
+        if not block:
+            raise ValueError("Truncated JSON file")
+        outf.write(block)
+        length -= len(block)
+
+
+def _update_spatial_index(filename, remap, dropped, added):
+    """Update a spatial index after a JSON file was rewritten.
+
+    Args:
+        filename: str -- the spatial index file
+        remap: function mapping old document offsets to new ones
+        dropped: numpy int64 array -- the old offsets of the replaced or
+                 deleted documents
+        added: list of (new offset, doc) tuples -- the new documents
+    """
+    import spatial_index
+
+    index = spatial_index.SpatialIndex.load(filename)
+    keep = ~np.isin(index.offsets, dropped)
+    builder = spatial_index.IndexBuilder()
+    for (offset, doc) in added:
+        builder.add(offset, doc)
+    new = builder.build()
+    bboxes = np.concatenate([index.levels[0][keep], new.levels[0]])
+    offsets = np.concatenate([remap(index.offsets[keep]), new.offsets])
+    spatial_index.SpatialIndex.build(bboxes, offsets, index.node_size).save(filename)
+
+
+def apply_to_json(changes, json_filename, index):
+    """Apply changes to a JSON file written by osm_to_json.py.
+
+    The file is rewritten into a temporary file, copying the unchanged byte
+    ranges, and then replaced. Its offset index (and its spatial index, if
+    any) are updated accordingly.
+
+    Args:
+        changes: list of (action, element type, element id, elem_json)
+                 tuples, see iter_changes()
+        json_filename: str -- the JSON file, with one document per line
+        index: OffsetIndex -- the offset index of the file
+
+    Returns:
+        the updated OffsetIndex
+    """
+    # The last change of each document wins
+    final = {}
+    for (action, elem_type, elem_id, doc) in changes:
+        final[_key(elem_type, elem_id)] = (action, doc)
+
+    edits = []      # (old offset, old length, position in the index, line, doc)
+    appended = []   # (key, line, doc)
+    for (key, (action, doc)) in final.items():
+        line = b'' if action == 'delete' else json.dumps(doc).encode('ascii') + b"\n"
+        pos = index.find(key)
+        if pos is not None:
+            edits.append((int(index.offsets[pos]), int(index.lengths[pos]), pos, line, doc))
+        elif line:
+            appended.append((key, line, doc))
+    edits.sort(key=lambda edit: edit[0])
+
+    tmp_filename = json_filename + ".tmp"
+    with open(json_filename, 'rb') as inf, open(tmp_filename, 'wb') as outf:
+        position = 0
+        for (offset, length, _, line, _) in edits:
+            _copy_range(inf, outf, offset - position)
+            inf.seek(length, os.SEEK_CUR)
+            outf.write(line)
+            position = offset + length
+        _copy_range(inf, outf, os.path.getsize(json_filename) - position)
+        end = outf.tell()
+        for (_, line, _) in appended:
+            outf.write(line)
+    os.replace(tmp_filename, json_filename)
+
+    # Shift the offsets by the length differences of the preceding edits
+    edit_offsets = np.array([edit[0] for edit in edits], dtype=np.int64)
+    shifts = np.concatenate([[0], np.cumsum([len(edit[3]) - edit[1] for edit in edits],
+                                            dtype=np.int64)])
+
+    def remap(offsets):
+        return offsets + shifts[np.searchsorted(edit_offsets, offsets)]
+
+    offsets = remap(index.offsets)
+    lengths = index.lengths.copy()
+    keep = np.ones(len(index), dtype=bool)
+    added = []
+    for (offset, _, pos, line, doc) in edits:
+        if line:
+            lengths[pos] = len(line)
+            added.append((int(offsets[pos]), doc))
+        else:
+            keep[pos] = False
+    new_keys = []
+    new_offsets = []
+    for (key, line, doc) in appended:
+        new_keys.append(key)
+        new_offsets.append(end)
+        added.append((end, doc))
+        end += len(line)
+
+    keys = np.concatenate([index.keys[keep], np.array(new_keys, dtype=np.int64)])
+    order = np.argsort(keys, kind='stable')
+    index = OffsetIndex(
+        keys[order],
+        np.concatenate([offsets[keep], np.array(new_offsets, dtype=np.int64)])[order],
+        np.concatenate([lengths[keep], np.array([len(item[1]) for item in appended],
+                                                dtype=np.int64)])[order])
+
+    import spatial_index
+    spatial_filename = spatial_index.index_filename(json_filename)
+    if os.path.exists(spatial_filename):
+        _update_spatial_index(spatial_filename, remap, edit_offsets, added)
+    return index
+
+
+def main():
+    """The main function.
+    """
+    import time
+    from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+    parser = ArgumentParser(description=__doc__,
+                            formatter_class=RawDescriptionHelpFormatter)
+    output = parser.add_mutually_exclusive_group(required=True)
+    output.add_argument("--json", metavar="FILE",
+                        help="update a JSON file written by osm_to_json.py")
+    output.add_argument("--sqlite", metavar="DB",
+                        help="update the \"map\" table of a SQLite database")
+    output.add_argument("--mongodb", metavar="[host:port/]DB/COLLECTION",
+                        help="update a MongoDB collection")
+    parser.add_argument("--node-store", metavar="PREFIX",
+                        help="add the coordinates of their nodes to the ways, "
+                             "and update the node store built by node_store.py")
+    parser.add_argument("--batch-size", type=int, default=osm_sinks.BATCH_SIZE,
+                        metavar="N", help="with --sqlite or --mongodb, the number "
+                        "of documents written at once (default: %(default)s)")
+    parser.add_argument("changes", metavar="OSC", nargs="+",
+                        help="OSM change files, applied in order (can be compressed)")
+    xml_parsers.add_parser_argument(parser)
+    args = parser.parse_args()
+    if args.parser:
+        xml_parsers.set_default(args.parser)
+
+    nodes = None
+    if args.node_store:
+        import node_store
+        nodes = node_store.NodeStore.load(args.node_store, mmap=False)
+
+    sink = None
+    index = None
+    if args.json:
+        if not os.path.exists(offsets_filename(args.json)):
+            parser.error("no offset index {}, convert the extract with "
+                         "\"osm_to_json.py --offset-index\"".format(
+                             offsets_filename(args.json)))
+        index = OffsetIndex.load(offsets_filename(args.json))
+        if index.end() != os.path.getsize(args.json):
+            parser.error("the offset index {} does not match {} (written "
+                         "again?)".format(offsets_filename(args.json), args.json))
+    elif args.sqlite:
+        sink = osm_sinks.SqliteSink(args.sqlite, batch_size=args.batch_size)
+    else:
+        (host, dbase, coll) = osm_sinks.parse_mongodb_spec(args.mongodb)
+        sink = osm_sinks.MongoSink(host, dbase, coll, args.batch_size, upsert=True)
+
+    try:
+        for osc in args.changes:
+            start = time.perf_counter()
+            changes = load_changes(osc, nodes)
+            if sink is not None:
+                apply_to_sink(changes, sink)
+            else:
+                index = apply_to_json(changes, args.json, index)
+            if nodes is not None:
+                nodes = nodes.updated(node_positions(changes))
+            counts = {action: sum(1 for change in changes if change[0] == action)
+                      for action in ('create', 'modify', 'delete')}
+            print("> Applied {}: {create} created, {modify} modified, {delete} "
+                  "deleted in {:.2f} s".format(osc, time.perf_counter() - start,
+                                               **counts))
+    finally:
+        if sink is not None:
+            sink.close()
+    if index is not None:
+        index.save(offsets_filename(args.json))
+    if nodes is not None:
+        nodes.save(args.node_store)
+
+
+if __name__ == '__main__':
+    main()
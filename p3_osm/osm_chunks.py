@@ -0,0 +1,250 @@
+"""
+Library for processing an OSM XML file in chunks, e.g. in parallel.
+
+The uncompressed OSM XML data is split into byte ranges, which are aligned to
+the starts of the top-level <node>, <way> and <relation> elements. Each chunk
+is turned into a well-formed XML document by wrapping it in a synthetic root
+element (named like the real one, e.g. <osm>), so it can be parsed by the
+usual parsers:
+- the first chunk starts with the real XML header and root element and gets
+  only a synthetic closing tag;
+- the last chunk ends with the real closing tag of the root element and gets
+  only a synthetic opening tag;
+- all other chunks get both.
+Note that the synthetic root element has no attributes, and that it is seen
+by the parsers of all but the first chunk.
+
+Uncompressed files are read directly. Compressed (bzip2 or gzip) files are
+read from the decompression checkpoints of their index (see zindex.py). A
+gzip file with a single member (e.g. compressed by plain "gzip") has only one
+checkpoint, so it yields a single chunk and is parsed serially.
+Alternatively, any OSM XML stream can be split on the fly into chunks of
+about a given size with iter_stream_chunks().
+
+Attributes:
+    READ_SIZE: int -- size in bytes of the data read at once
+    STREAM_CHUNK_SIZE: int -- default size in bytes of the stream chunks
+"""
+
+import io
+import itertools
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+import open_file
+import zindex
+
+READ_SIZE = 1024 * 1024
+STREAM_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Number of bytes kept between two reads, to find element starts cut in two
+_OVERLAP = 16
+
+_ROOT_RE = re.compile(rb"<([A-Za-z_][^\s/>]*)")
+
+
+class IterReader(io.RawIOBase):
+    """A binary fileobject reading the data from an iterable of bytes."""
+
+    def __init__(self, iterable):
+        super().__init__()
+        self._pieces = iter(iterable)
+        self._data = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while not self._data:
+            piece = next(self._pieces, None)
+            if piece is None:
+                return 0
+            self._data = memoryview(piece)
+
+        size = min(len(buf), len(self._data))
+        buf[:size] = self._data[:size]
+        self._data = self._data[size:]
+        return size
+
+
+def can_split(filename):
+    """Check whether a file can be split into chunks (i.e. can be indexed).
+
+    Archives (e.g. ".tar.bz2" or ".tgz") cannot, their members have to be
+    processed one by one instead (see open_file.map_members()).
+    """
+    return open_file._get_ext(filename) in zindex.FORMATS
+
+
+def get_root_tag(filename, index):
+    """Return the name of the root element of an XML file, as bytes."""
+    with zindex.open_range(filename, 0, READ_SIZE, index) as inf:
+        head = inf.read()
+    match = _ROOT_RE.search(head)
+    if match is None:
+        raise ValueError("No root element found in " + filename)
+    return match.group(1)
+
+
+def _iter_chunk(filename, start, end, index, root):
+    """Yield the pieces of the XML document made of the chunk [start, end).
+
+    The chunk actually starts at the first element start at or after "start"
+    (or at the file start if "start" is 0), and ends at the first element
+    start at or after "end" (or at the file end). Nothing is yielded if the
+    chunk contains no element start.
+    """
+    with zindex.open_range(filename, start, None, index) as inf:
+        pos = start  # Uncompressed offset of buf[0]
+        buf = b""
+
+        if start > 0:
+            # Skip to the first element start in the chunk
+            while True:
+                data = inf.read(READ_SIZE)
+                if not data:
+                    return
+                buf += data
+                match = zindex.SECTION_RE.search(buf)
+                if match:
+                    pos += match.start()
+                    buf = buf[match.start():]
+                    break
+                keep = min(len(buf), _OVERLAP)
+                pos += len(buf) - keep
+                buf = buf[len(buf) - keep:]
+            if pos >= end:
+                return
+            yield b"<" + root + b">"
+
+        while True:
+            # Cut the chunk at the first element start at or after "end"
+            cut_from = max(end - pos, 1)
+            if cut_from < len(buf):
+                match = zindex.SECTION_RE.search(buf, cut_from)
+                if match:
+                    yield buf[:match.start()]
+                    yield b"</" + root + b">"
+                    return
+            data = inf.read(READ_SIZE)
+            if not data:
+                # The real closing tag of the root element is in buf
+                yield buf
+                return
+            keep = min(len(buf), _OVERLAP)
+            if len(buf) > keep:
+                yield buf[:len(buf) - keep]
+            pos += len(buf) - keep
+            buf = buf[len(buf) - keep:] + data
+
+
+def open_chunk(filename, start, end, index=None, root=None):
+    """Open a chunk of an OSM XML file as a well-formed XML document.
+
+    Args:
+        filename: str -- the (compressed) OSM XML file
+        start: int -- the uncompressed offset from which to look for the first
+                      element of the chunk
+        end: int -- the uncompressed offset from which to look for the first
+                    element of the next chunk
+        index: dict -- the index of the file (see zindex.py)
+        root: bytes -- the name of the root element of the file
+
+    Returns:
+        a binary fileobject, or None if the chunk contains no element
+    """
+    index = index or zindex.get_index(filename)
+    root = root or get_root_tag(filename, index)
+    pieces = _iter_chunk(filename, start, end, index, root)
+    first = next(pieces, None)
+    if first is None:
+        return None
+    return io.BufferedReader(IterReader(itertools.chain([first], pieces)),
+                             buffer_size=READ_SIZE)
+
+
+def iter_stream_chunks(inf, size=STREAM_CHUNK_SIZE):
+    """Split an OSM XML stream into well-formed XML documents.
+
+    The documents are made of consecutive chunks of the stream, cut at the
+    first <node>, <way> or <relation> start after about "size" bytes, and
+    wrapped in a synthetic root element like the ones of open_chunk(). So
+    their top-level elements are, in order, the ones of the stream. Like
+    open_chunk(), this requires the <node>, <way> and <relation> elements to
+    be directly below the root element (i.e. not an OSM change file).
+
+    Args:
+        inf: binary fileobject -- the OSM XML stream
+        size: int -- the approximate size in bytes of the chunks
+
+    Yields:
+        bytes -- the documents
+    """
+    root = None
+    first = True
+    buf = b""
+    eof = False
+
+    while True:
+        # Cut at the first element start after "size" bytes
+        match = zindex.SECTION_RE.search(buf, size) if len(buf) > size else None
+        if match is None and not eof:
+            data = inf.read(max(READ_SIZE, size - len(buf) + 1))
+            eof = not data
+            buf += data
+            continue
+
+        if root is None:
+            match_root = _ROOT_RE.search(buf)
+            if match_root is None:
+                raise ValueError("No root element found")
+            root = match_root.group(1)
+
+        if match is None:
+            # The last chunk, with the real closing tag of the root element
+            yield buf if first else b"<" + root + b">" + buf
+            return
+        chunk = buf[:match.start()]
+        buf = buf[match.start():]
+        if first:
+            yield chunk + b"</" + root + b">"
+        else:
+            yield b"<" + root + b">" + chunk + b"</" + root + b">"
+        first = False
+
+
+def _apply_to_chunk(func, filename, start, end, index, root):
+    """Open a chunk and apply a function to it (in a worker process)."""
+    inf = open_chunk(filename, start, end, index, root)
+    if inf is None:
+        return None
+    return func(inf)
+
+
+def map_chunks(filename, func, jobs=None, parts=None):
+    """Apply a function to the chunks of an OSM XML file in a process pool.
+
+    Args:
+        filename: str -- the (compressed) OSM XML file
+        func: callable -- a picklable function func(fileobj) returning a
+                          picklable result
+        jobs: int -- number of worker processes (None means one per CPU core)
+        parts: int -- the number of chunks (by default 4 per worker process,
+                      for a better load balance)
+
+    Returns:
+        list of (start, result) tuples for the non-empty chunks, in file
+        order. All chunks but the one with start 0 have a synthetic root.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    index = zindex.get_index(filename)
+    root = get_root_tag(filename, index)
+    ranges = zindex.split(index, parts or 4 * jobs)
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(_apply_to_chunk, func, filename, start, end,
+                               index, root)
+                   for (start, end) in ranges]
+        results = [(start, future.result())
+                   for ((start, _), future) in zip(ranges, futures)]
+    return [(start, result) for (start, result) in results if result is not None]
@@ -0,0 +1,222 @@
+"""
+Columnar export of the nodes and ways of an OSM file (requires numpy).
+
+Most of the JSON documents of osm_to_json.py are nodes with an id, a position
+and a few tags, for which one JSON dict per node costs a lot of disk space and
+memory. The columnar format (osm_to_json.py --columns) stores each field in a
+numpy ".npy" file instead, which can be memory-mapped and filtered with
+vectorised operations. For each element type ("node" and "way"), the columns
+are saved as "<prefix>-<type>-<column>.npy":
+- id: int64 -- the element ids, in the order of the OSM file;
+- pos: int32 (n, 2) -- the (lat, lon) of the nodes, as fixed-point numbers
+  (see node_store.SCALE), MISSING if unknown;
+- version, changeset, uid: int32 -- MISSING if not given;
+- timestamp: int64 -- the seconds since the epoch, MISSING if not given;
+- tag_offsets: int64 (n + 1) -- the tags of the element i are the entries
+  tag_offsets[i]:tag_offsets[i + 1] of:
+- tag_keys, tag_values: int32 -- the key and value of each tag, as indices in
+  the string dictionaries "keys" and "values" saved in "<prefix>-tags.json";
+- node_offsets, node_refs (ways only): int64 -- the node ids of each way,
+  indexed like the tags.
+
+The tags are those stored by osm_to_json.shape_element() (see
+osm_to_json.classify_key()), with their OSM keys.
+
+Example (the ids of the restaurants):
+    >>> columns = load_columns("zurich-area", "node")
+    >>> strings = load_tag_strings("zurich-area")
+    >>> columns['id'][tag_mask(columns, strings, "amenity", "restaurant")]
+
+Attributes:
+    MISSING: int -- the value of the missing numbers
+    TYPES: tuple of str -- the exported element types
+"""
+
+import datetime
+import functools
+import json
+from array import array
+import numpy as np
+import open_file
+from node_store import SCALE
+from osm_to_json import classify_key
+
+MISSING = -2 ** 31
+TYPES = ('node', 'way')
+_NUMBERS = ('version', 'changeset', 'uid')
+
+
+@functools.lru_cache(maxsize=4096)
+def _date_epoch(date):
+    """Return the epoch seconds of a "YYYY-MM-DD" date (in UTC)."""
+    return int(datetime.datetime.strptime(date, "%Y-%m-%d").replace(
+        tzinfo=datetime.timezone.utc).timestamp())
+
+
+def parse_timestamp(timestamp):
+    """Convert an OSM timestamp ("2013-08-03T16:43:42Z") to epoch seconds."""
+    return (_date_epoch(timestamp[:10]) + int(timestamp[11:13]) * 3600 +
+            int(timestamp[14:16]) * 60 + int(timestamp[17:19]))
+
+
+class _TypeColumns:
+    """The columns of one element type, collected in compact arrays."""
+
+    def __init__(self):
+        self.ids = array('q')
+        self.pos = array('i')
+        self.numbers = {name: array('i') for name in _NUMBERS}
+        self.timestamps = array('q')
+        self.tag_offsets = array('q', [0])
+        self.tag_keys = array('i')
+        self.tag_values = array('i')
+        self.node_offsets = array('q', [0])
+        self.node_refs = array('q')
+
+    def arrays(self, doc_type):
+        """Return the columns as numpy arrays, by name."""
+        columns = {
+            'id': np.frombuffer(self.ids, dtype=np.int64),
+            'timestamp': np.frombuffer(self.timestamps, dtype=np.int64),
+            'tag_offsets': np.frombuffer(self.tag_offsets, dtype=np.int64),
+            'tag_keys': np.frombuffer(self.tag_keys, dtype=np.int32),
+            'tag_values': np.frombuffer(self.tag_values, dtype=np.int32),
+        }
+        for name in _NUMBERS:
+            columns[name] = np.frombuffer(self.numbers[name], dtype=np.int32)
+        if doc_type == 'node':
+            columns['pos'] = np.frombuffer(self.pos, dtype=np.int32).reshape(-1, 2)
+        else:
+            columns['node_offsets'] = np.frombuffer(self.node_offsets, dtype=np.int64)
+            columns['node_refs'] = np.frombuffer(self.node_refs, dtype=np.int64)
+        return columns
+
+
+class ColumnBuilder:
+    """Collect the nodes and ways of an OSM file into columns."""
+
+    def __init__(self):
+        self.columns = {doc_type: _TypeColumns() for doc_type in TYPES}
+        self.keys = {}
+        self.values = {}
+
+    def _encode(self, strings, string):
+        code = strings.get(string)
+        if code is None:
+            code = strings[string] = len(strings)
+        return code
+
+    def add(self, element):
+        """Add a <node> or <way> XML element (other elements are ignored)."""
+        columns = self.columns.get(element.tag)
+        if columns is None:
+            return
+        attrib = element.attrib
+        columns.ids.append(int(attrib['id']))
+        if element.tag == 'node':
+            if 'lat' in attrib and 'lon' in attrib:
+                columns.pos.append(round(float(attrib['lat']) * SCALE))
+                columns.pos.append(round(float(attrib['lon']) * SCALE))
+            else:
+                columns.pos.extend((MISSING, MISSING))
+        for name in _NUMBERS:
+            columns.numbers[name].append(int(attrib[name]) if name in attrib else MISSING)
+        columns.timestamps.append(parse_timestamp(attrib['timestamp'])
+                                  if 'timestamp' in attrib else MISSING)
+
+        for child in element:
+            if child.tag == 'tag':
+                if classify_key(child.attrib['k']) is None:
+                    continue
+                columns.tag_keys.append(self._encode(self.keys, child.attrib['k']))
+                columns.tag_values.append(self._encode(self.values, child.attrib['v']))
+            elif child.tag == 'nd':
+                columns.node_refs.append(int(child.attrib['ref']))
+        columns.tag_offsets.append(len(columns.tag_keys))
+        if element.tag == 'way':
+            columns.node_offsets.append(len(columns.node_refs))
+
+    def save(self, prefix):
+        """Save the columns and the tag string dictionaries.
+
+        Returns:
+            list of the written filenames
+        """
+        filenames = []
+        for doc_type in TYPES:
+            for (name, column) in self.columns[doc_type].arrays(doc_type).items():
+                filename = "{}-{}-{}.npy".format(prefix, doc_type, name)
+                np.save(filename, column)
+                filenames.append(filename)
+        filename = prefix + "-tags.json"
+        with open(filename, 'w', encoding='utf-8') as outf:
+            json.dump({'keys': list(self.keys), 'values': list(self.values)}, outf,
+                      ensure_ascii=False)
+        filenames.append(filename)
+        return filenames
+
+
+def write_columns(file_in, prefix, element_filter=None):
+    """Export the nodes and ways of an open OSM file to columns.
+
+    If element_filter (an osm_filters.ElementFilter) is given, only the
+    matching elements are exported.
+
+    Returns:
+        (number of elements, list of the written filenames)
+    """
+    builder = ColumnBuilder()
+    count = 0
+    for element in open_file.iter_elements(file_in, TYPES):
+        if element_filter is None or element_filter.match(element):
+            builder.add(element)
+            count += 1
+    return (count, builder.save(prefix))
+
+
+def load_columns(prefix, doc_type, mmap=True):
+    """Load the columns of an element type, memory-mapped by default.
+
+    Returns:
+        dict {<column name>: numpy array}
+    """
+    mode = 'r' if mmap else None
+    names = ['id', 'timestamp', 'tag_offsets', 'tag_keys', 'tag_values']
+    names += list(_NUMBERS)
+    names += ['pos'] if doc_type == 'node' else ['node_offsets', 'node_refs']
+    return {name: np.load("{}-{}-{}.npy".format(prefix, doc_type, name), mmap_mode=mode)
+            for name in names}
+
+
+def load_tag_strings(prefix):
+    """Load the tag string dictionaries.
+
+    Returns:
+        {"keys": {<key>: <index>}, "values": {<value>: <index>}}
+    """
+    with open(prefix + "-tags.json", encoding='utf-8') as inf:
+        strings = json.load(inf)
+    return {name: {string: i for (i, string) in enumerate(strings[name])}
+            for name in ('keys', 'values')}
+
+
+def tag_mask(columns, strings, key, value=None):
+    """Return the boolean mask of the elements having a tag.
+
+    Args:
+        columns: dict -- the columns of an element type, see load_columns()
+        strings: dict -- the tag string dictionaries, see load_tag_strings()
+        key: str -- the tag key
+        value: str -- the tag value (any value if None)
+    """
+    mask = np.zeros(len(columns['id']), dtype=bool)
+    key_code = strings['keys'].get(key)
+    value_code = strings['values'].get(value)
+    if key_code is None or (value is not None and value_code is None):
+        return mask
+    matches = columns['tag_keys'] == key_code
+    if value is not None:
+        matches &= columns['tag_values'] == value_code
+    entries = np.flatnonzero(matches)
+    mask[np.searchsorted(columns['tag_offsets'], entries, side='right') - 1] = True
+    return mask
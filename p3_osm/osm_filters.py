@@ -0,0 +1,133 @@
+"""
+Declarative element filters of osm_to_json.py, evaluated at parse time.
+
+For targeted extracts (e.g. only the elements with phone numbers, a bounding
+box or a few amenity types), shaping and serializing every node and way and
+filtering later in MongoDB wastes most of the conversion time. An
+ElementFilter is evaluated on the raw XML attributes and <tag> children of
+each element directly below the root, before osm_to_json.shape_element()
+runs, and the elements which do not match are cleared at once.
+
+The predicates are combined with AND; the alternatives of one predicate with
+OR. E.g. the restaurants and cafes with a phone number in Zurich:
+    > ./osm_to_json.py --bbox 47.32 8.45 47.43 8.62 --tag amenity=restaurant,cafe \\
+          --has-key phone --has-key "contact:*" zurich-area.osm.bz2
+
+With a bounding box, the ways having at least one node within the box are
+kept. Since the nodes precede the ways in OSM files, the ids of the nodes
+within the box are remembered for this.
+"""
+
+import fnmatch
+import re
+
+TYPES = ('node', 'way')
+
+
+class ElementFilter:
+    """Predicate on the <node> and <way> elements of an OSM file.
+
+    Args:
+        types: iterable of str -- the element types kept ("node" or "way"),
+               all if None
+        bbox: (min lat, min lon, max lat, max lon) -- keep the nodes within
+              the box, and the ways with at least one node within the box
+        keys: iterable of str -- keep the elements with at least one of these
+              tag keys, which can be glob patterns (e.g. "contact:*")
+        values: dict {<key>: set of str} -- keep the elements with one of
+                these tag values
+    """
+
+    def __init__(self, types=None, bbox=None, keys=None, values=None):
+        self.types = frozenset(types) if types else None
+        self.bbox = tuple(float(coord) for coord in bbox) if bbox else None
+        self.keys = tuple(keys) if keys else None
+        self.values = ({key: frozenset(vals) for (key, vals) in values.items()}
+                       if values else None)
+        self._key_re = (re.compile("|".join(fnmatch.translate(key) for key in self.keys))
+                        if self.keys else None)
+        self._node_ids = set()
+
+    @property
+    def needs_all_nodes(self):
+        """Whether the ways can only be matched after all the nodes (so the
+        file cannot be filtered in independent chunks)."""
+        return self.bbox is not None and (self.types is None or 'way' in self.types)
+
+    def _in_bbox(self, attrib):
+        if 'lat' not in attrib or 'lon' not in attrib:
+            return False
+        (min_lat, min_lon, max_lat, max_lon) = self.bbox
+        return (min_lat <= float(attrib['lat']) <= max_lat and
+                min_lon <= float(attrib['lon']) <= max_lon)
+
+    def match(self, element):
+        """Check whether an element directly below the root matches."""
+        if element.tag not in TYPES:
+            return False
+        if self.bbox is not None:
+            if element.tag == 'node':
+                if not self._in_bbox(element.attrib):
+                    return False
+                if self.needs_all_nodes:
+                    self._node_ids.add(element.attrib['id'])
+            elif not any(nd.attrib['ref'] in self._node_ids
+                         for nd in element.iter('nd')):
+                return False
+        if self.types is not None and element.tag not in self.types:
+            return False
+
+        has_key = self._key_re is None
+        has_value = self.values is None
+        if has_key and has_value:
+            return True
+        for tag in element.iter('tag'):
+            key = tag.attrib['k']
+            if not has_key and self._key_re.match(key):
+                has_key = True
+            if not has_value and tag.attrib['v'] in self.values.get(key, ()):
+                has_value = True
+            if has_key and has_value:
+                return True
+        return False
+
+
+def parse_tag_spec(spec):
+    """Parse a tag value specification "KEY=VALUE[,VALUE...]".
+
+    Returns:
+        (key, set of values)
+    """
+    (key, sep, values) = spec.partition('=')
+    if not sep or not key or not values:
+        raise ValueError("Invalid tag specification: " + spec)
+    return (key, set(values.split(',')))
+
+
+def add_filter_arguments(parser):
+    """Add the filter options to an ArgumentParser."""
+    parser.add_argument("--type", action="append", choices=TYPES, dest="types",
+                        help="keep only the elements of this type (repeatable)")
+    parser.add_argument("--bbox", type=float, nargs=4,
+                        metavar=("MINLAT", "MINLON", "MAXLAT", "MAXLON"),
+                        help="keep only the nodes within a bounding box, and "
+                             "the ways with nodes within it")
+    parser.add_argument("--has-key", action="append", metavar="KEY", dest="keys",
+                        help="keep only the elements with one of these tag keys "
+                             "(repeatable, glob patterns like \"contact:*\" allowed)")
+    parser.add_argument("--tag", action="append", metavar="KEY=VALUE[,VALUE...]",
+                        dest="tags",
+                        help="keep only the elements with one of these tag "
+                             "values (repeatable)")
+
+
+def filter_from_args(args):
+    """Return the ElementFilter of the options of add_filter_arguments(), or
+    None if no filter is given."""
+    if not (args.types or args.bbox or args.keys or args.tags):
+        return None
+    values = {}
+    for spec in args.tags or ():
+        (key, vals) = parse_tag_spec(spec)
+        values.setdefault(key, set()).update(vals)
+    return ElementFilter(args.types, args.bbox, args.keys, values)
@@ -0,0 +1,522 @@
+"""
+Reader for OSM PBF (Protocolbuffer Binary Format) files.
+
+The PBF file is decoded without any external dependency: the few protobuf
+messages of the format (see https://wiki.openstreetmap.org/wiki/PBF_Format)
+are parsed by a minimal protobuf decoder below.
+
+The decoded OSM primitives are returned as ElementTree elements shaped
+exactly like the ones of the OSM XML format, e.g.
+    <node id="1" version="2" ... lat="47.3769000" lon="8.5417000">
+        <tag k="amenity" v="cafe"/>
+    </node>
+so the scripts working on OSM XML can consume them unchanged, via
+iterparse() or parse().
+
+The file blobs are independent of each other, so they can be decompressed
+and decoded in parallel by a pool of worker processes.
+
+Attributes:
+    SUPPORTED_FEATURES: set of str -- the required features of the OSM
+                        header block that this reader understands
+"""
+
+import struct
+import time
+import zlib
+import xml.etree.ElementTree as ET
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+SUPPORTED_FEATURES = {'OsmSchema-V0.6', 'DenseNodes', 'HistoricalInformation'}
+
+# Protobuf wire types
+_VARINT = 0
+_FIXED64 = 1
+_LENGTH = 2
+_FIXED32 = 5
+
+_MEMBER_TYPES = ('node', 'way', 'relation')
+
+
+################################################################################
+# Minimal protobuf decoding
+
+
+def _varint(buf, pos):
+    """Decode a varint at "pos" of "buf" and return (value, new_pos)."""
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return (result, pos)
+        shift += 7
+
+
+def _zigzag(value):
+    """Decode a zigzag-encoded signed integer (sint32/sint64)."""
+    return (value >> 1) ^ -(value & 1)
+
+
+def _signed(value):
+    """Interpret a decoded varint as a signed 64-bit integer (int32/int64)."""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _fields(buf):
+    """Iterate over the fields of a protobuf message.
+
+    Yields:
+        (field_number, wire_type, value) tuples, where value is an int for
+        varint fields and a bytes slice for length-delimited fields
+    """
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        (key, pos) = _varint(buf, pos)
+        (field, wire) = (key >> 3, key & 7)
+        if wire == _VARINT:
+            (value, pos) = _varint(buf, pos)
+        elif wire == _LENGTH:
+            (size, pos) = _varint(buf, pos)
+            value = buf[pos:pos + size]
+            pos += size
+        elif wire == _FIXED64:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire == _FIXED32:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type {}".format(wire))
+        yield (field, wire, value)
+
+
+def _packed(wire, value):
+    """Decode a packed (or a single non-packed) repeated varint field."""
+    if wire == _VARINT:
+        return [value]
+    values = []
+    pos = 0
+    end = len(value)
+    while pos < end:
+        (val, pos) = _varint(value, pos)
+        values.append(val)
+    return values
+
+
+def _delta(values, decode=_zigzag):
+    """Decode a delta-coded list of zigzag integers into absolute values."""
+    result = []
+    acc = 0
+    for val in values:
+        acc += decode(val)
+        result.append(acc)
+    return result
+
+
+################################################################################
+# Decoding of OSM PBF messages
+
+
+def _format_coord(nanodeg):
+    """Format a coordinate in nanodegrees like in OSM XML (7 decimals)."""
+    units = (abs(nanodeg) + 50) // 100
+    sign = '-' if nanodeg < 0 and units else ''
+    return "{}{}.{:07d}".format(sign, units // 10**7, units % 10**7)
+
+
+def _format_time(millis):
+    """Format a timestamp in milliseconds since the epoch like in OSM XML."""
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(millis // 1000))
+
+
+class _Block:
+    """Decoding context of a PrimitiveBlock (string table and granularities)."""
+
+    def __init__(self, data):
+        self.strings = []
+        self.groups = []
+        self.granularity = 100
+        self.lat_offset = 0
+        self.lon_offset = 0
+        self.date_granularity = 1000
+        for (field, wire, value) in _fields(data):
+            if field == 1:
+                self.strings = [s.decode('utf-8') for (f, w, s) in _fields(value)
+                                if f == 1]
+            elif field == 2:
+                self.groups.append(value)
+            elif field == 17:
+                self.granularity = value
+            elif field == 18:
+                self.date_granularity = value
+            elif field == 19:
+                self.lat_offset = _signed(value)
+            elif field == 20:
+                self.lon_offset = _signed(value)
+
+    def lat(self, lat):
+        """Format a raw latitude of this block."""
+        return _format_coord(self.lat_offset + self.granularity * lat)
+
+    def lon(self, lon):
+        """Format a raw longitude of this block."""
+        return _format_coord(self.lon_offset + self.granularity * lon)
+
+    def info(self, attrib, data):
+        """Add the attributes stored in an Info message to "attrib"."""
+        fields = {}
+        for (field, _, value) in _fields(data):
+            fields[field] = value
+        if 6 in fields:
+            attrib['visible'] = 'true' if fields[6] else 'false'
+        if 1 in fields:
+            attrib['version'] = str(fields[1])
+        if 3 in fields:
+            attrib['changeset'] = str(_signed(fields[3]))
+        if 2 in fields:
+            attrib['timestamp'] = _format_time(_signed(fields[2]) *
+                                               self.date_granularity)
+        if 5 in fields:
+            attrib['user'] = self.strings[fields[5]]
+        if 4 in fields:
+            attrib['uid'] = str(_signed(fields[4]))
+
+    def tags(self, keys, vals):
+        """Return the list of (k, v) string pairs for the given string ids."""
+        strings = self.strings
+        return [(strings[k], strings[v]) for (k, v) in zip(keys, vals)]
+
+    def decode(self):
+        """Decode all primitive groups of the block.
+
+        Returns:
+            list of (tag, attrib, children) tuples, where children is a list
+            of (tag, attrib) tuples of the <tag>, <nd> and <member> elements
+        """
+        elements = []
+        for group in self.groups:
+            for (field, _, value) in _fields(group):
+                if field == 1:
+                    elements.append(self._node(value))
+                elif field == 2:
+                    elements.extend(self._dense(value))
+                elif field == 3:
+                    elements.append(self._way(value))
+                elif field == 4:
+                    elements.append(self._relation(value))
+        return elements
+
+    def _common(self, data):
+        """Decode the fields shared by Node, Way and Relation messages."""
+        attrib = {}
+        keys = []
+        vals = []
+        rest = []
+        for (field, wire, value) in _fields(data):
+            if field == 1:
+                attrib['id'] = value
+            elif field == 2:
+                keys = _packed(wire, value)
+            elif field == 3:
+                vals = _packed(wire, value)
+            elif field == 4:
+                self.info(attrib, value)
+            else:
+                rest.append((field, wire, value))
+        return (attrib, self.tags(keys, vals), rest)
+
+    def _node(self, data):
+        (attrib, tags, rest) = self._common(data)
+        attrib['id'] = str(_zigzag(attrib['id']))
+        for (field, _, value) in rest:
+            if field == 8:
+                attrib['lat'] = self.lat(_zigzag(value))
+            elif field == 9:
+                attrib['lon'] = self.lon(_zigzag(value))
+        return ('node', attrib, [('tag', {'k': k, 'v': v}) for (k, v) in tags])
+
+    def _way(self, data):
+        (attrib, tags, rest) = self._common(data)
+        attrib['id'] = str(_signed(attrib['id']))
+        children = []
+        for (field, wire, value) in rest:
+            if field == 8:
+                children.extend(('nd', {'ref': str(ref)})
+                                for ref in _delta(_packed(wire, value)))
+        children.extend(('tag', {'k': k, 'v': v}) for (k, v) in tags)
+        return ('way', attrib, children)
+
+    def _relation(self, data):
+        (attrib, tags, rest) = self._common(data)
+        attrib['id'] = str(_signed(attrib['id']))
+        roles = memids = types = []
+        for (field, wire, value) in rest:
+            if field == 8:
+                roles = _packed(wire, value)
+            elif field == 9:
+                memids = _delta(_packed(wire, value))
+            elif field == 10:
+                types = _packed(wire, value)
+        children = [('member', {'type': _MEMBER_TYPES[mtype], 'ref': str(ref),
+                                'role': self.strings[role]})
+                    for (mtype, ref, role) in zip(types, memids, roles)]
+        children.extend(('tag', {'k': k, 'v': v}) for (k, v) in tags)
+        return ('relation', attrib, children)
+
+    def _dense(self, data):
+        ids = lats = lons = keys_vals = []
+        info = {}
+        for (field, wire, value) in _fields(data):
+            if field == 1:
+                ids = _delta(_packed(wire, value))
+            elif field == 5:
+                for (ifield, iwire, ivalue) in _fields(value):
+                    info[ifield] = _packed(iwire, ivalue)
+            elif field == 8:
+                lats = _delta(_packed(wire, value))
+            elif field == 9:
+                lons = _delta(_packed(wire, value))
+            elif field == 10:
+                keys_vals = _packed(wire, value)
+
+        versions = info.get(1)
+        timestamps = _delta(info[2]) if 2 in info else None
+        changesets = _delta(info[3]) if 3 in info else None
+        uids = _delta(info[4]) if 4 in info else None
+        user_sids = _delta(info[5]) if 5 in info else None
+        visibles = info.get(6)
+
+        strings = self.strings
+        kv_pos = 0
+        nodes = []
+        for (i, node_id) in enumerate(ids):
+            attrib = {'id': str(node_id)}
+            if visibles:
+                attrib['visible'] = 'true' if visibles[i] else 'false'
+            if versions:
+                attrib['version'] = str(versions[i])
+            if changesets:
+                attrib['changeset'] = str(changesets[i])
+            if timestamps:
+                attrib['timestamp'] = _format_time(timestamps[i] *
+                                                   self.date_granularity)
+            if user_sids:
+                attrib['user'] = strings[user_sids[i]]
+            if uids:
+                attrib['uid'] = str(uids[i])
+            attrib['lat'] = self.lat(lats[i])
+            attrib['lon'] = self.lon(lons[i])
+
+            # keys_vals holds (key, value) string ids, each node's list being
+            # terminated by a 0
+            tags = []
+            while kv_pos < len(keys_vals) and keys_vals[kv_pos] != 0:
+                tags.append(('tag', {'k': strings[keys_vals[kv_pos]],
+                                     'v': strings[keys_vals[kv_pos + 1]]}))
+                kv_pos += 2
+            kv_pos += 1
+            nodes.append(('node', attrib, tags))
+        return nodes
+
+
+def _blob_data(blob):
+    """Return the uncompressed data of a Blob message."""
+    fields = {field: value for (field, _, value) in _fields(blob)}
+    if 1 in fields:
+        return fields[1]
+    if 3 in fields:
+        return zlib.decompress(fields[3])
+    if 4 in fields:
+        import lzma
+        return lzma.decompress(fields[4])
+    raise ValueError("Unsupported PBF blob compression")
+
+
+def decode_blob(blob):
+    """Decompress and decode an OSMData blob (runs in a worker process).
+
+    Returns:
+        list of (tag, attrib, children) tuples (see _Block.decode())
+    """
+    return _Block(_blob_data(blob)).decode()
+
+
+def decode_header(blob):
+    """Decode an OSMHeader blob.
+
+    Returns:
+        (root attrib, bounds attrib or None) -- the attributes of the <osm>
+        root element and of the <bounds> element
+    """
+    root = {'version': '0.6'}
+    bounds = None
+    for (field, _, value) in _fields(_blob_data(blob)):
+        if field == 1:
+            bbox = {f: _zigzag(v) for (f, _, v) in _fields(value)}
+            bounds = {'minlat': _format_coord(bbox.get(4, 0)),
+                      'minlon': _format_coord(bbox.get(1, 0)),
+                      'maxlat': _format_coord(bbox.get(3, 0)),
+                      'maxlon': _format_coord(bbox.get(2, 0))}
+        elif field == 4:
+            feature = value.decode('utf-8')
+            if feature not in SUPPORTED_FEATURES:
+                raise ValueError("Unsupported PBF feature: " + feature)
+        elif field == 16:
+            root['generator'] = value.decode('utf-8')
+    return (root, bounds)
+
+
+def iter_blobs(fileobj):
+    """Iterate over the blobs of a PBF file.
+
+    Yields:
+        (type, blob) tuples, where type is "OSMHeader" or "OSMData"
+    """
+    while True:
+        size = fileobj.read(4)
+        if len(size) < 4:
+            return
+        header = fileobj.read(struct.unpack('!L', size)[0])
+        blob_type = None
+        blob_size = 0
+        for (field, _, value) in _fields(header):
+            if field == 1:
+                blob_type = value.decode('utf-8')
+            elif field == 3:
+                blob_size = value
+        yield (blob_type, fileobj.read(blob_size))
+
+
+def _make_element(tag, attrib, children):
+    """Build an ElementTree element from a decoded primitive."""
+    elem = ET.Element(tag, attrib)
+    for (child_tag, child_attrib) in children:
+        ET.SubElement(elem, child_tag, child_attrib)
+    return elem
+
+
+class PbfFile:
+    """An open OSM PBF file, whose content can be parsed like an OSM XML file.
+
+    Args:
+        filename: str -- the PBF file to read
+        jobs: int -- number of processes decoding the blobs in parallel
+                     (None means one per CPU core, 1 means no worker processes)
+        prefetch: int -- if not 0, read the file ahead in a background thread,
+                         keeping up to this many 1 MB chunks in memory (see
+                         open_file.PrefetchReader)
+    """
+
+    def __init__(self, filename, jobs=1, prefetch=0):
+        self.name = filename
+        self.jobs = jobs
+        self._file = open(filename, 'rb')
+        if prefetch:
+            import io
+            import open_file
+            # Buffered, as the blobs are read with exact sizes
+            self._file = io.BufferedReader(open_file.PrefetchReader(self._file,
+                                                                    prefetch))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Close the file."""
+        self._file.close()
+
+    def _iter_decoded(self):
+        """Yield ('header', (root, bounds)) and then ('data', elements) items
+        in file order, decoding the data blobs in a process pool if enabled."""
+        blobs = iter_blobs(self._file)
+        if self.jobs == 1:
+            for (blob_type, blob) in blobs:
+                if blob_type == 'OSMHeader':
+                    yield ('header', decode_header(blob))
+                elif blob_type == 'OSMData':
+                    yield ('data', decode_blob(blob))
+            return
+
+        import os
+        jobs = self.jobs or os.cpu_count() or 1
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            for (blob_type, blob) in blobs:
+                if blob_type == 'OSMHeader':
+                    while pending:
+                        yield ('data', pending.popleft().result())
+                    yield ('header', decode_header(blob))
+                elif blob_type == 'OSMData':
+                    pending.append(pool.submit(decode_blob, blob))
+                    if len(pending) >= 2 * jobs:
+                        yield ('data', pending.popleft().result())
+            while pending:
+                yield ('data', pending.popleft().result())
+
+    def iterparse(self, events=('end',)):
+        """Parse the file incrementally, like xml.etree.ElementTree.iterparse.
+
+        Only the "start" and "end" events are supported. Unlike iterparse,
+        the node/way/relation elements are not attached to the root element,
+        so they do not have to be cleared to free memory.
+
+        Yields:
+            (event, element) tuples
+        """
+        want_start = 'start' in events
+        want_end = 'end' in events
+        root = None
+
+        for (kind, payload) in self._iter_decoded():
+            if kind == 'header':
+                (root_attrib, bounds) = payload
+                if root is None:
+                    root = ET.Element('osm', root_attrib)
+                    if want_start:
+                        yield ('start', root)
+                    if bounds is not None:
+                        elem = ET.Element('bounds', bounds)
+                        if want_start:
+                            yield ('start', elem)
+                        if want_end:
+                            yield ('end', elem)
+                continue
+
+            for (tag, attrib, children) in payload:
+                elem = _make_element(tag, attrib, children)
+                if want_start:
+                    yield ('start', elem)
+                    for child in elem:
+                        yield ('start', child)
+                        if want_end:
+                            yield ('end', child)
+                elif want_end:
+                    for child in elem:
+                        yield ('end', child)
+                if want_end:
+                    yield ('end', elem)
+
+        if root is not None and want_end:
+            yield ('end', root)
+
+    def parse(self):
+        """Parse the whole file into memory, like xml.etree.ElementTree.parse.
+
+        Returns:
+            an ElementTree object
+        """
+        root = None
+        for (event, elem) in self.iterparse(events=('start',)):
+            if root is None:
+                root = elem
+            elif elem.tag in ('bounds', 'node', 'way', 'relation'):
+                root.append(elem)
+        return ET.ElementTree(root)
@@ -0,0 +1,200 @@
+"""
+Approximate profiling of OSM XML files by random sampling.
+
+Instead of parsing the whole file, a configurable fraction of it is read as
+random byte windows of the uncompressed data. The windows are distinct slots
+of the window size picked at random, so they never overlap. Each window is
+resynchronised to the element boundaries (see osm_chunks.py), i.e. it starts
+at the first <node>/<way>/<relation> after its random offset and ends at the
+first one after its nominal end, and is then profiled like the whole file
+would be (see stats_cache.Profile).
+
+From the sampled windows the following is estimated:
+- the number of occurrences of each tag (path) in the whole file, by scaling
+  the mean density (occurrences per uncompressed byte) of the windows to the
+  file length, with a 95% confidence interval derived from the variance of
+  the density between windows;
+- the number of distinct values of each harvested attribute and of each
+  k:v key, with the Chao1 estimator for sampling without replacement, which
+  extrapolates the distinct values never seen from the values seen exactly
+  once and exactly twice and from the sampled fraction of the file. The
+  estimate is at most the estimated number of occurrences of the attribute
+  (e.g. all node ids are distinct).
+
+Compressed files are read via their checkpoint index (see zindex.py), so
+each window is decompressed from the nearest checkpoint only. A gzip file of
+a single member (e.g. compressed by plain "gzip") has no checkpoint but its
+start, so every window would be decompressed from the file start, which
+takes longer than parsing the whole file: such files are refused (they can
+be recompressed with "bgzip").
+
+Attributes:
+    WINDOW_SIZE: int -- default size in bytes of a sampled window
+    Z_95: float -- the normal quantile of a 95% confidence interval
+"""
+
+import math
+import random
+from collections import Counter
+import osm_chunks
+import stats_cache
+import zindex
+
+WINDOW_SIZE = 1024 * 1024
+Z_95 = 1.96
+
+
+def sample_profiles(filename, fraction, attr_xpaths=(), kv_xpaths=(),
+                    window=WINDOW_SIZE, seed=None):
+    """Profile random windows of an OSM XML file.
+
+    Args:
+        filename: str -- the (compressed) OSM XML file
+        fraction: float -- the fraction of the file to read, e.g. 0.01
+        attr_xpaths, kv_xpaths: list of str -- see stats_cache.Profile
+        window: int -- the size of a window in bytes
+        seed: int -- the seed of the random generator (None for a random one)
+
+    Returns:
+        (profiles, length, window) -- a list with a stats_cache.Profile per
+        window, the uncompressed length of the file and the window size
+
+    Raises:
+        ValueError -- if the file is a single-member gzip file
+    """
+    index = zindex.get_index(filename)
+    if not zindex.has_random_access(index):
+        raise ValueError("{} is a single gzip member, which can only be read from "
+                         "its start: parse the whole file, or recompress it with "
+                         "bgzip to sample it".format(filename))
+    root = osm_chunks.get_root_tag(filename, index)
+    length = index['length']
+    window = min(window, length)
+    count = max(1, min(int(math.ceil(fraction * length / window)),
+                       length // window))
+
+    # Non-overlapping slots, shifted by a random offset within the remainder
+    rand = random.Random(seed)
+    slots = length // window
+    shift = rand.randint(0, length - slots * window)
+    starts = [shift + slot * window
+              for slot in sorted(rand.sample(range(slots), count))]
+
+    profiles = []
+    for start in starts:
+        profile = stats_cache.Profile(attr_xpaths, kv_xpaths)
+        inf = osm_chunks.open_chunk(filename, start, start + window, index, root)
+        if inf is not None:
+            with inf:
+                for (summary, elem) in stats_cache.iter_top_elements(inf):
+                    # The (mostly synthetic) root element is not sampled
+                    if elem is not None:
+                        profile.add(summary, (root.decode(),))
+        profiles.append(profile)
+    return (profiles, length, window)
+
+
+def estimate_count(counts, length, window):
+    """Extrapolate the per-window counts of an item to the whole file.
+
+    Args:
+        counts: list of int -- the number of occurrences in each window
+        length: int -- the uncompressed file length
+        window: int -- the window size
+
+    Returns:
+        (estimate, low, high) -- the estimated total and its 95% confidence
+                                 interval
+    """
+    num = len(counts)
+    scale = length / window
+    mean = sum(counts) / num
+    if num > 1:
+        var = sum((c - mean) ** 2 for c in counts) / (num - 1)
+    else:
+        var = 0.0
+    # Standard error of the mean, with the finite population correction
+    sampled = min(num * window / length, 1.0)
+    stderr = math.sqrt(var / num * (1.0 - sampled))
+    return (round(mean * scale), max(round((mean - Z_95 * stderr) * scale), 0),
+            round((mean + Z_95 * stderr) * scale))
+
+
+def estimate_distinct(counter, fraction=1.0):
+    """Estimate the number of distinct values with the Chao1 estimator for
+    sampling without replacement (Chao & Lin, 2012).
+
+    Args:
+        counter: Counter -- the number of occurrences of each sampled value
+        fraction: float -- the sampled fraction of the file
+
+    Returns:
+        int -- the estimated number of distinct values in the whole file, at
+               most the estimated number of occurrences
+    """
+    observed = sum(1 for count in counter.values() if count > 0)
+    sampled = sum(count for count in counter.values() if count > 0)
+    if observed == 0 or fraction >= 1.0:
+        return observed
+    singletons = sum(1 for count in counter.values() if count == 1)
+    doubletons = sum(1 for count in counter.values() if count == 2)
+    # Without doubletons, the unseen values are extrapolated from the
+    # singletons and the sampling fraction alone: singletons * (1 - q) / q
+    denominator = (sampled / max(sampled - 1, 1) * 2 * doubletons
+                   + fraction / (1.0 - fraction) * singletons)
+    unseen = singletons ** 2 / denominator if denominator else 0.0
+    return min(round(observed + unseen), round(sampled / fraction))
+
+
+def estimate_schema(profiles, length, window):
+    """Estimate the tag statistics of the whole file from sampled windows.
+
+    Returns:
+        (tag_tree, tag_tree_counters, tag_counters, attr_counters) like the
+        ones returned by stats_cache.Profile.schema(), except that the
+        counters hold (estimate, low, high) tuples, and that tag_tree holds
+        the attributes seen in the sample
+    """
+    tag_tree = {}
+    for profile in profiles:
+        for (tag_path, counter) in profile.attr_counts.items():
+            tag_tree.setdefault(tag_path, set()).update(counter)
+
+    def estimate(counters):
+        keys = set().union(*counters)
+        return {key: estimate_count([counter[key] for counter in counters],
+                                    length, window)
+                for key in keys}
+
+    tag_tree_counters = estimate([p.path_counts for p in profiles])
+    tag_counters = estimate([p.tag_counts for p in profiles])
+    attr_counters = {
+        tag_path: estimate([p.attr_counts.get(tag_path, Counter()) for p in profiles])
+        for tag_path in tag_tree}
+    return (tag_tree, tag_tree_counters, tag_counters, attr_counters)
+
+
+def estimate_values(profiles, length, window):
+    """Estimate the number of distinct values from sampled windows.
+
+    Returns:
+        (attr_distinct, kv_distinct) -- {<attr xpath>: <estimate>} and
+        {<kv xpath>: {<key>: <estimate>}}
+    """
+    attr_values = {}
+    kv_values = {}
+    for profile in profiles:
+        for (xpath, counter) in profile.attr_values.items():
+            attr_values.setdefault(xpath, Counter()).update(counter)
+        for (xpath, counter) in profile.kv_values.items():
+            per_key = kv_values.setdefault(xpath, {})
+            for ((key, val), count) in counter.items():
+                per_key.setdefault(key, Counter())[val] += count
+
+    fraction = min(len(profiles) * window / length, 1.0) if length else 1.0
+    attr_distinct = {xpath: estimate_distinct(counter, fraction)
+                     for (xpath, counter) in attr_values.items()}
+    kv_distinct = {xpath: {key: estimate_distinct(counter, fraction)
+                           for (key, counter) in per_key.items()}
+                   for (xpath, per_key) in kv_values.items()}
+    return (attr_distinct, kv_distinct)
@@ -0,0 +1,231 @@
+"""
+Sinks bulk-loading the JSON documents of osm_to_json.py into a database.
+
+Instead of writing a JSON file and importing it with mongoimport, the
+documents can be loaded directly during the conversion:
+- MongoSink inserts them into a MongoDB collection with unordered
+  insert_many() batches (requires pymongo);
+- SqliteSink inserts them into an embedded SQLite database, with one
+  executemany() per batch and each batch in its own transaction. The
+  documents are stored as JSON text, which can be queried with the JSON1
+  functions of SQLite, e.g.:
+      SELECT json_extract(doc, '$.name') FROM map WHERE type = 'node'
+        AND json_extract(doc, '$.amenity') = 'restaurant';
+
+The documents are collected in batches, which are written by a background
+thread, so that loading overlaps with parsing.
+
+The documents are added with the type and id of their OSM element, which
+key them in the database: the "type" and "id" fields of a document can be
+replaced by tags (e.g. the "type" tag of multipolygons). The sinks can also
+apply updates (see osm_changes.py): the documents added to a SqliteSink
+replace those with the same type and id, a MongoSink does so with
+upsert=True, and delete() removes documents, in the order of the calls.
+
+Attributes:
+    BATCH_SIZE: int -- default number of documents written at once
+    QUEUE_BATCHES: int -- max. number of batches waiting for the writer thread
+    DEFAULT_MONGODB_HOST: str -- default location of the MongoDB server
+"""
+
+import json
+import queue
+import re
+import sqlite3
+import threading
+from collections import namedtuple
+from itertools import groupby
+
+BATCH_SIZE = 10000
+QUEUE_BATCHES = 4
+DEFAULT_MONGODB_HOST = "mongodb://localhost:27017"
+
+# The documents and deletions of documents, in the batches of the sinks
+Document = namedtuple('Document', 'type id doc')
+Deletion = namedtuple('Deletion', 'type id')
+
+
+class Sink:
+    """Base class of the sinks, batching the documents and writing the
+    batches in a background thread.
+
+    Subclasses implement write_batch() and optionally finish(). The batches
+    are lists of Document and Deletion tuples.
+
+    Args:
+        batch_size: int -- the number of documents written at once
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE):
+        self.batch_size = batch_size
+        self.count = 0
+        self._batch = []
+        self._queue = queue.Queue(maxsize=QUEUE_BATCHES)
+        self._error = None
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _write_loop(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            if self._error is None:
+                try:
+                    self.write_batch(batch)
+                except Exception as error:  # Re-raised in the main thread
+                    self._error = error
+
+    def _check_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _append(self, item):
+        self._batch.append(item)
+        if len(self._batch) >= self.batch_size:
+            self._check_error()
+            self._queue.put(self._batch)
+            self._batch = []
+
+    def add(self, doc_type, doc_id, doc):
+        """Add the document of the element with the given type and id to the
+        sink."""
+        self.count += 1
+        self._append(Document(doc_type, doc_id, doc))
+
+    def delete(self, doc_type, doc_id):
+        """Delete the document with the given type and id from the sink."""
+        self._append(Deletion(doc_type, doc_id))
+
+    def close(self):
+        """Write the remaining documents and wait for the writer thread."""
+        if self._thread is None:
+            return
+        if self._batch:
+            self._queue.put(self._batch)
+            self._batch = []
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self.finish()
+        self._check_error()
+
+    def write_batch(self, batch):
+        """Write a list of Document and Deletion tuples (in the writer
+        thread)."""
+        raise NotImplementedError
+
+    def finish(self):
+        """Release the resources of the sink, after the last batch."""
+
+
+class SqliteSink(Sink):
+    """Load the documents into a table of a SQLite database.
+
+    The table has the columns "type" and "id" (the primary key) and "doc",
+    the JSON text of the document. Documents already in the table are
+    replaced.
+
+    Args:
+        filename: str -- the database file (created if needed)
+        table: str -- the table name
+        batch_size: int -- the number of documents per transaction
+    """
+
+    def __init__(self, filename, table="map", batch_size=BATCH_SIZE):
+        if not re.match(r"^\w+$", table):
+            raise ValueError("Invalid table name: " + table)
+        self.table = table
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS {} (type TEXT NOT NULL, "
+                        "id INTEGER NOT NULL, doc TEXT NOT NULL, "
+                        "PRIMARY KEY (type, id))".format(table))
+        super().__init__(batch_size)
+
+    def write_batch(self, batch):
+        with self.db:
+            for (deletion, items) in groupby(
+                    batch, key=lambda item: isinstance(item, Deletion)):
+                if deletion:
+                    self.db.executemany(
+                        "DELETE FROM {} WHERE type = ? AND id = ?".format(self.table),
+                        ((item.type, int(item.id)) for item in items))
+                else:
+                    self.db.executemany(
+                        "INSERT OR REPLACE INTO {} VALUES (?, ?, ?)".format(self.table),
+                        ((item.type, int(item.id), json.dumps(item.doc))
+                         for item in items))
+
+    def finish(self):
+        self.db.close()
+
+
+class MongoSink(Sink):
+    """Load the documents into a MongoDB collection.
+
+    The "_id" of the documents is "<type>/<id>" (e.g. "way/7"), the type and
+    id of their element.
+
+    Args:
+        host: str -- the MongoDB server URI
+        dbase: str -- the database name
+        coll: str -- the collection name
+        batch_size: int -- the number of documents per insert_many()
+        upsert: bool -- replace the documents with the same type and id,
+                instead of inserting them
+    """
+
+    def __init__(self, host, dbase, coll, batch_size=BATCH_SIZE, upsert=False):
+        from pymongo import MongoClient
+
+        self.client = MongoClient(host)
+        self.coll = self.client[dbase][coll]
+        self.upsert = upsert
+        super().__init__(batch_size)
+
+    @staticmethod
+    def _document(item):
+        return dict(item.doc, _id=item.type + "/" + item.id)
+
+    def write_batch(self, batch):
+        if not self.upsert and not any(isinstance(item, Deletion) for item in batch):
+            self.coll.insert_many([self._document(item) for item in batch],
+                                  ordered=False)
+            return
+
+        from pymongo import DeleteOne, InsertOne, ReplaceOne
+
+        requests = []
+        for item in batch:
+            if isinstance(item, Deletion):
+                requests.append(DeleteOne({'_id': item.type + "/" + item.id}))
+            elif self.upsert:
+                doc = self._document(item)
+                requests.append(ReplaceOne({'_id': doc['_id']}, doc, upsert=True))
+            else:
+                requests.append(InsertOne(self._document(item)))
+        self.coll.bulk_write(requests, ordered=True)
+
+    def finish(self):
+        self.client.close()
+
+
+def parse_mongodb_spec(spec):
+    """Parse a MongoDB specification "[host:port/]DB/COLLECTION".
+
+    Returns:
+        (host, dbase, collection)
+    """
+    match = re.match(r"(.*:.*/)*(.*)/(.*)", spec)
+    if not match:
+        raise ValueError("Invalid specification of MongoDB database: " + spec)
+    host = match.group(1).rstrip('/') if match.group(1) else DEFAULT_MONGODB_HOST
+    return (host, match.group(2), match.group(3))
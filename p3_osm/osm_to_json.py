@@ -30,12 +30,20 @@ The output JSON has the following structure:
 }
 """
 
-import xml.etree.cElementTree as ET
 import codecs
+import functools
+import io
+import os
 import re
 import json
 import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import open_file
+import osm_chunks
+import osm_filters
+import osm_sinks
+import xml_parsers
 
 
 LOWER_RE = re.compile(r'^([a-z]|_)*$')
@@ -46,9 +54,115 @@ BAD_CHARS_RE = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 
 CREATED = ["version", "changeset", "timestamp", "user", "uid"]
 
+# Max. number of distinct tag keys whose classification is cached
+KEY_CACHE_SIZE = 65536
 
-def shape_element(element):
-    """Convert an OSM XML element to a JSON representation."""
+# Max. number of strings and max. string length of a StringTable
+STRING_TABLE_SIZE = 65536
+STRING_MAX_LENGTH = 64
+
+# The "created" fields shared by many documents (changesets and timestamps
+# have too many distinct values)
+INTERNED_CREATED = ["version", "user", "uid"]
+
+
+@functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+def classify_key(key):
+    """Decide how shape_element() stores the value of a tag key.
+
+    OSM tag keys are very repetitive, so the decisions are cached (see
+    classify_key.cache_info() for the hit rate).
+
+    Returns:
+        None if the tag is dropped, ("address", <field>) if its value goes to
+        the "address" sub-document, or (None, <key>) if it is stored as is
+    """
+    if BAD_CHARS_RE.search(key):
+        return None
+
+    addr_tag = ADDR_RE.search(key)
+    if addr_tag is not None:
+        if not LOWER_TWO_COLONS.search(key):
+            return ("address", addr_tag.group(1))
+
+    return (None, key)
+
+
+def format_key_cache_stats():
+    """Return the hit rate of the tag key classification cache as text."""
+    info = classify_key.cache_info()
+    lookups = info.hits + info.misses
+    return "{} lookups, {:.1%} hits, {} distinct keys cached".format(
+        lookups, info.hits / lookups if lookups else 0.0, info.currsize)
+
+
+class StringTable:
+    """Bounded table of shared strings for the documents of shape_element().
+
+    Each document holds its own copies of the user names, uids and tag values
+    parsed from the XML, although most of them are repeated over and over
+    (e.g. "restaurant"). When many documents are kept in memory (see
+    process_map()), replacing the copies with a shared instance saves their
+    memory. The table keeps the first distinct strings seen, up to a number
+    of strings and a string length, so its own size stays bounded even with
+    many distinct values (e.g. names).
+
+    Args:
+        size: int -- the max. number of strings in the table
+        max_length: int -- the max. length of the strings added to the table
+    """
+
+    def __init__(self, size=STRING_TABLE_SIZE, max_length=STRING_MAX_LENGTH):
+        self.size = size
+        self.max_length = max_length
+        self.lookups = 0
+        self.hits = 0
+        self.saved = 0
+        self._strings = {}
+
+    def __len__(self):
+        return len(self._strings)
+
+    def intern(self, string):
+        """Return the shared instance of a string (the string itself if it
+        is not in the table)."""
+        self.lookups += 1
+        shared = self._strings.get(string)
+        if shared is None:
+            if len(self._strings) < self.size and len(string) <= self.max_length:
+                self._strings[string] = string
+            return string
+        if shared is not string:
+            self.hits += 1
+            self.saved += sys.getsizeof(string)
+        return shared
+
+    def intern_document(self, doc):
+        """Replace the repeated strings of a document of shape_element() with
+        their shared instances."""
+        created = doc['created']
+        for field in INTERNED_CREATED:
+            if field in created:
+                created[field] = self.intern(created[field])
+        for (key, value) in doc.items():
+            if isinstance(value, str) and key != 'id' and key != 'type':
+                doc[key] = self.intern(value)
+        for (key, value) in doc.get('address', {}).items():
+            doc['address'][key] = self.intern(value)
+
+    def format_stats(self):
+        """Return the hit rate and the saved memory as text."""
+        return "{} lookups, {:.1%} shared, {} strings in table, {:.1f} MB saved".format(
+            self.lookups, self.hits / self.lookups if self.lookups else 0.0,
+            len(self), self.saved / 2 ** 20)
+
+
+def shape_element(element, strings=None):
+    """Convert an OSM XML element to a JSON representation.
+
+    If strings (a StringTable) is given, the repeated strings of the
+    representation are shared.
+    """
     node = {}
     node['created'] = {}
     node['address'] = {}
@@ -71,19 +185,15 @@ def shape_element(element):
                 node['created'][i] = element.attrib[i]
 
         for tag in element.iter('tag'):
-            key = tag.attrib['k']
-            val = tag.attrib['v']
-
-            if BAD_CHARS_RE.search(key):
+            decision = classify_key(tag.attrib['k'])
+            if decision is None:
                 continue
 
-            addr_tag = ADDR_RE.search(key)
-            if addr_tag is not None:
-                if not LOWER_TWO_COLONS.search(key):
-                    node['address'][addr_tag.group(1)] = val
-                    continue
-
-            node[key] = val
+            (sub_doc, key) = decision
+            if sub_doc is not None:
+                node[sub_doc][key] = tag.attrib['v']
+            else:
+                node[key] = tag.attrib['v']
 
         for tag in element.iter('nd'):
             node['node_refs'].append(tag.attrib['ref'])
@@ -93,38 +203,391 @@ def shape_element(element):
         if node['node_refs'] == []:
             del node['node_refs']
 
+        if strings is not None:
+            strings.intern_document(node)
         return node
     else:
         return None
 
 
-def process_map(file_in, filename, pretty=False):
-    """Process each XML element in the input map and write it to a JSON file."""
-    # You do not need to change this file
+def add_way_coords(elem_json, nodes):
+    """Add the coordinates of the nodes of a way to its JSON representation.
+
+    The coordinates are added as "node_pos": [[lat, lon], ...] (with null for
+    the nodes not found), in the order of "node_refs".
+
+    Args:
+        elem_json: dict -- the JSON representation of a way
+        nodes: node_store.NodeStore -- the node locations, or a
+               node_store.NodeStoreBuilder of the locations of the nodes read
+               so far (which precede the ways in OSM files)
+    """
+    if hasattr(nodes, 'build'):
+        nodes = nodes.build()
+    if 'node_refs' in elem_json:
+        elem_json['node_pos'] = nodes.lookup_list(elem_json['node_refs'])
+
+
+def iter_typed_documents(file_in, nodes=None, strings=None, element_filter=None):
+    """Yield the JSON representation of each node and way of an OSM XML file,
+    with the element type and id.
+
+    Only the <node> and <way> elements directly below the root element are
+    read (see open_file.iter_elements()). They are cleared as soon as they
+    (and so all their children) have been converted, so the memory use does
+    not grow with the size of the file.
+
+    If nodes is given, the ways get the coordinates of their nodes (see
+    add_way_coords()). If strings (a StringTable) is given, the repeated
+    strings of the documents are shared. If element_filter (an
+    osm_filters.ElementFilter) is given, only the matching elements are
+    converted, the others are cleared without being shaped.
+
+    Yields:
+        (element type, element id, elem_json) tuples -- the type and id are
+        the ones of the XML element ("node" or "way", and the "id"
+        attribute), which tags can replace in the document
+    """
+    for element in open_file.iter_elements(file_in, ('node', 'way')):
+        if (element.tag == 'node' and hasattr(nodes, 'build') and
+                'lat' in element.attrib and 'lon' in element.attrib):
+            # Also for the filtered out nodes, which the ways may still need
+            nodes.add(element.attrib['id'], element.attrib['lat'],
+                      element.attrib['lon'])
+        if element_filter is not None and not element_filter.match(element):
+            continue
+
+        elem_json = shape_element(element, strings)
+        if nodes is not None and element.tag == 'way':
+            add_way_coords(elem_json, nodes)
+        yield (element.tag, element.attrib['id'], elem_json)
+
+
+def iter_documents(file_in, nodes=None, strings=None, element_filter=None):
+    """Yield the JSON representation of each node and way of an OSM XML file
+    (see iter_typed_documents())."""
+    for (_, _, elem_json) in iter_typed_documents(file_in, nodes, strings,
+                                                  element_filter):
+        yield elem_json
+
+
+def process_map(file_in, filename, pretty=False, stream=False, nodes=None,
+                index=None, strings=None, element_filter=None, offset_index=None):
+    """Process each XML element in the input map and write it to a JSON file.
+
+    See iter_documents() for the nodes, strings and element_filter
+    arguments (a StringTable reduces the memory of the returned documents).
+    If index is given (a spatial_index.IndexBuilder), the documents are added
+    to it with their offsets in the JSON file. If offset_index is given (an
+    osm_changes.OffsetIndexBuilder), the byte ranges of the documents are
+    added to it.
+
+    Returns:
+        the list of the JSON documents, or only their number if stream is
+        True (then the documents are not kept in memory)
+    """
     file_out = "{0}.json".format(filename)
     data = []
+    count = 0
+    offset = 0
     with codecs.open(file_out, "w") as fout:
-        for _, element in ET.iterparse(file_in):
-            elem_json = shape_element(element)
-            if elem_json:
+        for (elem_type, elem_id, elem_json) in iter_typed_documents(
+                file_in, nodes, strings, element_filter):
+            count += 1
+            if not stream:
                 data.append(elem_json)
-                if pretty:
-                    fout.write(json.dumps(elem_json, indent=2)+"\n")
+            if index is not None:
+                index.add(offset, elem_json)
+            if pretty:
+                line = json.dumps(elem_json, indent=2)+"\n"
+            else:
+                line = json.dumps(elem_json) + "\n"
+            if offset_index is not None:
+                offset_index.add(elem_type, elem_id, offset, len(line))
+            # The JSON text is ASCII, so its length is its size in bytes
+            offset += len(line)
+            fout.write(line)
+    return count if stream else data
+
+
+def load_map(file_in, sink, nodes=None, element_filter=None):
+    """Load the JSON documents of the input map into a sink (see osm_sinks.py)
+    and close it. See iter_documents() for the nodes and element_filter
+    arguments.
+
+    Returns:
+        the number of documents
+    """
+    with sink:
+        for (elem_type, elem_id, elem_json) in iter_typed_documents(
+                file_in, nodes, element_filter=element_filter):
+            sink.add(elem_type, elem_id, elem_json)
+    return sink.count
+
+
+def _shape_chunk(pretty, node_store_prefix, with_bboxes, with_offsets,
+                 element_filter, data):
+    """Convert a chunk document of osm_chunks.iter_stream_chunks() to JSON
+    lines (in a worker process).
+
+    Returns:
+        (number of documents, JSON lines, bounding boxes, ranges) -- the
+        bounding boxes (see spatial_index.document_bbox()) are a list of
+        (<offset in the JSON lines>, <bbox>) tuples if with_bboxes is True,
+        the ranges a list of (<element type>, <id>, <offset in the JSON
+        lines>, <length>) tuples if with_offsets is True
+    """
+    nodes = None
+    if node_store_prefix is not None:
+        import node_store
+        nodes = node_store.NodeStore.load(node_store_prefix)
+    if with_bboxes:
+        import spatial_index
+
+    lines = []
+    bboxes = []
+    ranges = []
+    offset = 0
+    for (elem_type, elem_id, elem_json) in iter_typed_documents(
+            io.BytesIO(data), nodes, element_filter=element_filter):
+        if pretty:
+            line = json.dumps(elem_json, indent=2)+"\n"
+        else:
+            line = json.dumps(elem_json) + "\n"
+        if with_bboxes:
+            bbox = spatial_index.document_bbox(elem_json)
+            if bbox is not None:
+                bboxes.append((offset, bbox))
+        if with_offsets:
+            ranges.append((elem_type, elem_id, offset, len(line)))
+        offset += len(line)
+        lines.append(line)
+    return (len(lines), "".join(lines), bboxes, ranges)
+
+
+def process_map_parallel(file_in, filename, jobs=None, pretty=False,
+                         chunk_size=osm_chunks.STREAM_CHUNK_SIZE,
+                         node_store_prefix=None, index=None, element_filter=None,
+                         offset_index=None):
+    """Like process_map(stream=True), but shape and serialize the elements
+    in a process pool.
+
+    The main process only cuts the XML stream into chunks (see
+    osm_chunks.iter_stream_chunks()), which the worker processes parse and
+    convert to JSON lines. The lines are written in input order, so the
+    output is identical to the one of process_map().
+
+    Args:
+        file_in: binary fileobject -- the OSM XML input
+        filename: str -- the output filename, without the ".json" suffix
+        jobs: int -- number of worker processes (None means one per CPU core)
+        pretty: bool -- indent the JSON documents
+        chunk_size: int -- the approximate size in bytes of the XML chunks
+        node_store_prefix: str -- if given, the ways get the coordinates of
+                           their nodes from this (memory-mapped) node store
+                           (see node_store.py and add_way_coords())
+        index: spatial_index.IndexBuilder -- if given, the documents are
+               added to it with their offsets in the JSON file
+        offset_index: osm_changes.OffsetIndexBuilder -- if given, the byte
+                      ranges of the documents are added to it
+        element_filter: osm_filters.ElementFilter -- if given, only the
+                        matching elements are converted (the filter must
+                        not need all nodes, see
+                        osm_filters.ElementFilter.needs_all_nodes)
+
+    Returns:
+        the number of JSON documents
+    """
+    jobs = jobs or os.cpu_count() or 1
+    file_out = "{0}.json".format(filename)
+    chunks = osm_chunks.iter_stream_chunks(file_in, chunk_size)
+    pending = deque()
+    count = 0
+    offset = 0
+
+    with codecs.open(file_out, "w") as fout, \
+            ProcessPoolExecutor(max_workers=jobs) as pool:
+        while True:
+            # Keep a bounded number of chunks in flight
+            while chunks is not None and len(pending) < 2 * jobs:
+                data = next(chunks, None)
+                if data is None:
+                    chunks = None
                 else:
-                    fout.write(json.dumps(elem_json) + "\n")
-    return data
+                    pending.append(pool.submit(_shape_chunk, pretty,
+                                                node_store_prefix,
+                                                index is not None,
+                                                offset_index is not None,
+                                                element_filter, data))
+            if not pending:
+                return count
+            (num, lines, bboxes, ranges) = pending.popleft().result()
+            for (line_offset, bbox) in bboxes:
+                index.add_bbox(offset + line_offset, bbox)
+            for (elem_type, elem_id, line_offset, length) in ranges:
+                offset_index.add(elem_type, elem_id, offset + line_offset, length)
+            count += num
+            offset += len(lines)
+            fout.write(lines)
+
+
+def _convert_member(basename, way_coords, node_store_prefix, element_filter,
+                    name, file_in):
+    """Convert an archive member to a JSON shard (used with
+    open_file.map_members()) and return the shard filename.
+
+    With way_coords, the node locations are read from the store with the
+    prefix node_store_prefix, or else collected from the member itself.
+    """
+    nodes = None
+    if way_coords:
+        import node_store
+        if node_store_prefix:
+            nodes = node_store.NodeStore.load(node_store_prefix)
+        else:
+            nodes = node_store.NodeStoreBuilder()
+    shard = "{}-{}".format(basename, os.path.basename(name).split('.')[0])
+    process_map(file_in, shard, stream=True, nodes=nodes,
+                element_filter=element_filter)
+    return "{}.json".format(shard)
 
 
 def main():
     """The main function."""
-    if len(sys.argv) > 1:
-        file = sys.argv[1]
-    else:
-        print("ERROR: No input file specified", file=sys.stderr)
-        sys.exit(1)
+    from argparse import ArgumentParser
 
-    inf = open_file.open_file(file)
-    process_map(inf, file.split('.')[0])
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("-z", "--unzip-jobs", type=int, default=1, metavar="N",
+                        help="decompress bzip2 or PBF input with N processes in parallel "
+                             "(0 means one per CPU core)")
+    parser.add_argument("-p", "--prefetch", type=int, default=0, metavar="N",
+                        help="decompress the input ahead in a background thread, "
+                             "buffering up to N 1 MB chunks")
+    parser.add_argument("-m", "--members", action="store_true",
+                        help="convert each member of a zip/tar archive to a "
+                             "separate JSON file")
+    parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+                        help="convert with N processes in parallel (0 means one "
+                             "per CPU core), each taking a chunk of the input "
+                             "file (or archive member with -m)")
+    parser.add_argument("--way-coords", action="store_true",
+                        help="add the coordinates of their nodes to the ways "
+                             "(\"node_pos\", requires numpy)")
+    parser.add_argument("--node-store", metavar="PREFIX",
+                        help="with --way-coords, read the node coordinates from "
+                             "a store built by node_store.py instead of collecting "
+                             "them during the conversion (needed with -j)")
+    parser.add_argument("--spatial-index", action="store_true",
+                        help="build a spatial index of the JSON documents, "
+                             "see spatial_index.py (requires numpy)")
+    parser.add_argument("--offset-index", action="store_true",
+                        help="write the offset index of the JSON documents "
+                             "needed by osm_changes.py --json")
+    parser.add_argument("--columns", action="store_true",
+                        help="write the nodes and ways to numpy column files "
+                             "instead of JSON, see osm_columns.py (requires numpy)")
+    parser.add_argument("--sqlite", metavar="DB",
+                        help="load the documents into the \"map\" table of a SQLite "
+                             "database instead of writing a JSON file")
+    parser.add_argument("--mongodb", metavar="[host:port/]DB/COLLECTION",
+                        help="load the documents into a MongoDB collection instead "
+                             "of writing a JSON file")
+    parser.add_argument("--batch-size", type=int, default=osm_sinks.BATCH_SIZE,
+                        metavar="N", help="with --sqlite or --mongodb, the number "
+                        "of documents loaded at once (default: %(default)s)")
+    osm_filters.add_filter_arguments(parser)
+    parser.add_argument("filename", metavar="FILE",
+                        help="input OSM XML file (can be compressed or uncompressed)")
+    xml_parsers.add_parser_argument(parser)
+    args = parser.parse_args()
+    if args.parser:
+        xml_parsers.set_default(args.parser)
+
+    file = args.filename
+    element_filter = osm_filters.filter_from_args(args)
+    if args.offset_index and (args.members or args.columns or args.sqlite or
+                              args.mongodb):
+        parser.error("--offset-index needs a single JSON output file (not -m, "
+                     "--columns, --sqlite or --mongodb)")
+    if args.spatial_index and (args.sqlite or args.mongodb):
+        parser.error("--spatial-index needs a JSON output file (not --sqlite or "
+                     "--mongodb)")
+    if args.columns and (args.spatial_index or args.way_coords or args.sqlite or
+                         args.mongodb):
+        parser.error("--columns cannot be combined with --spatial-index, "
+                     "--way-coords, --sqlite or --mongodb")
+    if args.members:
+        if args.columns or args.sqlite or args.mongodb or args.spatial_index:
+            parser.error("-m cannot be combined with --columns, --sqlite, "
+                         "--mongodb or --spatial-index")
+        convert = functools.partial(_convert_member, file.split('.')[0],
+                                    args.way_coords, args.node_store, element_filter)
+        for (name, shard) in open_file.map_members(file, convert, args.jobs or None):
+            print("> Converted archive member {} to {}".format(name, shard))
+        return
+
+    inf = open_file.open_file(file, args.unzip_jobs or None, args.prefetch)
+    nodes = None
+    if args.way_coords:
+        import node_store
+        if args.node_store:
+            nodes = node_store.NodeStore.load(args.node_store)
+        else:
+            nodes = node_store.NodeStoreBuilder()
+
+    index = None
+    if args.spatial_index:
+        import spatial_index
+        index = spatial_index.IndexBuilder()
+    offset_index = None
+    if args.offset_index:
+        import osm_changes
+        offset_index = osm_changes.OffsetIndexBuilder()
+
+    # The reason why the conversion cannot be split into chunks for -j
+    serial_reason = None
+    if hasattr(inf, 'iterparse'):
+        serial_reason = "PBF input is decoded in parallel with -z instead"
+    elif args.way_coords and not args.node_store:
+        serial_reason = "--way-coords collects the node coordinates, use --node-store"
+    elif element_filter is not None and element_filter.needs_all_nodes:
+        serial_reason = "--bbox matches the ways by their nodes"
+
+    if args.columns:
+        import osm_columns
+        (count, filenames) = osm_columns.write_columns(inf, file.split('.')[0],
+                                                       element_filter)
+        print("> Wrote {} elements to {} column files ({:.1f} MB)".format(
+            count, len(filenames),
+            sum(os.path.getsize(filename) for filename in filenames) / 2 ** 20))
+    elif args.sqlite or args.mongodb:
+        if args.sqlite:
+            sink = osm_sinks.SqliteSink(args.sqlite, batch_size=args.batch_size)
+        else:
+            (host, dbase, coll) = osm_sinks.parse_mongodb_spec(args.mongodb)
+            sink = osm_sinks.MongoSink(host, dbase, coll, args.batch_size)
+        print("> Loaded {} documents".format(load_map(inf, sink, nodes, element_filter)))
+    elif args.jobs != 1 and serial_reason is None:
+        process_map_parallel(inf, file.split('.')[0], args.jobs or None,
+                             node_store_prefix=args.node_store if args.way_coords else None,
+                             index=index, element_filter=element_filter,
+                             offset_index=offset_index)
+    else:
+        if args.jobs != 1:
+            print("> Converting serially ({})".format(serial_reason))
+        process_map(inf, file.split('.')[0], stream=True, nodes=nodes, index=index,
+                    element_filter=element_filter, offset_index=offset_index)
+        print("> Tag key cache: " + format_key_cache_stats())
+    if offset_index is not None:
+        filename = osm_changes.offsets_filename(file.split('.')[0])
+        offset_index.build().save(filename)
+        print("> Offset index: " + filename)
+    if index is not None:
+        filename = spatial_index.index_filename(file.split('.')[0])
+        index.build().save(filename)
+        print("> Spatial index: " + filename)
+    if isinstance(inf, open_file.PrefetchReader):
+        print("> Read-ahead: " + inf.format_stats())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,180 @@
+"""
+Bounded-memory sketches of the values harvested from an OSM XML file.
+
+Keeping every distinct value in a set (like get_xml_values.py does) needs
+memory proportional to the number of distinct values, e.g. tens of millions
+of coordinates for a large region. A ValueSketch keeps the exact counts of
+the values only as long as there are at most "threshold" distinct ones.
+Beyond that it switches to two fixed-size sketches:
+- a HyperLogLog estimating the number of distinct values (with a standard
+  error of 1.04 / sqrt(2 ** precision), i.e. about 1.6% by default);
+- a Space-Saving summary of the most frequent values, whose counts are
+  overestimated by at most the reported error.
+
+Attributes:
+    EXACT_THRESHOLD: int -- default max. number of distinct values kept exactly
+    TOP_K: int -- default number of most frequent values reported
+    HLL_PRECISION: int -- default number of index bits of the HyperLogLog
+"""
+
+import hashlib
+import heapq
+import math
+from collections import Counter
+
+EXACT_THRESHOLD = 1000
+TOP_K = 20
+HLL_PRECISION = 12
+
+
+def _hash64(value):
+    """Return a 64-bit hash of a string, stable across processes."""
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'),
+                                          digest_size=8).digest(), 'big')
+
+
+class HyperLogLog:
+    """Estimate the number of distinct strings with the HyperLogLog algorithm.
+
+    Args:
+        precision: int -- the number of hash bits indexing the registers
+    """
+
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+        self._shift = 64 - precision
+        self._mask = (1 << self._shift) - 1
+
+    def add(self, value):
+        """Add a string to the sketch."""
+        hashed = _hash64(value)
+        index = hashed >> self._shift
+        rank = self._shift - (hashed & self._mask).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, other):
+        """Merge another HyperLogLog of the same precision into this one."""
+        self.registers = bytearray(max(a, b) for (a, b) in
+                                   zip(self.registers, other.registers))
+
+    def __len__(self):
+        """Return the estimated number of distinct strings added."""
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / sum(2.0 ** -reg for reg in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * size and zeros:
+            # Small range correction: linear counting
+            estimate = size * math.log(size / zeros)
+        return round(estimate)
+
+
+class SpaceSaving:
+    """Find the most frequent strings with the Space-Saving algorithm.
+
+    At most "capacity" strings are monitored. A string not monitored replaces
+    the monitored one with the smallest count, and inherits that count as
+    its maximum overestimation error.
+
+    Args:
+        capacity: int -- the number of monitored strings
+        counts: Counter -- optional exact counts to start from
+    """
+
+    def __init__(self, capacity, counts=None):
+        self.capacity = capacity
+        self.counts = {}  # {<value>: [count, error]}
+        for (value, count) in (counts or Counter()).most_common(capacity):
+            self.counts[value] = [count, 0]
+        # Min-heap of (count, value), with stale entries removed lazily
+        self._heap = [(count, value) for (value, (count, _)) in self.counts.items()]
+        heapq.heapify(self._heap)
+
+    def add(self, value):
+        """Count one occurrence of a string."""
+        entry = self.counts.get(value)
+        if entry is not None:
+            entry[0] += 1
+        elif len(self.counts) < self.capacity:
+            entry = self.counts[value] = [1, 0]
+        else:
+            while True:
+                (count, victim) = heapq.heappop(self._heap)
+                if self.counts.get(victim, [None])[0] == count:
+                    break
+            del self.counts[victim]
+            entry = self.counts[value] = [count + 1, count]
+        heapq.heappush(self._heap, (entry[0], value))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(count, value) for (value, (count, _)) in self.counts.items()]
+            heapq.heapify(self._heap)
+
+    def most_common(self, num):
+        """Return the num most frequent strings.
+
+        Returns:
+            list of (value, count, error) tuples -- the true count of each
+            value is between count - error and count
+        """
+        entries = sorted(self.counts.items(), key=lambda item: -item[1][0])
+        return [(value, count, error) for (value, (count, error)) in entries[:num]]
+
+
+class ValueSketch:
+    """Profile of the values of one attribute (or one k:v key).
+
+    Args:
+        threshold: int -- the max. number of distinct values kept exactly
+        top: int -- the number of most frequent values reported
+        precision: int -- the precision of the HyperLogLog
+    """
+
+    def __init__(self, threshold=EXACT_THRESHOLD, top=TOP_K,
+                 precision=HLL_PRECISION):
+        self.threshold = threshold
+        self.top = top
+        self.precision = precision
+        self.counts = Counter()  # Exact counts, None once over the threshold
+        self.hll = None
+        self.heavy = None
+
+    def add(self, value):
+        """Count one occurrence of a value."""
+        if self.counts is None:
+            self.hll.add(value)
+            self.heavy.add(value)
+            return
+        self.counts[value] += 1
+        if len(self.counts) > self.threshold:
+            self.hll = HyperLogLog(self.precision)
+            for known in self.counts:
+                self.hll.add(known)
+            # Monitor more values than reported, for more accurate counts
+            self.heavy = SpaceSaving(4 * self.top, self.counts)
+            self.counts = None
+
+    @property
+    def exact(self):
+        """Whether the values are still known exactly."""
+        return self.counts is not None
+
+    def summary(self):
+        """Return the profile as a dict.
+
+        Returns:
+            {'distinct': <(estimated) number of distinct values>,
+             'exact': <bool>,
+             'top': [(<value>, <count>, <max. count error>), ...],
+             'values': <set of all values, only if exact>}
+        """
+        if self.exact:
+            return {'distinct': len(self.counts),
+                    'exact': True,
+                    'top': [(value, count, 0) for (value, count)
+                            in self.counts.most_common(self.top)],
+                    'values': set(self.counts)}
+        return {'distinct': len(self.hll),
+                'exact': False,
+                'top': self.heavy.most_common(self.top)}
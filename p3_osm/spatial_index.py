@@ -0,0 +1,264 @@
+#!/usr/bin/python3
+
+"""Spatial index over the JSON documents of osm_to_json.py (requires numpy).
+
+The index is a static R-tree over the bounding boxes of the documents: the
+position of the nodes ("pos") and the bounding box of the ways whose node
+coordinates are known ("node_pos", see osm_to_json.py --way-coords). The
+leaves are packed with the Sort-Tile-Recursive (STR) algorithm, and each
+tree node covers NODE_SIZE consecutive nodes of the level below. A query
+walks down the tree one level at a time, with vectorised numpy operations.
+
+The coordinates are stored as int32 fixed-point numbers, like in
+node_store.py. The index maps each bounding box to the byte offset of its
+document in the JSON file, and is saved next to the JSON file, e.g. as
+"zurich-area.sidx.npz" for "zurich-area.json".
+
+Example runs (build the index of an existing JSON file, then query it):
+    > ./spatial_index.py zurich-area.json --build
+    > ./spatial_index.py zurich-area.json --bbox 47.36 8.53 47.38 8.55
+    > ./spatial_index.py zurich-area.json --radius 47.3769 8.5417 200
+
+Attributes:
+    NODE_SIZE: int -- the number of children of each R-tree node
+    INDEX_SUFFIX: str -- the suffix replacing ".json" in the index filename
+    EARTH_RADIUS: float -- the mean Earth radius in meters
+"""
+
+import json
+import math
+from array import array
+import numpy as np
+from node_store import SCALE
+
+NODE_SIZE = 16
+INDEX_SUFFIX = ".sidx.npz"
+EARTH_RADIUS = 6371008.8
+
+
+def index_filename(json_filename):
+    """Return the filename of the spatial index of a JSON file."""
+    if json_filename.endswith(".json"):
+        json_filename = json_filename[:-len(".json")]
+    return json_filename + INDEX_SUFFIX
+
+
+def document_bbox(doc):
+    """Return the bounding box (min lat, min lon, max lat, max lon) of a
+    JSON document, or None if its location is not known."""
+    if doc.get('pos') is not None:
+        (lat, lon) = doc['pos']
+        return (lat, lon, lat, lon)
+    coords = [pos for pos in doc.get('node_pos') or () if pos is not None]
+    if not coords:
+        return None
+    lats = [pos[0] for pos in coords]
+    lons = [pos[1] for pos in coords]
+    return (min(lats), min(lons), max(lats), max(lons))
+
+
+def _to_fixed(bbox):
+    """Convert a bounding box to fixed point, rounding it outwards."""
+    return np.array([math.floor(bbox[0] * SCALE), math.floor(bbox[1] * SCALE),
+                     math.ceil(bbox[2] * SCALE), math.ceil(bbox[3] * SCALE)],
+                    dtype=np.int64)
+
+
+def _overlaps(boxes, query):
+    """Return the mask of the boxes (n, 4) intersecting a query box."""
+    return ((boxes[:, 0] <= query[2]) & (boxes[:, 2] >= query[0]) &
+            (boxes[:, 1] <= query[3]) & (boxes[:, 3] >= query[1]))
+
+
+class SpatialIndex:
+    """A packed R-tree mapping bounding boxes to document offsets.
+
+    Args:
+        levels: list of numpy int32 arrays of shape (n, 4) -- the boxes of
+                each tree level, from the leaves (the documents) to the root
+        offsets: numpy int64 array -- the document offsets of the leaves
+        node_size: int -- the number of children of each tree node
+    """
+
+    def __init__(self, levels, offsets, node_size=NODE_SIZE):
+        self.levels = levels
+        self.offsets = offsets
+        self.node_size = node_size
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @classmethod
+    def build(cls, bboxes, offsets, node_size=NODE_SIZE):
+        """Pack an R-tree with the Sort-Tile-Recursive algorithm.
+
+        Args:
+            bboxes: numpy int32 array of shape (n, 4) -- fixed-point boxes
+            offsets: numpy int64 array -- the document offset of each box
+        """
+        count = len(offsets)
+        if count:
+            # Sort into vertical slices by longitude, then each by latitude
+            leaves = -(-count // node_size)
+            slice_size = -(-leaves // math.ceil(math.sqrt(leaves))) * node_size
+            center_lon = bboxes[:, 1].astype(np.int64) + bboxes[:, 3]
+            center_lat = bboxes[:, 0].astype(np.int64) + bboxes[:, 2]
+            order = np.argsort(center_lon, kind='stable')
+            slices = np.arange(count) // slice_size
+            order = order[np.lexsort((center_lat[order], slices))]
+            (bboxes, offsets) = (bboxes[order], offsets[order])
+
+        levels = [bboxes]
+        while len(levels[-1]) > 1:
+            lower = levels[-1]
+            starts = np.arange(0, len(lower), node_size)
+            levels.append(np.column_stack([
+                np.minimum.reduceat(lower[:, 0], starts),
+                np.minimum.reduceat(lower[:, 1], starts),
+                np.maximum.reduceat(lower[:, 2], starts),
+                np.maximum.reduceat(lower[:, 3], starts)]).astype(np.int32))
+        return cls(levels, offsets, node_size)
+
+    @classmethod
+    def load(cls, filename):
+        """Load an index saved with save()."""
+        with np.load(filename) as data:
+            levels = [data['level{}'.format(i)] for i in range(int(data['depth']))]
+            return cls(levels, data['offsets'], int(data['node_size']))
+
+    def save(self, filename):
+        """Save the index to a .npz file."""
+        arrays = {'level{}'.format(i): level for (i, level) in enumerate(self.levels)}
+        np.savez(filename, offsets=self.offsets, depth=len(self.levels),
+                 node_size=self.node_size, **arrays)
+
+    def _query_leaves(self, query):
+        """Return the indices of the leaves intersecting a fixed-point box."""
+        if not len(self.offsets):
+            return np.zeros(0, dtype=np.int64)
+        candidates = np.arange(len(self.levels[-1]))
+        for depth in range(len(self.levels) - 1, 0, -1):
+            candidates = candidates[_overlaps(self.levels[depth][candidates], query)]
+            children = (candidates[:, None] * self.node_size +
+                        np.arange(self.node_size)).ravel()
+            candidates = children[children < len(self.levels[depth - 1])]
+        return candidates[_overlaps(self.levels[0][candidates], query)]
+
+    def query_bbox(self, min_lat, min_lon, max_lat, max_lon):
+        """Find the documents whose bounding box intersects a bounding box.
+
+        Returns:
+            numpy int64 array -- the sorted offsets of the documents
+        """
+        leaves = self._query_leaves(_to_fixed((min_lat, min_lon, max_lat, max_lon)))
+        return np.sort(self.offsets[leaves])
+
+    def query_radius(self, lat, lon, radius):
+        """Find the documents whose bounding box is within a distance (in
+        meters, on a local equirectangular projection) of a point.
+
+        Returns:
+            numpy int64 array -- the sorted offsets of the documents
+        """
+        dlat = math.degrees(radius / EARTH_RADIUS)
+        coslat = max(math.cos(math.radians(lat)), 1e-9)
+        dlon = dlat / coslat
+        leaves = self._query_leaves(_to_fixed((lat - dlat, lon - dlon,
+                                               lat + dlat, lon + dlon)))
+
+        # Distance from the point to the nearest point of each box
+        boxes = self.levels[0][leaves] / SCALE
+        near_lat = np.clip(lat, boxes[:, 0], boxes[:, 2])
+        near_lon = np.clip(lon, boxes[:, 1], boxes[:, 3])
+        dist = EARTH_RADIUS * np.hypot(np.radians(near_lat - lat),
+                                       np.radians(near_lon - lon) * coslat)
+        return np.sort(self.offsets[leaves[dist <= radius]])
+
+
+class IndexBuilder:
+    """Collect the bounding boxes of documents (in compact arrays) and build
+    a SpatialIndex."""
+
+    def __init__(self):
+        self._bboxes = array('i')
+        self._offsets = array('q')
+
+    def add(self, offset, doc):
+        """Add a document written at the given offset of the JSON file."""
+        bbox = document_bbox(doc)
+        if bbox is not None:
+            self.add_bbox(offset, bbox)
+
+    def add_bbox(self, offset, bbox):
+        """Add the bounding box of a document (see document_bbox())."""
+        self._offsets.append(offset)
+        self._bboxes.extend(round(coord * SCALE) for coord in bbox)
+
+    def build(self, node_size=NODE_SIZE):
+        """Return the SpatialIndex of the documents added so far."""
+        bboxes = np.frombuffer(self._bboxes, dtype=np.int32).reshape(-1, 4).copy()
+        offsets = np.frombuffer(self._offsets, dtype=np.int64).copy()
+        return SpatialIndex.build(bboxes, offsets, node_size)
+
+
+def build_from_json(json_filename):
+    """Build the SpatialIndex of a JSON file with one document per line."""
+    builder = IndexBuilder()
+    offset = 0
+    with open(json_filename, 'rb') as inf:
+        for line in inf:
+            builder.add(offset, json.loads(line))
+            offset += len(line)
+    return builder.build()
+
+
+def read_documents(json_filename, offsets):
+    """Read the JSON documents at the given offsets of a JSON file (with one
+    document per line)."""
+    with open(json_filename, 'rb') as inf:
+        for offset in offsets:
+            inf.seek(offset)
+            yield json.loads(inf.readline())
+
+
+def main():
+    """The main function.
+    """
+    import time
+    from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+    parser = ArgumentParser(description=__doc__,
+                            formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("--build", action="store_true",
+                        help="build the index of the JSON file")
+    parser.add_argument("--bbox", type=float, nargs=4,
+                        metavar=("MINLAT", "MINLON", "MAXLAT", "MAXLON"),
+                        help="print the documents within a bounding box")
+    parser.add_argument("--radius", type=float, nargs=3,
+                        metavar=("LAT", "LON", "METERS"),
+                        help="print the documents within a distance of a point")
+    parser.add_argument("filename", metavar="FILE",
+                        help="JSON file output by osm_to_json.py")
+    args = parser.parse_args()
+
+    if args.build:
+        index = build_from_json(args.filename)
+        index.save(index_filename(args.filename))
+        print("> Indexed {} documents in {}".format(len(index),
+                                                   index_filename(args.filename)))
+    else:
+        index = SpatialIndex.load(index_filename(args.filename))
+
+    for (query, params) in (("bbox", args.bbox), ("radius", args.radius)):
+        if params is None:
+            continue
+        start = time.perf_counter()
+        offsets = getattr(index, "query_" + query)(*params)
+        elapsed = time.perf_counter() - start
+        print("> Found {} documents in {:.2f} ms".format(len(offsets), elapsed * 1000))
+        for doc in read_documents(args.filename, offsets):
+            print(json.dumps(doc))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,437 @@
+#!/usr/bin/python3
+
+"""Persistent, incremental cache of the OSM XML schema and value statistics.
+
+The statistics computed by get_xml_schema.py and get_xml_values.py are
+stored in a SQLite database next to the input file ("<file>.cache.sqlite"),
+keyed by the fingerprint (size and modification time) of the file. As long
+as the file does not change, repeated runs of the scripts read the cached
+statistics instead of parsing the file again.
+
+For the incremental mode, the cache also keeps a "ledger": a compact summary
+(tag, attributes and children) of every <node>, <way> and <relation>,
+indexed by element type and id. OSM change files (".osc") can then be applied
+to the cached statistics: the contribution of the old version of each
+created, modified or deleted element is subtracted, and the one of its new
+version is added. So the statistics become identical to those of a full scan
+of the updated extract, without rescanning it. To make this possible, the
+statistics are kept as counters (e.g. of attribute values) instead of sets.
+The applied change files are recorded with the SHA-1 hash of their content,
+so that each one is applied only once, even if it is renamed or moved.
+
+Example run (build the cache with a ledger and print a summary):
+    > ./stats_cache.py --incremental zurich-area.osm.bz2
+
+Attributes:
+    CACHE_SUFFIX: str -- the suffix of the cache database files
+    LEDGER_BATCH_SIZE: int -- number of ledger rows written at once
+"""
+
+import hashlib
+import os
+import pickle
+import re
+import sqlite3
+from collections import Counter
+import open_file
+import xml_parsers
+
+CACHE_SUFFIX = ".cache.sqlite"
+LEDGER_BATCH_SIZE = 10000
+
+_XPATH_RE = re.compile(r"^\.//([\w:/-]+?)(?:\[@([\w:-]+)\])?$")
+
+
+def parse_xpath(xpath):
+    """Parse a limited xpath of the form ".//a/b[@attr]" or ".//a/b".
+
+    Returns:
+        (tags, attr) -- the tuple of the tag names, and the attribute name
+                        (None if not given)
+    """
+    match = _XPATH_RE.match(xpath)
+    if match is None:
+        raise ValueError("Unsupported xpath: " + xpath)
+    return (tuple(match.group(1).split('/')), match.group(2))
+
+
+def summarize(elem):
+    """Return a compact, picklable summary of an element and its children.
+
+    Returns:
+        (tag, ((attribute name, value), ...), (child summary, ...))
+    """
+    return (elem.tag, tuple(elem.attrib.items()),
+            tuple(summarize(child) for child in elem))
+
+
+class Profile:
+    """Schema and value statistics, which can be updated incrementally.
+
+    Args:
+        attr_xpaths: list of str -- xpaths like ".//node[@user]" whose
+                     attribute values are counted (see get_xml_values.py)
+        kv_xpaths: list of str -- xpaths like ".//node/tag" whose k:v pairs
+                   are counted (see get_xml_values.py)
+    """
+
+    def __init__(self, attr_xpaths=(), kv_xpaths=()):
+        self.attr_xpaths = tuple(attr_xpaths)
+        self.kv_xpaths = tuple(kv_xpaths)
+        self.path_counts = Counter()  # {<tag path>: count}
+        self.tag_counts = Counter()  # {<tag>: count}
+        self.attr_counts = {}  # {<tag path>: Counter {<attribute>: count}}
+        self.attr_values = {xpath: Counter() for xpath in self.attr_xpaths}
+        self.kv_values = {xpath: Counter() for xpath in self.kv_xpaths}
+        self._attr_match = [(xpath,) + parse_xpath(xpath) for xpath in self.attr_xpaths]
+        self._kv_match = [(xpath,) + parse_xpath(xpath)[:1] for xpath in self.kv_xpaths]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_attr_match']
+        del state['_kv_match']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attr_match = [(xpath,) + parse_xpath(xpath) for xpath in self.attr_xpaths]
+        self._kv_match = [(xpath,) + parse_xpath(xpath)[:1] for xpath in self.kv_xpaths]
+
+    def add(self, summary, parents=(), sign=1):
+        """Add (sign=1) or subtract (sign=-1) the contribution of an element.
+
+        Args:
+            summary: tuple -- the element summary (see summarize())
+            parents: tuple of str -- the tags of the element's ancestors
+            sign: int -- 1 to add, -1 to subtract
+        """
+        (tag, attrib, children) = summary
+        tags = parents + (tag,)
+        tag_path = '.'.join(tags)
+        self.path_counts[tag_path] += sign
+        self.tag_counts[tag] += sign
+        counter = self.attr_counts.setdefault(tag_path, Counter())
+        for (name, _) in attrib:
+            counter[name] += sign
+
+        # Like ElementTree's findall(), ".//" matches below the root only
+        if parents:
+            attrib = dict(attrib)
+            for (xpath, xtags, attr) in self._attr_match:
+                if tags[-len(xtags):] == xtags and attr in attrib:
+                    self.attr_values[xpath][attrib[attr]] += sign
+            for (xpath, xtags) in self._kv_match:
+                if tags[-len(xtags):] == xtags:
+                    self.kv_values[xpath][(attrib['k'], attrib['v'])] += sign
+
+        for child in children:
+            self.add(child, tags, sign)
+
+    def schema(self):
+        """Return the statistics in the format of get_xml_schema.parse_tree().
+
+        Returns:
+            (tag_tree, tag_tree_counters, tag_counters, attr_counters)
+        """
+        tag_tree_counters = +self.path_counts
+        tag_tree = {}
+        attr_counters = {}
+        for tag_path in tag_tree_counters:
+            counter = +self.attr_counts.get(tag_path, Counter())
+            tag_tree[tag_path] = set(counter)
+            attr_counters[tag_path] = counter
+        return (tag_tree, tag_tree_counters, +self.tag_counts, attr_counters)
+
+    def attr_value_sets(self):
+        """Return the attribute values in the format of
+        get_xml_values.get_attrib_values()."""
+        return {xpath: {value for (value, count) in counter.items() if count > 0}
+                for (xpath, counter) in self.attr_values.items()}
+
+    def kv_value_sets(self):
+        """Return the k:v pairs in the format of get_xml_values.get_kv()."""
+        values = {}
+        for (xpath, counter) in self.kv_values.items():
+            values[xpath] = {}
+            for ((key, val), count) in counter.items():
+                if count > 0:
+                    values[xpath].setdefault(key, set()).add(val)
+        return values
+
+
+def iter_top_elements(inf):
+    """Parse an OSM file and yield the summary of each top-level element.
+
+    Yields:
+        (root summary, None) first, then (summary, elem) for each element
+        directly below the root
+    """
+    depth = 0
+    root = None
+    for (event, elem) in open_file.iterparse(inf, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 1:
+                root = elem
+                yield ((elem.tag, tuple(elem.attrib.items()), ()), None)
+        else:
+            depth -= 1
+            if depth == 1:
+                yield (summarize(elem), elem)
+                elem.clear()
+                root.clear()
+
+
+def _iter_changes(filename):
+    """Parse an OSM change file.
+
+    Yields:
+        (action, summary) tuples, where action is "create", "modify" or
+        "delete"
+    """
+    depth = 0
+    action = None
+    inf = open_file.open_file(filename)
+    for (event, elem) in open_file.iterparse(inf, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 2:
+                action = elem.tag
+        else:
+            depth -= 1
+            if depth == 2:
+                yield (action, summarize(elem))
+                elem.clear()
+    inf.close()
+
+
+def _fingerprint(filename):
+    """Return the (size, mtime) fingerprint of a file."""
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _content_hash(filename):
+    """Return the SHA-1 hash (hex) of the content of a file."""
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as inf:
+        for data in iter(lambda: inf.read(1024 * 1024), b""):
+            sha1.update(data)
+    return sha1.hexdigest()
+
+
+class StatsCache:
+    """The cache database of an OSM file.
+
+    Args:
+        filename: str -- the OSM file whose statistics are cached
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename + CACHE_SUFFIX)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB);
+            CREATE TABLE IF NOT EXISTS profiles (key TEXT PRIMARY KEY, value BLOB);
+            CREATE TABLE IF NOT EXISTS ledger (
+                type TEXT, id INTEGER, summary BLOB, PRIMARY KEY (type, id)
+            ) WITHOUT ROWID;
+            """)
+        if self._get_meta('fingerprint') != _fingerprint(filename):
+            # The file changed: invalidate the whole cache
+            with self.db:
+                self.db.execute("DELETE FROM meta")
+                self.db.execute("DELETE FROM profiles")
+                self.db.execute("DELETE FROM ledger")
+                self._set_meta('fingerprint', _fingerprint(filename))
+                self._set_meta('changes', [])
+                self._set_meta('has_ledger', False)
+
+    def close(self):
+        """Close the database."""
+        self.db.close()
+
+    def _get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def _set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                        (key, pickle.dumps(value)))
+
+    @property
+    def changes(self):
+        """The list of change files applied so far: [path, content hash]."""
+        return self._get_meta('changes')
+
+    @property
+    def has_ledger(self):
+        """Whether the cache contains the ledger for incremental updates."""
+        return self._get_meta('has_ledger')
+
+    def load_profile(self, key):
+        """Return the cached profile with the given key, or None."""
+        row = self.db.execute("SELECT value FROM profiles WHERE key = ?",
+                              (key,)).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def save_profile(self, key, profile):
+        """Store a profile in the cache."""
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO profiles VALUES (?, ?)",
+                            (key, pickle.dumps(profile, pickle.HIGHEST_PROTOCOL)))
+
+    def scan(self, profile, ledger=False):
+        """Fill a profile by a full scan of the file, optionally storing the
+        ledger of its elements."""
+        batch = []
+        static = []
+        inf = open_file.open_file(self.filename)
+        with self.db:
+            if ledger:
+                self.db.execute("DELETE FROM ledger")
+            for (summary, elem) in iter_top_elements(inf):
+                if elem is None:
+                    root = summary
+                    profile.add(root)
+                    continue
+                profile.add(summary, (root[0],))
+                if not ledger:
+                    continue
+                if 'id' in elem.attrib:
+                    batch.append((summary[0], int(elem.attrib['id']),
+                                  pickle.dumps(summary, pickle.HIGHEST_PROTOCOL)))
+                    if len(batch) >= LEDGER_BATCH_SIZE:
+                        self.db.executemany("INSERT OR REPLACE INTO ledger "
+                                            "VALUES (?, ?, ?)", batch)
+                        batch = []
+                else:
+                    static.append(summary)
+            if ledger:
+                self.db.executemany("INSERT OR REPLACE INTO ledger VALUES (?, ?, ?)",
+                                    batch)
+                self._set_meta('root', root)
+                self._set_meta('static', static)
+                self._set_meta('has_ledger', True)
+        inf.close()
+        return profile
+
+    def replay(self, profile):
+        """Fill a profile from the ledger (instead of scanning the file)."""
+        root = self._get_meta('root')
+        profile.add(root)
+        for summary in self._get_meta('static'):
+            profile.add(summary, (root[0],))
+        for (blob,) in self.db.execute("SELECT summary FROM ledger"):
+            profile.add(pickle.loads(blob), (root[0],))
+        return profile
+
+    def apply_changes(self, osc_filename):
+        """Apply an OSM change file to the ledger and all cached profiles."""
+        keys = [key for (key,) in self.db.execute("SELECT key FROM profiles")]
+        profiles = [self.load_profile(key) for key in keys]
+        parents = (self._get_meta('root')[0],)
+
+        with self.db:
+            for (action, summary) in _iter_changes(osc_filename):
+                (tag, attrib, _) = summary
+                elem_id = int(dict(attrib)['id'])
+                row = self.db.execute("SELECT summary FROM ledger WHERE type = ? "
+                                      "AND id = ?", (tag, elem_id)).fetchone()
+                if row:
+                    old = pickle.loads(row[0])
+                    for profile in profiles:
+                        profile.add(old, parents, -1)
+                if action == 'delete':
+                    self.db.execute("DELETE FROM ledger WHERE type = ? AND id = ?",
+                                    (tag, elem_id))
+                else:
+                    for profile in profiles:
+                        profile.add(summary, parents)
+                    self.db.execute("INSERT OR REPLACE INTO ledger VALUES (?, ?, ?)",
+                                    (tag, elem_id,
+                                     pickle.dumps(summary, pickle.HIGHEST_PROTOCOL)))
+            for (key, profile) in zip(keys, profiles):
+                self.db.execute("INSERT OR REPLACE INTO profiles VALUES (?, ?)",
+                                (key, pickle.dumps(profile, pickle.HIGHEST_PROTOCOL)))
+            self._set_meta('changes', self.changes + [[osc_filename,
+                                                       _content_hash(osc_filename)]])
+
+
+def get_profile(filename, attr_xpaths=(), kv_xpaths=(), incremental=False,
+                changes=()):
+    """Return the (cached) statistics profile of an OSM file.
+
+    Args:
+        filename: str -- the OSM file
+        attr_xpaths, kv_xpaths: list of str -- see Profile
+        incremental: bool -- keep the ledger needed for applying change files
+        changes: list of str -- OSM change files (".osc") to apply to the
+                 statistics, in order. Change files already applied to the
+                 cache are skipped.
+
+    Returns:
+        (profile, applied) -- the Profile object, and the list of all change
+                              files applied to it
+    """
+    key = repr((tuple(attr_xpaths), tuple(kv_xpaths)))
+    cache = StatsCache(filename)
+    try:
+        applied = {change[1] for change in cache.changes}
+        pending = []
+        for osc in changes:
+            digest = _content_hash(osc)
+            if digest not in applied:
+                applied.add(digest)
+                pending.append(osc)
+        incremental = incremental or bool(pending)
+
+        profile = cache.load_profile(key)
+        if profile is None or (incremental and not cache.has_ledger):
+            profile = Profile(attr_xpaths, kv_xpaths)
+            if cache.has_ledger:
+                cache.replay(profile)
+            else:
+                cache.scan(profile, ledger=incremental)
+            cache.save_profile(key, profile)
+
+        for osc in pending:
+            cache.apply_changes(osc)
+        if pending:
+            profile = cache.load_profile(key)
+
+        return (profile, [change[0] for change in cache.changes])
+    finally:
+        cache.close()
+
+
+def main():
+    """The main function.
+    """
+    from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+    parser = ArgumentParser(description=__doc__,
+                            formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("-i", "--incremental", action="store_true",
+                        help="keep the ledger needed for applying change files")
+    parser.add_argument("-c", "--changes", action="append", default=[], metavar="OSC",
+                        help="apply an OSM change file to the cached statistics "
+                             "(can be repeated)")
+    parser.add_argument("filename", metavar="FILE",
+                        help="input OSM XML file (can be compressed or uncompressed)")
+    xml_parsers.add_parser_argument(parser)
+    args = parser.parse_args()
+    if args.parser:
+        xml_parsers.set_default(args.parser)
+
+    (profile, applied) = get_profile(args.filename, incremental=args.incremental,
+                                     changes=args.changes)
+    print("> Cache: " + args.filename + CACHE_SUFFIX)
+    for osc in applied:
+        print("> Applied change file: " + osc)
+    for (tag, count) in sorted((+profile.tag_counts).items()):
+        print("> {}: {}".format(tag, count))
+
+
+if __name__ == '__main__':
+    main()
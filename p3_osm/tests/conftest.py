@@ -0,0 +1,214 @@
+"""Shared fixtures of the tests.
+
+The scripts import each other by their plain module names, so the script
+folder is put on the module search path.
+"""
+
+import os
+import random
+import struct
+import sys
+import zlib
+import xml.etree.ElementTree as ET
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def write_osm(outf, nodes, ways=0, relations=0, seed=0):
+    """Write a synthetic OSM XML file to a binary fileobject.
+
+    The nodes get ids 1..nodes, random coordinates around Zurich and some
+    tags; the ways reference random nodes, the relations random ways.
+    """
+    rand = random.Random(seed)
+    keys = ('amenity', 'name', 'highway', 'phone', 'addr:street', 'type')
+    outf.write(b'<?xml version="1.0" encoding="UTF-8"?>\n'
+               b'<osm version="0.6" generator="tests">\n')
+    for node_id in range(1, nodes + 1):
+        tags = rand.sample(keys, rand.randint(0, 3))
+        head = '  <node id="{}" lat="{:.7f}" lon="{:.7f}" version="{}"'.format(
+            node_id, 47.3 + rand.random() / 10, 8.5 + rand.random() / 10,
+            rand.randint(1, 9))
+        if not tags:
+            outf.write((head + '/>\n').encode())
+            continue
+        lines = [head + '>']
+        lines += ['    <tag k="{}" v="v{}"/>'.format(key, rand.randint(0, 50))
+                  for key in tags]
+        lines.append('  </node>\n')
+        outf.write('\n'.join(lines).encode())
+    for way_id in range(1, ways + 1):
+        lines = ['  <way id="{}" version="1">'.format(way_id)]
+        lines += ['    <nd ref="{}"/>'.format(rand.randint(1, nodes))
+                  for _ in range(rand.randint(2, 6))]
+        lines += ['    <tag k="{}" v="v{}"/>'.format(key, rand.randint(0, 50))
+                  for key in rand.sample(keys, rand.randint(0, 2))]
+        lines.append('  </way>\n')
+        outf.write('\n'.join(lines).encode())
+    for rel_id in range(1, relations + 1):
+        lines = ['  <relation id="{}" version="1">'.format(rel_id)]
+        lines += ['    <member type="way" ref="{}" role="outer"/>'.format(
+            rand.randint(1, max(ways, 1))) for _ in range(rand.randint(1, 4))]
+        lines.append('    <tag k="type" v="multipolygon"/>')
+        lines.append('  </relation>\n')
+        outf.write('\n'.join(lines).encode())
+    outf.write(b'</osm>\n')
+
+
+def _varint(value):
+    """Encode a protobuf varint (negative values as 64-bit two's complement)."""
+    value &= (1 << 64) - 1
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _zigzag(value):
+    """Zigzag-encode a signed integer (sint32/sint64)."""
+    return (value << 1) ^ (value >> 63)
+
+
+def _field(number, value):
+    """Encode a varint (int) or length-delimited (bytes) protobuf field."""
+    if isinstance(value, int):
+        return _varint(number << 3) + _varint(value)
+    return _varint(number << 3 | 2) + _varint(len(value)) + value
+
+
+def _packed(number, values):
+    return _field(number, b''.join(_varint(value) for value in values))
+
+
+def _deltas(values):
+    """Delta-code and zigzag-encode a list of integers."""
+    return [_zigzag(value - prev) for (prev, value) in zip([0] + values, values)]
+
+
+def _nanodeg(coord):
+    """Convert a coordinate with 7 decimals, as written by write_osm(), to
+    nanodegrees."""
+    (units, decimals) = coord.split('.')
+    return int(units + decimals.ljust(7, '0')) * 100
+
+
+class _PbfBlock:
+    """Encoder of a PrimitiveBlock, with its string table."""
+
+    GRANULARITY = 100
+    LAT_OFFSET = -10**9
+    LON_OFFSET = 2 * 10**9
+
+    def __init__(self):
+        self.strings = {'': 0}
+        self.groups = []
+
+    def sid(self, string):
+        return self.strings.setdefault(string, len(self.strings))
+
+    def raw(self, nanodeg, offset):
+        return (nanodeg - offset) // self.GRANULARITY
+
+    def tags(self, elem):
+        tags = elem.findall('tag')
+        return (_packed(2, [self.sid(tag.get('k')) for tag in tags]) +
+                _packed(3, [self.sid(tag.get('v')) for tag in tags]))
+
+    def dense(self, nodes):
+        keys_vals = []
+        for node in nodes:
+            for tag in node.findall('tag'):
+                keys_vals += [self.sid(tag.get('k')), self.sid(tag.get('v'))]
+            keys_vals.append(0)
+        self.groups.append(_field(2, (
+            _packed(1, _deltas([int(node.get('id')) for node in nodes])) +
+            _field(5, _packed(1, [int(node.get('version')) for node in nodes])) +
+            _packed(8, _deltas([self.raw(_nanodeg(node.get('lat')), self.LAT_OFFSET)
+                                for node in nodes])) +
+            _packed(9, _deltas([self.raw(_nanodeg(node.get('lon')), self.LON_OFFSET)
+                                for node in nodes])) +
+            _packed(10, keys_vals))))
+
+    def nodes(self, nodes):
+        self.groups.append(b''.join(_field(1, (
+            _field(1, _zigzag(int(node.get('id')))) + self.tags(node) +
+            _field(4, _field(1, int(node.get('version')))) +
+            _field(8, _zigzag(self.raw(_nanodeg(node.get('lat')), self.LAT_OFFSET))) +
+            _field(9, _zigzag(self.raw(_nanodeg(node.get('lon')), self.LON_OFFSET)))))
+            for node in nodes))
+
+    def ways(self, ways):
+        self.groups.append(b''.join(_field(3, (
+            _field(1, int(way.get('id'))) + self.tags(way) +
+            _field(4, _field(1, int(way.get('version')))) +
+            _packed(8, _deltas([int(nd.get('ref')) for nd in way.findall('nd')]))))
+            for way in ways))
+
+    def relations(self, relations):
+        types = ('node', 'way', 'relation')
+        messages = []
+        for rel in relations:
+            members = rel.findall('member')
+            messages.append(_field(4, (
+                _field(1, int(rel.get('id'))) + self.tags(rel) +
+                _field(4, _field(1, int(rel.get('version')))) +
+                _packed(8, [self.sid(member.get('role')) for member in members]) +
+                _packed(9, _deltas([int(member.get('ref')) for member in members])) +
+                _packed(10, [types.index(member.get('type')) for member in members]))))
+        self.groups.append(b''.join(messages))
+
+    def encode(self):
+        strings = sorted(self.strings, key=self.strings.get)
+        return (_field(1, b''.join(_field(1, string.encode('utf-8'))
+                                   for string in strings)) +
+                b''.join(_field(2, group) for group in self.groups) +
+                _field(17, self.GRANULARITY) + _field(19, self.LAT_OFFSET) +
+                _field(20, self.LON_OFFSET))
+
+
+def _write_blob(outf, blob_type, data, compress):
+    if compress:
+        blob = _field(2, len(data)) + _field(3, zlib.compress(data))
+    else:
+        blob = _field(1, data)
+    header = _field(1, blob_type.encode()) + _field(3, len(blob))
+    outf.write(struct.pack('!L', len(header)) + header + blob)
+
+
+def write_pbf(outf, osm_xml, block_size=100):
+    """Convert the bytes of an OSM XML file written by write_osm() to an OSM
+    PBF file, written to a binary fileobject.
+
+    The blocks of block_size elements alternate between dense and plain
+    nodes, and between zlib-compressed and raw blobs.
+    """
+    root = ET.fromstring(osm_xml)
+    header = (_field(4, b'OsmSchema-V0.6') + _field(4, b'DenseNodes') +
+              _field(16, root.get('generator').encode()))
+    _write_blob(outf, 'OSMHeader', header, True)
+    elements = list(root)
+    for start in range(0, len(elements), block_size):
+        number = start // block_size
+        block = _PbfBlock()
+        chunk = elements[start:start + block_size]
+        for tag in ('node', 'way', 'relation'):
+            group = [elem for elem in chunk if elem.tag == tag]
+            if not group:
+                continue
+            if tag == 'node':
+                (block.dense if number % 2 == 0 else block.nodes)(group)
+            else:
+                getattr(block, tag + 's')(group)
+        _write_blob(outf, 'OSMData', block.encode(), number % 2 == 0)
+
+
+@pytest.fixture(scope='session')
+def osm_data():
+    """The bytes of a synthetic OSM XML file of about 1 MB."""
+    import io
+    buf = io.BytesIO()
+    write_osm(buf, nodes=6000, ways=1500, relations=200)
+    return buf.getvalue()
@@ -0,0 +1,44 @@
+"""Tests of bz2_parallel.py."""
+
+import bz2
+import io
+import random
+import pytest
+import bz2_parallel
+
+
+@pytest.fixture(scope='module')
+def bz2_data(osm_data):
+    """A multi-stream bzip2 file (like pbzip2 output) of several 100 KB
+    blocks, and its decompressed data."""
+    data = osm_data + bytes(random.Random(1).getrandbits(8) for _ in range(150000))
+    half = len(data) // 2
+    compressed = (bz2.compress(data[:half], compresslevel=1) +
+                  bz2.compress(data[half:], compresslevel=1))
+    return (compressed, data)
+
+
+def test_parallel_reader_equals_bz2(tmp_path, bz2_data):
+    (compressed, data) = bz2_data
+    path = tmp_path / "area.osm.bz2"
+    path.write_bytes(compressed)
+    with bz2_parallel.open_parallel(str(path), jobs=3) as inf:
+        parallel = inf.read()
+    with bz2.open(str(path)) as inf:
+        assert parallel == inf.read() == data
+
+
+def test_iter_blocks_small_reads(bz2_data):
+    """The blocks are found also across the boundaries of the reads."""
+    (compressed, data) = bz2_data
+    blocks = list(bz2_parallel.iter_blocks(io.BytesIO(compressed), read_size=4096))
+    assert len(blocks) > 4
+    assert all(start < end for (start, end, _) in blocks)
+    assert b"".join(bz2_parallel.decompress_block(stream)
+                    for (_, _, stream) in blocks) == data
+
+
+def test_truncated_file(bz2_data):
+    (compressed, _) = bz2_data
+    with pytest.raises(IOError):
+        list(bz2_parallel.iter_blocks(io.BytesIO(compressed[:-20])))
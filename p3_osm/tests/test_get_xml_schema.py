@@ -0,0 +1,103 @@
+"""Tests of get_xml_schema.py."""
+
+import bz2
+import gzip
+import io
+import os
+import subprocess
+import sys
+import pytest
+import get_xml_schema
+import open_file
+
+
+def _write(path, data, compression):
+    """Write the OSM data uncompressed or compressed in several independent
+    pieces (bzip2 blocks of 100 KB, gzip members of 64 KB), so that the file
+    can be split into several chunks."""
+    if compression == 'bz2':
+        path.write_bytes(bz2.compress(data, compresslevel=1))
+    elif compression == 'gz':
+        path.write_bytes(b"".join(gzip.compress(data[i:i + 64 * 1024])
+                                  for i in range(0, len(data), 64 * 1024)))
+    else:
+        path.write_bytes(data)
+
+
+@pytest.mark.parametrize('engine', ['expat', 'iterparse'])
+@pytest.mark.parametrize('compression', ['osm', 'bz2', 'gz'])
+def test_parallel_schema_equals_serial(tmp_path, osm_data, engine, compression):
+    """The chunked parallel parse gives the same statistics as the serial one."""
+    path = tmp_path / ("area.osm" if compression == 'osm' else
+                       "area.osm." + compression)
+    _write(path, osm_data, compression)
+
+    serial_attr_counters = {}
+    serial = get_xml_schema._parse(open_file.open_file(str(path)), engine,
+                                   serial_attr_counters)
+    parallel_attr_counters = {}
+    parallel = get_xml_schema.parse_chunked(str(path), 2, engine,
+                                            parallel_attr_counters)
+
+    assert parallel == serial
+    assert parallel_attr_counters == serial_attr_counters
+    assert serial[2]['node'] == 6000
+    assert serial[2]['osm'] == 1
+
+
+def test_parallel_output_equals_serial(tmp_path, osm_data):
+    """The printed statistics of a parallel run are byte for byte those of a
+    serial run, although the order of the sets and Counters in memory differs
+    (also between interpreters, with other string hash seeds)."""
+    path = tmp_path / "area.osm.bz2"
+    _write(path, osm_data, 'bz2')
+    script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                          "get_xml_schema.py")
+    outputs = []
+    for (jobs, seed) in (("1", "1"), ("2", "2"), ("3", "3")):
+        outputs.append(subprocess.check_output(
+            [sys.executable, script, "-a", "-c", "-f", "-t", "-j", jobs, str(path)],
+            env=dict(os.environ, PYTHONHASHSEED=seed)))
+    assert outputs[0] == outputs[1] == outputs[2]
+    assert b"'osm.node': 6000" in outputs[0]
+
+
+# Attributes found on some elements only, in varying order and combinations,
+# and the same tag (tag) at several paths
+VARIED_XML = b"""<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+  <bounds minlat="47.3" minlon="8.5" maxlat="47.4" maxlon="8.6"/>
+  <node id="1" lat="47.31" lon="8.51"/>
+  <node id="2" lat="47.32" lon="8.52" visible="true" user="a" uid="7">
+    <tag k="amenity" v="cafe"/>
+  </node>
+  <node lon="8.53" id="3" lat="47.33" user="b"/>
+  <node id="4" visible="false" lat="47.34" lon="8.54"><tag k="name" v="x"/></node>
+  <way id="5" version="2"><nd ref="1"/><nd ref="2" extra="y"/><tag k="a" v="b"/></way>
+  <relation id="6">
+    <member type="way" ref="5" role=""/>
+    <member type="node" ref="1"/>
+    <tag k="type" v="multipolygon"/>
+  </relation>
+</osm>
+"""
+
+
+@pytest.mark.parametrize('source', ['varied', 'fixture'])
+def test_fast_parse_equals_parse_tree(osm_data, source):
+    """parse_tree_fast() gives the tag_tree, tag_tree_counters, tag_counters
+    and attribute counters of parse_tree()."""
+    data = VARIED_XML if source == 'varied' else osm_data
+    expected_attr_counters = {}
+    expected = get_xml_schema.parse_tree(io.BytesIO(data), expected_attr_counters)
+    attr_counters = {}
+    result = get_xml_schema.parse_tree_fast(io.BytesIO(data), attr_counters)
+
+    assert result[0] == expected[0]
+    assert result[1] == expected[1]
+    assert result[2] == expected[2]
+    assert attr_counters == expected_attr_counters
+    if source == 'varied':
+        assert expected[0]['osm.node'] == {'id', 'lat', 'lon', 'visible', 'user', 'uid'}
+        assert expected_attr_counters['osm.node']['visible'] == 2
+        assert expected_attr_counters['osm.way.nd'] == {'ref': 2, 'extra': 1}
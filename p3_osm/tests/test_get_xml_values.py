@@ -0,0 +1,80 @@
+"""Tests of get_xml_values.py."""
+
+import io
+import re
+import xml.etree.ElementTree as ET
+import pytest
+import get_xml_values
+
+# Attributes missing on some elements, and tags matching only some xpaths
+# (e.g. "member" elements outside of relations)
+VARIED_XML = b"""<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6" user="root">
+  <node id="1" lat="47.31" lon="8.51" user="a"/>
+  <node id="2" lat="47.32" lon="8.52"><tag k="amenity" v="cafe"/></node>
+  <way id="3" user="b"><nd ref="1"/><tag k="amenity" v="bar"/></way>
+  <relation id="4" user="a">
+    <member type="way" ref="3" role="outer"/>
+    <member type="node" ref="1"/>
+    <tag k="type" v="multipolygon"/>
+  </relation>
+  <member type="node" ref="2" role="stray"/>
+</osm>
+"""
+
+
+@pytest.fixture(params=['varied', 'fixture'])
+def xml_data(request, osm_data):
+    return VARIED_XML if request.param == 'varied' else osm_data
+
+
+def _findall_attrib_values(data, xpaths):
+    """The attribute values found with ElementTree.findall() on the whole
+    parsed document (the original implementation of get_attrib_values())."""
+    tree = ET.parse(io.BytesIO(data))
+    values = {}
+    for path in xpaths:
+        attr = re.search(r"\[@(.*)\]", path).group(1)
+        values[path] = {elem.attrib[attr] for elem in tree.findall(path)
+                        if attr in elem.attrib}
+    return values
+
+
+def test_attrib_values_equal_findall(xml_data):
+    """The single pass over all the xpaths finds the values of findall()."""
+    values = get_xml_values.get_attrib_values(io.BytesIO(xml_data),
+                                              get_xml_values.ATTR_XPATHS)
+    assert values == _findall_attrib_values(xml_data, get_xml_values.ATTR_XPATHS)
+    assert any(values.values())
+
+
+def test_iter_matches_document_order():
+    matches = [(xpath, elem.get('id') or elem.get('ref'))
+               for (xpath, elem) in get_xml_values.iter_matches(
+                   io.BytesIO(VARIED_XML), [".//node[@user]", ".//relation/member",
+                                            ".//osm[@user]"])]
+    assert matches == [(".//node[@user]", "1"), (".//relation/member", "3"),
+                       (".//relation/member", "1")]
+
+
+def _findall_kv(data, xpaths):
+    """The k:v values found with findall() (the original get_kv())."""
+    tree = ET.parse(io.BytesIO(data))
+    values = {}
+    for path in xpaths:
+        values[path] = {}
+        for elem in tree.findall(path):
+            values[path].setdefault(elem.attrib['k'], set()).add(elem.attrib['v'])
+    return values
+
+
+def test_values_equal_findall(xml_data):
+    """The attribute values and k:v pairs harvested in one pass are those of
+    the separate findall() passes."""
+    (attr_values, kv_values) = get_xml_values.get_values(
+        io.BytesIO(xml_data), get_xml_values.ATTR_XPATHS, get_xml_values.KV_XPATHS)
+    assert attr_values == _findall_attrib_values(xml_data, get_xml_values.ATTR_XPATHS)
+    assert kv_values == _findall_kv(xml_data, get_xml_values.KV_XPATHS)
+    assert get_xml_values.get_kv(io.BytesIO(xml_data),
+                                 get_xml_values.KV_XPATHS) == kv_values
+    assert kv_values[".//node/tag"]
@@ -0,0 +1,62 @@
+"""Tests of node_store.py."""
+
+import io
+import math
+import numpy as np
+import node_store
+from conftest import write_osm
+
+
+def _store(nodes):
+    """Build a store from {<node id>: (lat, lon)}, added in unsorted order."""
+    builder = node_store.NodeStoreBuilder()
+    for (node_id, (lat, lon)) in sorted(nodes.items(), reverse=True):
+        builder.add(str(node_id), str(lat), str(lon))
+    return builder.build()
+
+
+def test_lookup_found_and_not_found():
+    store = _store({5: (47.3769, 8.5417), 2: (-33.8688, 151.2093),
+                    9: (0.0000001, -179.9999999)})
+    (coords, found) = store.lookup([2, 3, 9, 5, 1, 10, 5])
+    assert found.tolist() == [True, False, True, True, False, False, True]
+    assert coords[0].tolist() == [-33.8688, 151.2093]
+    assert coords[2].tolist() == [0.0000001, -179.9999999]
+    assert coords[3].tolist() == coords[6].tolist() == [47.3769, 8.5417]
+    assert all(math.isnan(value) for value in coords[~found].ravel())
+    assert store.lookup_list(["9", "4"]) == [[0.0000001, -179.9999999], None]
+
+
+def test_empty_store():
+    store = node_store.NodeStoreBuilder().build()
+    assert len(store) == 0
+    (_, found) = store.lookup([1, 2])
+    assert not found.any()
+    assert store.lookup_list([1]) == [None]
+
+
+def test_updated():
+    """Changed nodes move, deleted ones (None) are not found anymore, new
+    ones are added, by int or str ids; the old store does not change."""
+    store = _store({1: (47.0, 8.0), 2: (47.1, 8.1), 3: (47.2, 8.2)})
+    new = store.updated({'2': (46.5, 7.5), 3: None, 7: (45.0, 7.0), '8': None})
+    assert new.lookup_list([1, 2, 3, 7, 8]) == [
+        [47.0, 8.0], [46.5, 7.5], None, [45.0, 7.0], None]
+    assert new.ids.tolist() == [1, 2, 7]
+    assert store.lookup_list([2, 3, 7]) == [[47.1, 8.1], [47.2, 8.2], None]
+
+
+def test_build_store_save_load(tmp_path):
+    buf = io.BytesIO()
+    write_osm(buf, 500, ways=10)
+    buf.seek(0)
+    store = node_store.build_store(buf)
+    assert len(store) == 500
+    assert np.all(store.ids[1:] > store.ids[:-1])
+
+    prefix = str(tmp_path / "area-nodes")
+    store.save(prefix)
+    loaded = node_store.NodeStore.load(prefix)
+    assert isinstance(loaded.ids, np.memmap)
+    assert loaded.lookup_list(range(0, 502)) == store.lookup_list(range(0, 502))
+    assert loaded.lookup_list([0, 501]) == [None, None]
@@ -0,0 +1,146 @@
+"""Tests of open_file.py."""
+
+import bz2
+import io
+import tarfile
+import zipfile
+import pytest
+import open_file
+
+
+def _read_in(inf, sizes):
+    """Read a fileobject in reads of the given sizes, cycled, until EOF."""
+    parts = []
+    i = 0
+    while True:
+        part = inf.read(sizes[i % len(sizes)])
+        if not part:
+            return b"".join(parts)
+        parts.append(part)
+        i += 1
+
+
+@pytest.mark.parametrize('sizes', [[-1], [1, 7, 4096], [3 * 1024 * 1024]])
+def test_prefetch_reader_equals_plain_read(osm_data, sizes):
+    """The read-ahead chunks (smaller than the file) are returned in order,
+    for any read sizes."""
+    with open_file.PrefetchReader(io.BytesIO(osm_data), chunks=2,
+                                  chunk_size=64 * 1024) as inf:
+        assert _read_in(inf, sizes) == osm_data
+        assert inf.stats()['bytes'] == len(osm_data)
+
+
+def test_prefetch_reader_decompresses(tmp_path, osm_data):
+    path = tmp_path / "area.osm.bz2"
+    path.write_bytes(bz2.compress(osm_data))
+    with open_file.open_file(str(path), prefetch=4) as inf:
+        assert isinstance(inf, open_file.PrefetchReader)
+        assert _read_in(inf, [10000]) == osm_data
+
+
+def test_prefetch_reader_raises_errors():
+    """An error of the wrapped fileobject is raised by the reader."""
+    with open_file.PrefetchReader(bz2.BZ2File(io.BytesIO(b"BZh9 not bzip2"))) as inf:
+        with pytest.raises(OSError):
+            inf.read()
+
+
+def test_prefetch_reader_close_early(osm_data):
+    """Closing the reader before the end stops the read-ahead thread."""
+    inf = open_file.PrefetchReader(io.BytesIO(osm_data), chunks=1, chunk_size=1024)
+    assert inf.read(10) == osm_data[:10]
+    inf.close()
+    assert inf.closed
+
+
+@pytest.mark.parametrize('advice', [open_file.MMAP_ADVICE, None])
+def test_mmap_reader_equals_plain_read(tmp_path, osm_data, advice):
+    path = tmp_path / "area.osm"
+    path.write_bytes(osm_data)
+    with open_file.MmapReader(str(path), advice) as inf:
+        assert len(inf) == len(osm_data)
+        assert _read_in(inf, [1, 7, 4096]) == osm_data
+        assert inf.read() == b""
+
+        inf.seek(1000)
+        assert inf.read(50) == osm_data[1000:1050]
+        assert inf.tell() == 1050
+        inf.seek(-10, io.SEEK_END)
+        assert inf.read() == osm_data[-10:]
+        buf = bytearray(100)
+        inf.seek(20)
+        assert inf.readinto(buf) == 100
+        assert bytes(buf) == osm_data[20:120]
+
+        view = inf.view(100, 200)
+        assert view == osm_data[100:200]
+        view.release()
+
+
+def test_open_file_maps_uncompressed_files(tmp_path, osm_data):
+    """Uncompressed files are memory-mapped, and parsed like a plain file."""
+    path = tmp_path / "area.osm"
+    path.write_bytes(osm_data)
+    inf = open_file.open_file(str(path))
+    assert isinstance(inf, open_file.MmapReader)
+    tags = [elem.tag for elem in open_file.iter_elements(inf, ('node', 'way'))]
+    assert tags == [elem.tag for elem in open_file.iter_elements(
+        io.BytesIO(osm_data), ('node', 'way'))]
+    assert len(tags) == 7500
+    inf.close()
+
+    empty = tmp_path / "empty.osm"
+    empty.write_bytes(b"")
+    with open_file.open_file(str(empty)) as inf:
+        assert inf.read() == b""
+
+
+def _member_size(name, inf):
+    """The data size of an archive member (a picklable map_members() func)."""
+    return len(inf.read())
+
+
+@pytest.fixture()
+def members(osm_data):
+    return [("a.osm", osm_data[:1000]), ("dir/b.osm", osm_data),
+            ("c.osm", b"")]
+
+
+def _write_archive(path, members):
+    if path.suffix == '.zip':
+        with zipfile.ZipFile(str(path), 'w', zipfile.ZIP_DEFLATED) as zipf:
+            zipf.writestr("dir/", b"")
+            for (name, data) in members:
+                zipf.writestr(name, data)
+        return
+    mode = {'.tar': 'w', '.tgz': 'w:gz', '.bz2': 'w:bz2'}[path.suffix]
+    with tarfile.open(str(path), mode) as tar:
+        info = tarfile.TarInfo("dir")
+        info.type = tarfile.DIRTYPE
+        tar.addfile(info)
+        for (name, data) in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+@pytest.mark.parametrize('archive', ['area.zip', 'area.tar', 'area.tgz', 'area.tar.bz2'])
+def test_iter_members(tmp_path, members, archive):
+    """The files of zip and (compressed) tar archives are read in order, the
+    directories are skipped."""
+    path = tmp_path / archive
+    _write_archive(path, members)
+    assert [(name, inf.read()) for (name, inf) in
+            open_file.iter_members(str(path))] == members
+
+    for jobs in (1, 2):
+        assert open_file.map_members(str(path), _member_size, jobs) == [
+            (name, len(data)) for (name, data) in members]
+
+
+def test_iter_members_plain_file(tmp_path, osm_data):
+    """A file which is not an archive is its only member."""
+    path = tmp_path / "area.osm.bz2"
+    path.write_bytes(bz2.compress(osm_data))
+    assert [(name, inf.read()) for (name, inf) in
+            open_file.iter_members(str(path))] == [(str(path), osm_data)]
@@ -0,0 +1,86 @@
+"""Tests of osm_changes.py."""
+
+import io
+import json
+import open_file
+import osm_changes
+import osm_to_json
+from conftest import write_osm
+
+OSC = b"""<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6">
+  <modify>
+    <way id="7" version="2">
+      <nd ref="1"/>
+      <nd ref="2"/>
+      <tag k="type" v="multipolygon"/>
+      <tag k="id" v="42"/>
+    </way>
+  </modify>
+  <delete>
+    <node id="3" version="2"/>
+  </delete>
+  <create>
+    <node id="1001" lat="47.3000000" lon="8.5000000" version="1">
+      <tag k="type" v="node"/>
+    </node>
+  </create>
+</osmChange>
+"""
+
+
+def _read_docs(json_filename, index):
+    """Return the documents of a JSON file by element type and id, using its
+    offset index (the "type" and "id" fields can be replaced by tags)."""
+    with open(json_filename, 'rb') as inf:
+        data = inf.read()
+    docs = {}
+    for (key, offset, length) in zip(index.keys, index.offsets, index.lengths):
+        elem_key = (osm_changes.TYPES[key % len(osm_changes.TYPES)],
+                    str(key // len(osm_changes.TYPES)))
+        docs[elem_key] = json.loads(data[offset:offset + length].decode())
+    assert sum(index.lengths) == len(data)
+    return docs
+
+
+def test_iter_changes_element_type():
+    """The changes have the type and id of their XML element, which tags
+    replace in the documents."""
+    changes = list(osm_changes.iter_changes(io.BytesIO(OSC)))
+    assert [change[:3] for change in changes] == [
+        ('modify', 'way', '7'), ('delete', 'node', '3'), ('create', 'node', '1001')]
+    assert changes[0][3]['type'] == 'multipolygon'
+    assert changes[0][3]['id'] == '42'
+    assert changes[2][3]['type'] == 'node'
+
+
+def test_apply_to_json(tmp_path):
+    """The changes of documents with "type" (and "id") tags are applied, the
+    other documents are kept as they are."""
+    path = tmp_path / "area.osm"
+    with open(str(path), 'wb') as outf:
+        write_osm(outf, 200, ways=50)
+    builder = osm_changes.OffsetIndexBuilder()
+    osm_to_json.process_map(open_file.open_file(str(path)), str(tmp_path / "area"),
+                            stream=True, offset_index=builder)
+    json_filename = str(tmp_path / "area.json")
+    index = builder.build()
+    before = _read_docs(json_filename, index)
+    assert len(before) == 250
+    assert any(doc['type'] != key[0] for (key, doc) in before.items())
+
+    osc = tmp_path / "day1.osc"
+    osc.write_bytes(OSC)
+    index = osm_changes.apply_to_json(osm_changes.load_changes(str(osc)),
+                                      json_filename, index)
+
+    after = _read_docs(json_filename, index)
+    assert after[('way', '7')]['type'] == 'multipolygon'
+    assert after[('way', '7')]['id'] == '42'
+    assert after[('way', '7')]['node_refs'] == ['1', '2']
+    assert ('node', '3') not in after
+    assert after[('node', '1001')]['pos'] == [47.3, 8.5]
+    assert len(after) == len(before)
+    for (key, doc) in before.items():
+        if key not in (('way', '7'), ('node', '3')):
+            assert after[key] == doc
@@ -0,0 +1,83 @@
+"""Tests of osm_columns.py."""
+
+import io
+import xml.etree.ElementTree as ET
+import numpy as np
+import open_file
+import osm_columns
+import osm_filters
+from conftest import write_osm
+from node_store import SCALE
+from osm_to_json import classify_key
+
+
+def _tags(columns, strings, i):
+    """The tags of the element i, decoded from the columns."""
+    keys = list(strings['keys'])
+    values = list(strings['values'])
+    (start, end) = columns['tag_offsets'][i:i + 2]
+    return [(keys[columns['tag_keys'][j]], values[columns['tag_values'][j]])
+            for j in range(start, end)]
+
+
+def test_round_trip(tmp_path):
+    """The columns read back give the ids, positions, versions (MISSING for
+    the absent numbers), kept tags and node refs of the XML elements, in file order."""
+    buf = io.BytesIO()
+    write_osm(buf, 300, ways=40, relations=5)
+    data = buf.getvalue()
+    path = tmp_path / "area.osm"
+    path.write_bytes(data)
+    prefix = str(tmp_path / "area")
+    (count, filenames) = osm_columns.write_columns(open_file.open_file(str(path)), prefix)
+    assert count == 340
+    assert all((tmp_path / name).exists() for name in filenames)
+
+    tree = ET.fromstring(data)
+    strings = osm_columns.load_tag_strings(prefix)
+    for doc_type in osm_columns.TYPES:
+        columns = osm_columns.load_columns(prefix, doc_type)
+        assert isinstance(columns['id'], np.memmap)
+        elements = tree.findall(doc_type)
+        assert columns['id'].tolist() == [int(elem.get('id')) for elem in elements]
+        for (i, elem) in enumerate(elements):
+            assert columns['version'][i] == int(elem.get('version'))
+            assert columns['timestamp'][i] == columns['uid'][i] == osm_columns.MISSING
+            assert _tags(columns, strings, i) == [
+                (tag.get('k'), tag.get('v')) for tag in elem.iter('tag')
+                if classify_key(tag.get('k')) is not None]
+            if doc_type == 'node':
+                assert (columns['pos'][i] / SCALE).tolist() == [
+                    float(elem.get('lat')), float(elem.get('lon'))]
+            else:
+                (start, end) = columns['node_offsets'][i:i + 2]
+                assert columns['node_refs'][start:end].tolist() == [
+                    int(nd.get('ref')) for nd in elem.iter('nd')]
+
+    nodes = osm_columns.load_columns(prefix, 'node', mmap=False)
+    mask = osm_columns.tag_mask(nodes, strings, 'amenity')
+    assert nodes['id'][mask].tolist() == [
+        int(elem.get('id')) for elem in tree.findall("node[tag]")
+        if elem.find("tag[@k='amenity']") is not None]
+    assert mask.any()
+    assert not osm_columns.tag_mask(nodes, strings, 'amenity', 'no such value').any()
+
+
+def test_parse_timestamp():
+    assert osm_columns.parse_timestamp("2013-08-03T16:43:42Z") == 1375548222
+    assert osm_columns.parse_timestamp("1970-01-01T00:00:00Z") == 0
+
+
+def test_element_filter(tmp_path):
+    """Only the matching elements are exported."""
+    buf = io.BytesIO()
+    write_osm(buf, 200, ways=20)
+    buf.seek(0)
+    prefix = str(tmp_path / "area")
+    element_filter = osm_filters.ElementFilter(types={'node'}, keys={'amenity'})
+    (count, _) = osm_columns.write_columns(buf, prefix, element_filter)
+    nodes = osm_columns.load_columns(prefix, 'node')
+    strings = osm_columns.load_tag_strings(prefix)
+    assert count == len(nodes['id']) > 0
+    assert osm_columns.tag_mask(nodes, strings, 'amenity').all()
+    assert len(osm_columns.load_columns(prefix, 'way')['id']) == 0
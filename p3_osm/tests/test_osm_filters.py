@@ -0,0 +1,70 @@
+"""Tests of osm_filters.py."""
+
+import argparse
+import fnmatch
+import io
+import xml.etree.ElementTree as ET
+import pytest
+import osm_filters
+import osm_to_json
+
+BBOX = (47.32, 8.52, 47.36, 8.56)
+
+
+def _post_filter(data, types=None, bbox=None, keys=None, values=None):
+    """The documents of all the elements, filtered after the conversion with
+    the raw XML elements."""
+    tree = ET.fromstring(data)
+    docs = osm_to_json.iter_documents(io.BytesIO(data))
+    in_bbox = set()
+    kept = []
+    elements = [elem for elem in tree if elem.tag in osm_filters.TYPES]
+    for (elem, doc) in zip(elements, docs):
+        if elem.tag == 'node' and bbox:
+            lat = float(elem.get('lat'))
+            lon = float(elem.get('lon'))
+            if bbox[0] <= lat <= bbox[2] and bbox[1] <= lon <= bbox[3]:
+                in_bbox.add(elem.get('id'))
+        tags = {tag.get('k'): tag.get('v') for tag in elem.iter('tag')}
+        if types and elem.tag not in types:
+            continue
+        if bbox and not (elem.get('id') in in_bbox if elem.tag == 'node' else
+                         any(nd.get('ref') in in_bbox for nd in elem.iter('nd'))):
+            continue
+        if keys and not any(fnmatch.fnmatchcase(key, pattern)
+                            for key in tags for pattern in keys):
+            continue
+        if values and not any(tags.get(key) in vals for (key, vals) in values.items()):
+            continue
+        kept.append(doc)
+    return kept
+
+
+@pytest.mark.parametrize('options', [
+    {'types': ['way']},
+    {'keys': ['amenity', 'addr:*']},
+    {'values': {'amenity': {'v1', 'v2'}, 'highway': {'v3'}}},
+    {'bbox': BBOX},
+    {'types': ['way'], 'bbox': BBOX},
+    {'types': ['node'], 'bbox': BBOX, 'keys': ['name'], 'values': {'phone': {'v5', 'v6'}}},
+])
+def test_filter_equals_post_filter(osm_data, options):
+    """Filtering the elements before the conversion keeps the documents of
+    filtering all of them afterwards."""
+    element_filter = osm_filters.ElementFilter(**options)
+    filtered = list(osm_to_json.iter_documents(io.BytesIO(osm_data),
+                                               element_filter=element_filter))
+    assert filtered == _post_filter(osm_data, **options)
+    assert filtered
+
+
+def test_filter_from_args():
+    parser = argparse.ArgumentParser()
+    osm_filters.add_filter_arguments(parser)
+    assert osm_filters.filter_from_args(parser.parse_args([])) is None
+    element_filter = osm_filters.filter_from_args(parser.parse_args(
+        ['--type', 'node', '--tag', 'amenity=bar,cafe', '--tag', 'amenity=pub']))
+    assert element_filter.types == {'node'}
+    assert element_filter.values == {'amenity': {'bar', 'cafe', 'pub'}}
+    with pytest.raises(ValueError):
+        osm_filters.parse_tag_spec("amenity")
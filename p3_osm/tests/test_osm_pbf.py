@@ -0,0 +1,84 @@
+"""Tests of osm_pbf.py, on PBF files converted from the synthetic OSM XML
+data by conftest.write_pbf()."""
+
+import io
+import xml.etree.ElementTree as ET
+import pytest
+import get_xml_schema
+import open_file
+import osm_pbf
+import osm_to_json
+from conftest import _varint, _zigzag, write_osm, write_pbf
+
+
+@pytest.fixture(scope='module')
+def osm_xml():
+    buf = io.BytesIO()
+    write_osm(buf, 400, ways=80, relations=20)
+    return buf.getvalue()
+
+
+@pytest.fixture()
+def pbf_path(tmp_path, osm_xml):
+    path = tmp_path / "area.osm.pbf"
+    with open(str(path), 'wb') as outf:
+        write_pbf(outf, osm_xml)
+    return path
+
+
+def _elements(events):
+    """The top-level elements of iterparse() events, as comparable tuples."""
+    return [(elem.tag, elem.attrib, [(child.tag, child.attrib) for child in elem])
+            for (_, elem) in events if elem.tag in ('node', 'way', 'relation')]
+
+
+@pytest.mark.parametrize('value', [0, 1, 127, 128, 300, 2**31, 2**63 - 1])
+def test_varint(value):
+    encoded = b"\xff" + _varint(value)
+    assert osm_pbf._varint(encoded, 1) == (value, len(encoded))
+
+
+@pytest.mark.parametrize('value', [0, -1, 1, -64, 2**40, -2**40, -2**63])
+def test_zigzag_and_signed(value):
+    assert osm_pbf._zigzag(_zigzag(value) & (2**64 - 1)) == value
+    assert osm_pbf._signed(osm_pbf._varint(_varint(value), 0)[0]) == value
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_elements_equal_xml(pbf_path, osm_xml, jobs):
+    """The dense and plain nodes, ways (node refs) and relations (members) of
+    the raw and zlib blobs are the elements of the XML file, also when the
+    blobs are decoded by worker processes."""
+    with osm_pbf.PbfFile(str(pbf_path), jobs) as pbf:
+        elements = _elements(pbf.iterparse())
+    expected = _elements(ET.iterparse(io.BytesIO(osm_xml)))
+    assert len(elements) == 500
+    assert elements == expected
+
+
+def test_prefetch(pbf_path, osm_xml):
+    """open_file() reads PBF files ahead if asked to."""
+    with open_file.open_file(str(pbf_path), prefetch=2) as pbf:
+        assert isinstance(pbf._file.raw, open_file.PrefetchReader)
+        elements = _elements(pbf.iterparse())
+    assert elements == _elements(ET.iterparse(io.BytesIO(osm_xml)))
+
+
+def test_documents_equal_xml(pbf_path, tmp_path, osm_xml):
+    """osm_to_json converts the PBF file to the documents of the XML file."""
+    xml_path = tmp_path / "area.osm"
+    xml_path.write_bytes(osm_xml)
+    docs = list(osm_to_json.iter_documents(open_file.open_file(str(pbf_path))))
+    assert docs == list(osm_to_json.iter_documents(open_file.open_file(str(xml_path))))
+    assert len(docs) == 480
+
+
+def test_schema_equals_xml(pbf_path, osm_xml):
+    """get_xml_schema finds the tags and attributes of the XML file."""
+    pbf_attr_counters = {}
+    pbf_result = get_xml_schema.parse_tree(open_file.open_file(str(pbf_path)),
+                                           pbf_attr_counters)
+    xml_attr_counters = {}
+    xml_result = get_xml_schema.parse_tree(io.BytesIO(osm_xml), xml_attr_counters)
+    assert pbf_result == xml_result
+    assert pbf_attr_counters == xml_attr_counters
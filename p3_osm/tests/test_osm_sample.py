@@ -0,0 +1,55 @@
+"""Tests of osm_sample.py."""
+
+import gzip
+from collections import Counter
+import pytest
+import osm_sample
+from conftest import write_osm
+
+NODES = 20000
+
+
+@pytest.fixture(scope='module')
+def osm_path(tmp_path_factory):
+    path = tmp_path_factory.mktemp('sample') / "area.osm"
+    with open(str(path), 'wb') as outf:
+        write_osm(outf, NODES)
+    return str(path)
+
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_distinct_estimate(osm_path, seed):
+    """The windows do not overlap, and the estimated number of distinct node
+    ids (all of them distinct) is close to the real one."""
+    (profiles, length, window) = osm_sample.sample_profiles(
+        osm_path, 0.1, [".//node[@id]"], window=16 * 1024, seed=seed)
+    ids = Counter()
+    for profile in profiles:
+        ids.update(profile.attr_values[".//node[@id]"])
+    assert max(ids.values()) == 1
+
+    (attr_distinct, _) = osm_sample.estimate_values(profiles, length, window)
+    assert abs(attr_distinct[".//node[@id]"] - NODES) < 0.2 * NODES
+
+
+def test_distinct_estimate_few_values():
+    """Values seen often are not extrapolated."""
+    counter = Counter({'a': 50, 'b': 20, 'c': 7})
+    assert osm_sample.estimate_distinct(counter, 0.01) == 3
+    assert osm_sample.estimate_distinct(Counter(), 0.01) == 0
+
+
+def test_single_gzip_member_refused(tmp_path, osm_data):
+    """A plain gzip file cannot be sampled, a multi-member one can."""
+    single = tmp_path / "single.osm.gz"
+    single.write_bytes(gzip.compress(osm_data))
+    with pytest.raises(ValueError, match="single gzip member"):
+        osm_sample.sample_profiles(str(single), 0.1, window=64 * 1024, seed=1)
+
+    multi = tmp_path / "multi.osm.gz"
+    multi.write_bytes(b"".join(gzip.compress(osm_data[i:i + 128 * 1024])
+                               for i in range(0, len(osm_data), 128 * 1024)))
+    (profiles, length, window) = osm_sample.sample_profiles(
+        str(multi), 0.1, window=64 * 1024, seed=1)
+    assert length == len(osm_data)
+    assert len(profiles) == 2
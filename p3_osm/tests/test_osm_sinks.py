@@ -0,0 +1,58 @@
+"""Tests of osm_sinks.py (the SQLite sink, which needs no server)."""
+
+import json
+import sqlite3
+import open_file
+import osm_sinks
+import osm_to_json
+from conftest import write_osm
+
+
+def _rows(db_filename):
+    db = sqlite3.connect(db_filename)
+    try:
+        return {(doc_type, doc_id): doc for (doc_type, doc_id, doc) in
+                db.execute("SELECT type, id, doc FROM map")}
+    finally:
+        db.close()
+
+
+def test_sqlite_sink(tmp_path):
+    path = tmp_path / "area.osm"
+    with open(str(path), 'wb') as outf:
+        write_osm(outf, 300, ways=60)
+    db_filename = str(tmp_path / "area.db")
+    docs = list(osm_to_json.iter_typed_documents(open_file.open_file(str(path))))
+
+    count = osm_to_json.load_map(open_file.open_file(str(path)),
+                                 osm_sinks.SqliteSink(db_filename, batch_size=50))
+    assert count == len(docs) == 360
+    rows = _rows(db_filename)
+    assert rows == {(doc_type, int(doc_id)): json.dumps(doc)
+                    for (doc_type, doc_id, doc) in docs}
+    # The rows are keyed by the type of the element, not by the "type" tag
+    assert any(json.loads(doc)['type'] != doc_type
+               for ((doc_type, _), doc) in rows.items())
+
+    # The JSON1 functions of SQLite read the payloads
+    db = sqlite3.connect(db_filename)
+    (lat, refs) = db.execute(
+        "SELECT json_extract(doc, '$.pos[0]'), json_array_length(doc, '$.node_refs') "
+        "FROM map WHERE type = 'node' AND id = 1").fetchone()
+    assert (lat, refs) == (docs[0][2]['pos'][0], None)
+    (refs,) = db.execute("SELECT json_array_length(doc, '$.node_refs') FROM map "
+                         "WHERE type = 'way' AND id = 1").fetchone()
+    assert refs == len(docs[300][2]['node_refs'])
+    db.close()
+
+    # Loading again replaces the documents, a Deletion removes one
+    changed = dict(docs[0][2], name="Changed")
+    with osm_sinks.SqliteSink(db_filename, batch_size=2) as sink:
+        sink.add('node', '1', changed)
+        sink.delete('node', '2')
+        sink.add(*docs[300])
+    rows = _rows(db_filename)
+    assert len(rows) == 359
+    assert json.loads(rows[('node', 1)])['name'] == "Changed"
+    assert ('node', 2) not in rows
+    assert rows[('way', 1)] == json.dumps(docs[300][2])
@@ -0,0 +1,135 @@
+"""Tests of osm_to_json.py."""
+
+import os
+import subprocess
+import sys
+import pytest
+import node_store
+import open_file
+import osm_changes
+import osm_filters
+import osm_to_json
+
+# Size in MB of the synthetic input of the streaming memory test (e.g. 4000
+# for a multi-GB run); a run with a fifth of it is the reference
+STREAM_TEST_MB = int(os.environ.get('OSM_TEST_STREAM_MB', 40))
+
+# Max. growth in MB of the peak RSS from the reference to the full run
+STREAM_RSS_GROWTH_MB = 16
+
+_STREAM_SCRIPT = """
+import os, resource, sys, threading
+sys.path[:0] = sys.argv[1:3]
+from conftest import write_osm
+import osm_to_json
+
+size = int(sys.argv[3])
+(read_fd, write_fd) = os.pipe()
+
+def produce():
+    with os.fdopen(write_fd, 'wb') as outf:
+        write_osm(outf, nodes=6000 * size, ways=1500 * size, relations=200 * size)
+
+thread = threading.Thread(target=produce)
+thread.start()
+with os.fdopen(read_fd, 'rb') as inf:
+    count = osm_to_json.process_map(inf, sys.argv[4], stream=True)
+thread.join()
+print(count, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def _stream_peak_rss(size, tmp_path):
+    """Convert a synthetic OSM file of about "size" MB, generated on the fly,
+    in a fresh interpreter.
+
+    Returns:
+        (number of documents, peak RSS in MB)
+    """
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+    output = subprocess.check_output(
+        [sys.executable, "-c", _STREAM_SCRIPT, tests_dir, os.path.dirname(tests_dir),
+         str(size), str(tmp_path / "out{}".format(size))])
+    (count, max_rss) = output.split()
+    os.remove(str(tmp_path / "out{}.json".format(size)))
+    return (int(count), int(max_rss) / 1024)
+
+
+def test_streaming_memory_is_bounded(tmp_path):
+    """The peak memory of process_map(stream=True) does not grow with the
+    size of the input."""
+    (small_count, small_rss) = _stream_peak_rss(STREAM_TEST_MB // 5, tmp_path)
+    (count, rss) = _stream_peak_rss(STREAM_TEST_MB, tmp_path)
+    assert count == 5 * small_count
+    assert rss < small_rss + STREAM_RSS_GROWTH_MB, (small_rss, rss)
+
+
+@pytest.mark.parametrize('options', [
+    {},
+    {'way_coords': True},
+    {'element_filter': osm_filters.ElementFilter(keys=['amenity', 'addr:*'])},
+    {'way_coords': True, 'element_filter': osm_filters.ElementFilter(types=['way'])},
+])
+def test_parallel_output_equals_serial(tmp_path, osm_data, options):
+    """The JSON file (and offset index) converted by 4 processes from chunks
+    of the input is byte for byte the serial one, also with the node
+    coordinates of a node store (--way-coords --node-store) and element
+    filters."""
+    path = tmp_path / "area.osm"
+    path.write_bytes(osm_data)
+    prefix = None
+    nodes = None
+    if options.get('way_coords'):
+        prefix = str(tmp_path / "area-nodes")
+        node_store.build_store(open_file.open_file(str(path))).save(prefix)
+        nodes = node_store.NodeStore.load(prefix)
+    element_filter = options.get('element_filter')
+
+    serial_offsets = osm_changes.OffsetIndexBuilder()
+    serial_count = osm_to_json.process_map(
+        open_file.open_file(str(path)), str(tmp_path / "serial"), stream=True,
+        nodes=nodes, element_filter=element_filter, offset_index=serial_offsets)
+    parallel_offsets = osm_changes.OffsetIndexBuilder()
+    parallel_count = osm_to_json.process_map_parallel(
+        open_file.open_file(str(path)), str(tmp_path / "parallel"), 4,
+        chunk_size=64 * 1024, node_store_prefix=prefix,
+        element_filter=element_filter, offset_index=parallel_offsets)
+
+    serial = (tmp_path / "serial.json").read_bytes()
+    assert parallel_count == serial_count > 0
+    assert (tmp_path / "parallel.json").read_bytes() == serial
+    assert (parallel_offsets.build().offsets == serial_offsets.build().offsets).all()
+    if nodes is not None:
+        assert b'"node_pos": [[' in serial
+
+
+@pytest.mark.parametrize('args', [
+    ['--way-coords'], ['--bbox', '47.3', '8.5', '47.35', '8.55']])
+def test_serial_fallback_notice(tmp_path, osm_data, monkeypatch, capsys, args):
+    """With -j, the options which need a serial conversion are reported."""
+    path = tmp_path / "area.osm"
+    path.write_bytes(osm_data)
+    monkeypatch.setattr(sys, 'argv', ['osm_to_json.py', '-j', '4'] + args + [str(path)])
+    osm_to_json.main()
+    assert "> Converting serially (" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('size', [osm_to_json.STRING_TABLE_SIZE, 5])
+def test_interned_output_equals_plain(tmp_path, osm_data, size):
+    """The documents with shared strings (also from a full table) and their
+    JSON file are the ones without a StringTable."""
+    path = tmp_path / "area.osm"
+    path.write_bytes(osm_data)
+    plain = osm_to_json.process_map(open_file.open_file(str(path)),
+                                    str(tmp_path / "plain"))
+    strings = osm_to_json.StringTable(size=size)
+    interned = osm_to_json.process_map(open_file.open_file(str(path)),
+                                       str(tmp_path / "interned"), strings=strings)
+    assert interned == plain
+    assert (tmp_path / "interned.json").read_bytes() == (tmp_path / "plain.json").read_bytes()
+    assert len(strings) <= size
+    assert strings.hits > 0
+
+    values = [doc['amenity'] for doc in interned if doc.get('amenity') == "v7"]
+    assert len(values) > 1
+    assert all(value is values[0] for value in values) == (size > 5)
@@ -0,0 +1,71 @@
+"""Tests of sketches.py."""
+
+import random
+from collections import Counter
+import pytest
+import sketches
+
+
+@pytest.mark.parametrize('distinct', [50, 3000, 200000])
+def test_hyperloglog_error(distinct):
+    """The estimate is within 4 standard errors (1.04 / sqrt(4096), i.e.
+    1.6%) of the true number of distinct values, duplicates included."""
+    hll = sketches.HyperLogLog()
+    for i in range(distinct):
+        hll.add("v{}".format(i))
+        if i % 3 == 0:
+            hll.add("v{}".format(i))
+    assert abs(len(hll) - distinct) <= 4 * 1.04 / 64 * distinct + 1
+
+
+def test_hyperloglog_update():
+    """A merged sketch is the sketch of the union."""
+    (first, second, union) = (sketches.HyperLogLog(), sketches.HyperLogLog(),
+                              sketches.HyperLogLog())
+    for i in range(20000):
+        (first if i % 2 else second).add(str(i))
+        union.add(str(i))
+    first.update(second)
+    assert first.registers == union.registers
+
+
+def test_space_saving_bounds():
+    """On a skewed stream, each reported count overestimates the true count
+    by at most its error, and all the values more frequent than
+    total / capacity are monitored."""
+    rand = random.Random(3)
+    stream = ["v{}".format(int(rand.paretovariate(1.2))) for _ in range(50000)]
+    true = Counter(stream)
+    capacity = 40
+    heavy = sketches.SpaceSaving(capacity)
+    for value in stream:
+        heavy.add(value)
+
+    top = heavy.most_common(capacity)
+    for (value, count, error) in top:
+        assert count - error <= true[value] <= count
+    monitored = {value for (value, _, _) in top}
+    for (value, count) in true.items():
+        if count > len(stream) / capacity:
+            assert value in monitored
+    assert [value for (value, _, _) in top[:3]] == [
+        value for (value, _) in true.most_common(3)]
+
+
+def test_value_sketch_switches_to_sketches():
+    sketch = sketches.ValueSketch(threshold=100, top=5)
+    for i in range(100):
+        sketch.add(str(i % 60))
+    summary = sketch.summary()
+    assert summary['exact']
+    assert summary['distinct'] == 60
+    assert summary['values'] == {str(i) for i in range(60)}
+
+    for i in range(5000):
+        sketch.add(str(i))
+        sketch.add("frequent")
+    summary = sketch.summary()
+    assert not summary['exact']
+    assert 'values' not in summary
+    assert abs(summary['distinct'] - 5001) < 5001 * 0.07
+    assert summary['top'][0][:2] == ("frequent", 5000)
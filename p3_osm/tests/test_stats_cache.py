@@ -0,0 +1,37 @@
+"""Tests of stats_cache.py."""
+
+import os
+import stats_cache
+from conftest import write_osm
+
+OSC = b"""<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6">
+  <create>
+    <node id="{}" lat="47.3000000" lon="8.5000000" version="1">
+      <tag k="amenity" v="cafe"/>
+    </node>
+  </create>
+</osmChange>
+"""
+
+
+def test_changes_with_same_size_and_mtime(tmp_path):
+    """Two different change files with the same size and modification time
+    are both applied, and a copy of an applied one is skipped."""
+    path = tmp_path / "area.osm"
+    with open(str(path), 'wb') as outf:
+        write_osm(outf, 100)
+    first = tmp_path / "first.osc"
+    second = tmp_path / "second.osc"
+    first.write_bytes(OSC.replace(b"{}", b"1001"))
+    second.write_bytes(OSC.replace(b"{}", b"1002"))
+    copy = tmp_path / "copy.osc"
+    copy.write_bytes(first.read_bytes())
+    for osc in (first, second, copy):
+        os.utime(str(osc), ns=(10 ** 18, 10 ** 18))
+
+    stats_cache.get_profile(str(path), incremental=True)
+    (profile, applied) = stats_cache.get_profile(
+        str(path), changes=[str(first), str(second), str(copy)])
+    assert applied == [str(first), str(second)]
+    assert profile.tag_counts['node'] == 102
@@ -0,0 +1,36 @@
+"""Tests of value_dump.py."""
+
+import pprint
+import pytest
+import value_dump
+
+# Values with the separators of the format and other special characters
+ODD_VALUES = {"tab\there", "new\nline", "cr\rlf\r\n", '"quoted"', "back\\slash",
+              "Zürich", "line\u2028separator\x85", "", " "}
+
+
+@pytest.mark.parametrize('suffix', ['.vals', '.vals.gz', '.vals.bz2', '.vals.xz'])
+def test_kv_round_trip(tmp_path, suffix):
+    values = {"amenity": {"bar", "school"},
+              "name\twith tab": ODD_VALUES,
+              "many": {str(i) for i in range(2 * value_dump.DUMP_LINE_VALUES + 5)}}
+    filename = str(tmp_path / ("kv-node-tag" + suffix))
+    assert value_dump.is_dump(filename)
+    value_dump.write_values(filename, ".//node/tag", values)
+
+    assert value_dump.read_header(filename) == (".//node/tag", "kv")
+    assert value_dump.read_values(filename) == {".//node/tag": values}
+    lines = list(value_dump.iter_values(filename, ["many"]))
+    assert [len(vals) for (_, vals) in lines] == [1000, 1000, 5]
+
+
+def test_attr_round_trip_equals_pprint(tmp_path):
+    """An attribute dump reads back like the eval() of the pprint dump."""
+    values = ODD_VALUES | {"47.3", "8.5"}
+    filename = str(tmp_path / "attr-node-user.vals")
+    value_dump.write_values(filename, ".//node[@user]", values)
+
+    pprinted = pprint.pformat({".//node[@user]": values})
+    assert value_dump.read_values(filename) == eval(pprinted)
+    assert [key for (key, _) in value_dump.iter_values(filename)] == [None]
+    assert not value_dump.is_dump(str(tmp_path / "attr-node-user.txt"))
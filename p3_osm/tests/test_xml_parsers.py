@@ -0,0 +1,39 @@
+"""Tests of xml_parsers.py."""
+
+import io
+import xml.etree.ElementTree as ET
+import pytest
+import xml_parsers
+
+
+@pytest.fixture(params=xml_parsers.PARSERS)
+def parser(request):
+    if request.param == 'lxml':
+        pytest.importorskip('lxml')
+    return request.param
+
+
+def _describe(elem):
+    """Return the tag, attributes and children of an element as data."""
+    return (elem.tag, dict(elem.attrib), [_describe(child) for child in elem])
+
+
+def test_iter_elements(osm_data, parser):
+    """The selected elements are complete, and the other top-level elements
+    are released as the input is read."""
+    expected = [_describe(elem) for elem in ET.fromstring(osm_data)
+                if elem.tag in ('node', 'way')]
+    elements = []
+    for elem in xml_parsers.iter_elements(io.BytesIO(osm_data), ('node', 'way'),
+                                          parser):
+        elements.append(_describe(elem))
+        if parser == 'lxml':
+            # At most the (cleared) previous element is kept
+            assert len(list(elem.itersiblings(preceding=True))) <= 1
+    assert elements == expected
+
+
+def test_parse(osm_data, parser):
+    """All backends build the same tree."""
+    root = xml_parsers.parse(io.BytesIO(osm_data), parser).getroot()
+    assert _describe(root) == _describe(ET.fromstring(osm_data))
@@ -0,0 +1,123 @@
+"""
+Compact, streamable dump format for the values harvested by get_xml_values.py.
+
+The pprint format written by default by get_xml_values.py has to be read back
+with eval() as a whole, which is slow and needs a lot of memory for big dumps.
+In the value dump format, each line holds a group of values of one key:
+
+    <key as JSON> TAB <list of values as JSON> NEWLINE
+
+The first line holds the xpath of the dump and its kind ("attr" for
+attribute values, "kv" for k:v pairs), with the key null, e.g.:
+
+    null	[".//node/tag", "kv"]
+    "amenity"	["bar", "school"]
+    "phone"	["+41 44 123 45 67"]
+
+For attribute dumps (without k:v pairs) the key of the value lines is null.
+The values of a key are sorted and split into lines of at most
+DUMP_LINE_VALUES values. Since JSON strings never contain a raw TAB, a
+reader can skip the lines of the keys it is not interested in without
+decoding their values.
+
+The dump files can be compressed, depending on their suffix (".gz", ".bz2"
+or ".xz").
+
+Attributes:
+    DUMP_SUFFIX: str -- the suffix of (uncompressed) value dump files
+    DUMP_LINE_VALUES: int -- the maximal number of values per line
+    COMPRESSION: dict -- the compressed file suffixes and their modules
+"""
+
+import bz2
+import gzip
+import json
+import lzma
+
+DUMP_SUFFIX = ".vals"
+DUMP_LINE_VALUES = 1000
+COMPRESSION = {'gz': gzip, 'bz2': bz2, 'xz': lzma}
+
+
+def _open(filename, mode):
+    """Open a (compressed) dump file in text mode."""
+    module = COMPRESSION.get(filename.rsplit('.', 1)[-1])
+    if module is None:
+        return open(filename, mode, encoding='utf-8')
+    return module.open(filename, mode + 't', encoding='utf-8')
+
+
+def is_dump(filename):
+    """Check whether a filename is the one of a (compressed) value dump."""
+    if filename.rsplit('.', 1)[-1] in COMPRESSION:
+        filename = filename.rsplit('.', 1)[0]
+    return filename.endswith(DUMP_SUFFIX)
+
+
+def write_values(filename, xpath, values):
+    """Write the values of one xpath to a dump file.
+
+    Args:
+        filename: str -- the dump file (compressed depending on its suffix)
+        xpath: str -- the xpath of the values
+        values: set of str, or dict {<key>: set of str} -- the attribute
+                values or the k:v pairs, as returned by get_xml_values.py
+    """
+    kind = 'kv' if isinstance(values, dict) else 'attr'
+    if kind == 'attr':
+        values = {None: values}
+
+    with _open(filename, 'w') as outf:
+        outf.write("null\t{}\n".format(json.dumps([xpath, kind])))
+        for key in sorted(values, key=lambda key: key or ""):
+            vals = sorted(values[key])
+            prefix = json.dumps(key)
+            for start in range(0, len(vals), DUMP_LINE_VALUES):
+                outf.write("{}\t{}\n".format(
+                    prefix, json.dumps(vals[start:start + DUMP_LINE_VALUES],
+                                       ensure_ascii=False)))
+
+
+def iter_values(filename, keys=None):
+    """Read a dump file line by line.
+
+    Args:
+        filename: str -- the dump file
+        keys: iterable of str -- if given, only the values of these keys are
+              decoded and yielded
+
+    Yields:
+        (key, list of values) tuples, possibly several for the same key. The
+        key is None in attribute dumps.
+    """
+    if keys is not None:
+        keys = {json.dumps(key) for key in keys}
+
+    with _open(filename, 'r') as inf:
+        inf.readline()  # The header
+        for line in inf:
+            (key, values) = line.split('\t', 1)
+            if keys is None or key in keys:
+                yield (json.loads(key), json.loads(values))
+
+
+def read_header(filename):
+    """Return the (xpath, kind) of a dump file."""
+    with _open(filename, 'r') as inf:
+        return tuple(json.loads(inf.readline().split('\t', 1)[1]))
+
+
+def read_values(filename):
+    """Read a whole dump file, like eval() of a pprint dump would.
+
+    Returns:
+        {<xpath>: <set of values>} for attribute dumps, or
+        {<xpath>: {<key>: <set of values>}} for k:v dumps
+    """
+    (xpath, kind) = read_header(filename)
+    values = {}
+    for (key, vals) in iter_values(filename):
+        values.setdefault(key, set()).update(vals)
+    if kind == 'attr':
+        values = values.get(None, set())
+    return {xpath: values}
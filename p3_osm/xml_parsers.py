@@ -0,0 +1,230 @@
+"""
+Selectable XML parser backends for the iterparse() of open_file.py.
+
+All scripts parse their input via open_file.iterparse(), which uses one of
+these backends:
+- "etree": xml.etree.ElementTree.iterparse of the standard library (the
+  default);
+- "lxml": lxml.etree.iterparse, with huge_tree enabled (for very long text
+  and attribute values) and with the tag filtering done by lxml itself
+  (requires lxml);
+- "expat": a raw driver of the expat parser of the standard library, which
+  builds ElementTree elements from the start and end callbacks only (the
+  text of the elements is not kept, OSM files only have attributes).
+
+The scripts that only need some of the elements directly below the root
+element (e.g. the <node> and <way> elements) read them with iter_elements(),
+which passes the tags to lxml, so that the events of the other elements (and
+of the <nd> and <tag> children) are not reported to Python at all. Whole
+files are parsed by parse() with the chosen backend too.
+
+The backend is chosen with the "--parser" option of the scripts (see
+add_parser_argument()). The choice is stored in the environment variable
+PARSER_ENV, so that the worker processes of the parallel modes use it too.
+
+Compare the backends on an input file with:
+    > ./bench.py parsers zurich-area.osm
+
+Attributes:
+    PARSERS: tuple of str -- the backend names
+    DEFAULT_PARSER: str -- the backend used if none was chosen
+    PARSER_ENV: str -- the environment variable holding the chosen backend
+    EXPAT_CHUNK_SIZE: int -- the size of the chunks fed to the expat parser
+    OSM_ELEMENTS: tuple of str -- the tags of the elements of an OSM file
+                  directly below the root element that can be large
+"""
+
+import os
+import xml.etree.ElementTree as ET
+from xml.parsers import expat
+
+PARSERS = ('etree', 'lxml', 'expat')
+DEFAULT_PARSER = 'etree'
+PARSER_ENV = "OSM_XML_PARSER"
+EXPAT_CHUNK_SIZE = 1024 * 1024
+OSM_ELEMENTS = ('node', 'way', 'relation')
+
+
+def get_default():
+    """Return the name of the chosen backend."""
+    return os.environ.get(PARSER_ENV, DEFAULT_PARSER)
+
+
+def set_default(name):
+    """Choose the backend used by default (also in child processes)."""
+    if name not in PARSERS:
+        raise ValueError("Unknown XML parser: " + name)
+    os.environ[PARSER_ENV] = name
+
+
+def _etree_iterparse(inf, events, tag):
+    if tag is None:
+        return ET.iterparse(inf, events=events)
+    return ((event, elem) for (event, elem) in ET.iterparse(inf, events=events)
+            if elem.tag in tag)
+
+
+def _lxml_iterparse(inf, events, tag):
+    from lxml import etree
+    return etree.iterparse(inf, events=events, tag=tag, huge_tree=True)
+
+
+def _expat_iterparse(inf, events, tag):
+    report_start = 'start' in events
+    report_end = 'end' in events
+    stack = []
+    pending = []
+
+    def start(name, attrs):
+        elem = ET.Element(name, attrs)
+        if stack:
+            stack[-1].append(elem)
+        stack.append(elem)
+        if report_start and (tag is None or name in tag):
+            pending.append(('start', elem))
+
+    def end(name):
+        elem = stack.pop()
+        if report_end and (tag is None or name in tag):
+            pending.append(('end', elem))
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    while True:
+        data = inf.read(EXPAT_CHUNK_SIZE)
+        if not data:
+            break
+        parser.Parse(data, False)
+        yield from pending
+        pending.clear()
+    parser.Parse(b"", True)
+    yield from pending
+
+
+_BACKENDS = {'etree': _etree_iterparse, 'lxml': _lxml_iterparse,
+             'expat': _expat_iterparse}
+
+
+def iterparse(inf, events=('end',), parser=None, tag=None):
+    """Parse incrementally a binary XML fileobject, like
+    ElementTree.iterparse().
+
+    Args:
+        inf: binary fileobject -- the XML input
+        events: tuple of str -- the events to report ("start" and/or "end")
+        parser: str -- the backend (the chosen one if None, see set_default())
+        tag: str or tuple of str -- if given, only the events of the elements
+             with these tags are reported. The other elements are still
+             built, so the caller has to release them (e.g. by clearing the
+             root element).
+
+    Return:
+        an iterator of (event, element) tuples
+    """
+    parser = parser or get_default()
+    if parser not in _BACKENDS:
+        raise ValueError("Unknown XML parser: " + parser)
+    if isinstance(tag, str):
+        tag = (tag,)
+    return _BACKENDS[parser](inf, tuple(events), tuple(tag) if tag else None)
+
+
+def select_elements(events, tag):
+    """Select the elements directly below the root element from the start
+    and end events of a whole document.
+
+    Each element is yielded once it is complete, and released (with all the
+    elements before it) when the next one is requested.
+
+    Args:
+        events: iterator of (event, element) tuples, with "start" and "end"
+                events of all elements
+        tag: tuple of str -- the tags of the elements to yield
+
+    Yields:
+        the elements
+    """
+    depth = 0
+    root = None
+    for (event, elem) in events:
+        if event == 'start':
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+
+        depth -= 1
+        if depth == 1:
+            if elem.tag in tag:
+                yield elem
+            elem.clear()
+            root.clear()
+
+
+def _lxml_iter_elements(inf, tag):
+    # All the large top-level elements are reported (not only the selected
+    # ones), so that the unselected ones are released too
+    for (_, elem) in _lxml_iterparse(inf, ('end',), tuple(set(tag + OSM_ELEMENTS))):
+        parent = elem.getparent()
+        if parent is None or parent.getparent() is not None:
+            continue
+        if elem.tag in tag:
+            yield elem
+        elem.clear()
+        while elem.getprevious() is not None:
+            del parent[0]
+
+
+def iter_elements(inf, tag, parser=None):
+    """Parse incrementally a binary XML fileobject and yield the complete
+    elements with the given tags directly below the root element.
+
+    The elements are released when the next one is requested, so the memory
+    use does not grow with the size of the input.
+
+    Args:
+        inf: binary fileobject -- the XML input
+        tag: str or tuple of str -- the tags of the elements to yield
+        parser: str -- the backend (the chosen one if None, see set_default())
+
+    Yields:
+        the elements
+    """
+    parser = parser or get_default()
+    if isinstance(tag, str):
+        tag = (tag,)
+    if parser == 'lxml':
+        return _lxml_iter_elements(inf, tuple(tag))
+    return select_elements(iterparse(inf, ('start', 'end'), parser), tuple(tag))
+
+
+def parse(inf, parser=None):
+    """Parse a whole binary XML fileobject, like ElementTree.parse().
+
+    Args:
+        inf: binary fileobject -- the XML input
+        parser: str -- the backend (the chosen one if None, see set_default())
+
+    Return:
+        an ElementTree object (an lxml one with the "lxml" backend)
+    """
+    parser = parser or get_default()
+    if parser == 'lxml':
+        from lxml import etree
+        return etree.parse(inf, etree.XMLParser(huge_tree=True))
+    if parser == 'expat':
+        root = None
+        for (_, elem) in _expat_iterparse(inf, ('start',), None):
+            root = elem if root is None else root
+        return ET.ElementTree(root)
+    if parser not in _BACKENDS:
+        raise ValueError("Unknown XML parser: " + parser)
+    return ET.parse(inf)
+
+
+def add_parser_argument(parser):
+    """Add the "--parser" option to an ArgumentParser."""
+    parser.add_argument("--parser", choices=PARSERS, default=None,
+                        help="the XML parser backend (default: {}, see "
+                             "xml_parsers.py)".format(get_default()))
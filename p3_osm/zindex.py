@@ -0,0 +1,392 @@
+#!/usr/bin/python3
+
+"""Random-access checkpoint index for compressed OSM XML files.
+
+A compressed file can normally be read only from its start. The index built
+by this module stores decompression checkpoints, i.e. positions in the
+compressed file from which decompression can be restarted:
+- bzip2: the bit offsets of all compressed blocks, which are independent of
+  each other (see bz2_parallel.py);
+- gzip: the byte offsets of all gzip members. Files compressed by e.g.
+  "bgzip" (or concatenated gzip files) consist of many members. A deflate
+  stream cannot be restarted within a member without the 32 KB window
+  preceding the restart point, which Python's zlib cannot restore at a
+  bit position, so a file compressed by plain "gzip" (one member) has a
+  single checkpoint: it can only be read serially from its start, and
+  neither split into chunks nor sampled efficiently.
+
+For each checkpoint the corresponding offset in the uncompressed data is
+stored too, as well as the uncompressed offsets at which the first <node>,
+<way> and <relation> elements start. Thus any uncompressed byte range or OSM
+section can be read by decompressing only from the nearest checkpoint on, and
+several workers can each take their own slice of the compressed file.
+
+The index is stored as JSON in a sidecar file "<filename>.idx". It is built
+once and reused as long as the size and modification time of the compressed
+file do not change.
+
+Example run (build the index and print a summary):
+    > ./zindex.py zurich-area.osm.bz2
+
+Attributes:
+    INDEX_SUFFIX: str -- the suffix of the sidecar index files
+    READ_SIZE: int -- size in bytes of the compressed data read at once
+"""
+
+import bisect
+import bz2
+import io
+import json
+import os
+import re
+import zlib
+import bz2_parallel
+import open_file
+
+INDEX_SUFFIX = ".idx"
+READ_SIZE = 4 * 1024 * 1024
+
+# The supported formats, by lowercased filename extension (see
+# open_file._get_ext(); compressed tar archives are not XML files and cannot
+# be indexed)
+FORMATS = {'bz2': 'bzip2', 'gz': 'gzip', 'osm': 'plain', 'xml': 'plain'}
+
+# Start of a top-level OSM section element
+SECTION_RE = re.compile(rb"<(node|way|relation)[\s/>]")
+SECTIONS = ('node', 'way', 'relation')
+
+
+def _get_format(filename):
+    """Return the format ("bzip2", "gzip" or "plain") of the given file."""
+    ext = open_file._get_ext(filename)
+    if ext not in FORMATS:
+        raise ValueError("Cannot index file with extension: " + ext)
+    return FORMATS[ext]
+
+
+def _fingerprint(filename):
+    """Return the (size, mtime) fingerprint of a file."""
+    stat = os.stat(filename)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+class _SectionScanner:
+    """Find the uncompressed offsets of the first <node>/<way>/<relation>."""
+
+    def __init__(self):
+        self.sections = {}
+        self._tail = b""
+        self._offset = 0  # Uncompressed offset of self._tail[0]
+
+    def feed(self, data):
+        """Scan the next piece of uncompressed data."""
+        if len(self.sections) < len(SECTIONS):
+            buf = self._tail + data
+            for match in SECTION_RE.finditer(buf):
+                tag = match.group(1).decode()
+                if tag not in self.sections:
+                    self.sections[tag] = self._offset + match.start()
+            # Keep enough bytes to match a section start split between pieces
+            keep = min(len(buf), 10)
+            self._tail = buf[len(buf) - keep:]
+            self._offset += len(buf) - keep
+        else:
+            self._offset += len(data)
+
+
+def _build_bzip2(filename):
+    """Return the checkpoints ([start_bit, end_bit, uncompressed offset] per
+    block), the uncompressed length and the sections of a bzip2 file."""
+    checkpoints = []
+    scanner = _SectionScanner()
+    offset = 0
+    with open(filename, 'rb') as inf:
+        for (start, end, stream) in bz2_parallel.iter_blocks(inf):
+            data = bz2.decompress(stream)
+            checkpoints.append([start, end, offset])
+            scanner.feed(data)
+            offset += len(data)
+    return (checkpoints, offset, scanner.sections)
+
+
+def _build_gzip(filename):
+    """Return the checkpoints ([byte offset, uncompressed offset] per member),
+    the uncompressed length and the sections of a gzip file."""
+    checkpoints = []
+    scanner = _SectionScanner()
+    offset = 0
+    comp_pos = 0  # Compressed offset of the first byte of "pending"
+    pending = b""
+    decomp = None
+    with open(filename, 'rb') as inf:
+        while True:
+            if not pending:
+                pending = inf.read(READ_SIZE)
+                if not pending:
+                    break
+            if decomp is None:
+                # A new gzip member starts here
+                decomp = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                checkpoints.append([comp_pos, offset])
+            data = decomp.decompress(pending)
+            scanner.feed(data)
+            offset += len(data)
+            if decomp.eof:
+                comp_pos += len(pending) - len(decomp.unused_data)
+                pending = decomp.unused_data
+                decomp = None
+            else:
+                comp_pos += len(pending)
+                pending = b""
+    return (checkpoints, offset, scanner.sections)
+
+
+def _build_plain(filename):
+    """Return the (trivial) checkpoints, the length and the sections of an
+    uncompressed file."""
+    scanner = _SectionScanner()
+    with open(filename, 'rb') as inf:
+        for data in iter(lambda: inf.read(READ_SIZE), b""):
+            scanner.feed(data)
+            if len(scanner.sections) == len(SECTIONS):
+                break
+    return ([[0, 0]], os.path.getsize(filename), scanner.sections)
+
+
+def build_index(filename):
+    """Build the checkpoint index of a file and store it in its sidecar file.
+
+    Args:
+        filename: str -- the compressed (or plain) OSM XML file
+
+    Returns:
+        index: dict -- the index, see load_index()
+    """
+    fmt = _get_format(filename)
+    builder = {'bzip2': _build_bzip2, 'gzip': _build_gzip,
+               'plain': _build_plain}[fmt]
+    (checkpoints, length, sections) = builder(filename)
+    (size, mtime) = _fingerprint(filename)
+    index = {'format': fmt, 'size': size, 'mtime': mtime, 'length': length,
+             'checkpoints': checkpoints, 'sections': sections}
+
+    with open(filename + INDEX_SUFFIX, 'w') as outf:
+        json.dump(index, outf)
+    return index
+
+
+def load_index(filename):
+    """Load the index of a file from its sidecar file, if it is up-to-date.
+
+    Args:
+        filename: str -- the compressed (or plain) OSM XML file
+
+    Returns:
+        None if there is no up-to-date index, or else a dict with the keys
+        "format" -- "bzip2", "gzip" or "plain"
+        "size", "mtime" -- the fingerprint of the indexed file
+        "length" -- the uncompressed length of the file
+        "checkpoints" -- list of checkpoints, each ending with the uncompressed
+                         offset of the checkpoint (see _build_bzip2/_build_gzip)
+        "sections" -- dict {"node"/"way"/"relation": uncompressed offset}
+    """
+    try:
+        with open(filename + INDEX_SUFFIX) as inf:
+            index = json.load(inf)
+    except (OSError, ValueError):
+        return None
+    if (index.get('size'), index.get('mtime')) != _fingerprint(filename):
+        return None
+    return index
+
+
+def get_index(filename):
+    """Return the index of a file, building it if it does not exist yet."""
+    return load_index(filename) or build_index(filename)
+
+
+def has_random_access(index):
+    """Check whether a file can be read from other positions than its start
+    without decompressing everything before them (i.e. it is not a gzip file
+    of a single member)."""
+    return not (index['format'] == 'gzip' and len(index['checkpoints']) == 1)
+
+
+def find_checkpoint(index, offset):
+    """Return the number of the last checkpoint at or before an uncompressed
+    offset."""
+    offsets = [cp[-1] for cp in index['checkpoints']]
+    return max(bisect.bisect_right(offsets, offset) - 1, 0)
+
+
+def split(index, parts):
+    """Split the uncompressed data into ranges starting at checkpoints.
+
+    Args:
+        index: dict -- the index of the file
+        parts: int -- the desired number of ranges
+
+    Returns:
+        list of (start, end) uncompressed offsets. Fewer than "parts" ranges
+        are returned if the file has fewer checkpoints.
+    """
+    length = index['length']
+    targets = [length * i // parts for i in range(parts)]
+    if index['format'] == 'plain':
+        bounds = targets
+    else:
+        checkpoints = index['checkpoints']
+        bounds = sorted({checkpoints[find_checkpoint(index, target)][-1]
+                         for target in targets})
+    bounds.append(length)
+    return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)
+            if bounds[i] < bounds[i + 1]]
+
+
+class IndexedReader(io.RawIOBase):
+    """A binary fileobject returning an uncompressed byte range of a file.
+
+    Decompression starts at the checkpoint nearest before the range start.
+
+    Args:
+        filename: str -- the compressed (or plain) file
+        index: dict -- the index of the file
+        start: int -- uncompressed offset of the range start
+        end: int -- uncompressed offset of the range end (None for file end)
+    """
+
+    def __init__(self, filename, index, start=0, end=None):
+        super().__init__()
+        self.name = filename
+        self._file = open(filename, 'rb')
+        self._index = index
+        self._start = start
+        self._end = index['length'] if end is None else min(end, index['length'])
+        self._chunks = self._iter_range()
+        self._data = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def _iter_uncompressed(self, checkpoint):
+        """Yield the uncompressed data from a checkpoint to the file end."""
+        checkpoints = self._index['checkpoints']
+        fmt = self._index['format']
+        if fmt == 'bzip2':
+            for (start, end, _) in checkpoints[checkpoint:]:
+                self._file.seek(start // 8)
+                data = self._file.read((end + 7) // 8 - start // 8)
+                base = start // 8 * 8
+                stream = bz2_parallel.make_block_stream(data, start - base,
+                                                        end - base)
+                yield bz2.decompress(stream)
+        elif fmt == 'gzip':
+            self._file.seek(checkpoints[checkpoint][0])
+            decomp = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            for data in iter(lambda: self._file.read(READ_SIZE), b""):
+                while data:
+                    yield decomp.decompress(data)
+                    if not decomp.eof:
+                        break
+                    data = decomp.unused_data
+                    decomp = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        else:
+            self._file.seek(self._start)
+            for data in iter(lambda: self._file.read(READ_SIZE), b""):
+                yield data
+
+    def _iter_range(self):
+        """Yield the uncompressed data of the range [start, end)."""
+        if self._index['format'] == 'plain':
+            checkpoint = 0
+            offset = self._start
+        else:
+            checkpoint = find_checkpoint(self._index, self._start)
+            offset = self._index['checkpoints'][checkpoint][-1]
+
+        for data in self._iter_uncompressed(checkpoint):
+            if offset >= self._end:
+                return
+            if offset + len(data) > self._start:
+                yield memoryview(data)[max(self._start - offset, 0):
+                                       self._end - offset]
+            offset += len(data)
+
+    def readinto(self, buf):
+        while not self._data:
+            self._data = next(self._chunks, None)
+            if self._data is None:
+                self._data = memoryview(b"")
+                return 0
+
+        size = min(len(buf), len(self._data))
+        buf[:size] = self._data[:size]
+        self._data = self._data[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+
+def open_range(filename, start=0, end=None, index=None):
+    """Open an uncompressed byte range of a (compressed) file for reading.
+
+    Args:
+        filename: str -- the compressed (or plain) OSM XML file
+        start: int -- uncompressed offset of the range start
+        end: int -- uncompressed offset of the range end (None for file end)
+        index: dict -- the index of the file (looked up if None)
+
+    Returns:
+        a buffered binary fileobject
+    """
+    index = index or get_index(filename)
+    return io.BufferedReader(IndexedReader(filename, index, start, end),
+                             buffer_size=1024 * 1024)
+
+
+def open_section(filename, tag, index=None):
+    """Open a file for reading from its first <node>, <way> or <relation>.
+
+    Returns:
+        a buffered binary fileobject, or None if the file has no such section
+    """
+    index = index or get_index(filename)
+    if tag not in index['sections']:
+        return None
+    return open_range(filename, index['sections'][tag], index=index)
+
+
+def main():
+    """The main function.
+    """
+    from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+    parser = ArgumentParser(description=__doc__,
+                            formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="rebuild the index even if it is up-to-date")
+    parser.add_argument("filename", metavar="FILE",
+                        help="input OSM XML file (bzip2 or gzip compressed)")
+    args = parser.parse_args()
+
+    if args.force:
+        index = build_index(args.filename)
+    else:
+        index = get_index(args.filename)
+
+    print("> Format: {}".format(index['format']))
+    print("> Uncompressed length: {}".format(index['length']))
+    print("> Checkpoints: {}".format(len(index['checkpoints'])))
+    if not has_random_access(index):
+        print("> Single gzip member: no random access, the file is read serially "
+              "(recompress it with bgzip for random access)")
+    for tag in SECTIONS:
+        if tag in index['sections']:
+            print("> First <{}> at offset: {}".format(tag, index['sections'][tag]))
+
+
+if __name__ == '__main__':
+    main()